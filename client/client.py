@@ -6,14 +6,23 @@ import webbrowser
 import socket
 import yaml
 import time
+import re
 import threading
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
 from platformdirs import user_downloads_path
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 
 # A simple list to act as a message queue between the server thread
 # and the main thread.
 RECEIVED_TOKEN = []
+# Any other parameters the server sent to the callback (e.g. 'sub' and
+# 'key_algorithm' for CSR issuance).
+RECEIVED_PARAMS = {}
 
 class Config:
     """
@@ -21,7 +30,7 @@ class Config:
     of precedence: CLI > Environment > User Config > System Config > Default.
     """
 
-    def __init__(self, server_url_flag, output_flag, overwrite_flag, option_flag, _user_config_path=None, _system_config_path=None):
+    def __init__(self, server_url_flag, output_flag, overwrite_flag, option_flag, _user_config_path=None, _system_config_path=None, csr_flag=None):
         # Allow paths to be injected for testing, otherwise use real paths
         self.user_config_path = _user_config_path if _user_config_path is not None else (Path.home() / ".config" / "ovpn-manager" / "config.yaml")
         self.system_config_path = _system_config_path if _system_config_path is not None else Path("/etc/ovpn-manager/config.yaml")
@@ -33,6 +42,7 @@ class Config:
         self.output_path = self._resolve_output_path(output_flag)
         self.overwrite = self._resolve_overwrite_flag(overwrite_flag)
         self.optionset = self._resolve_optionset(option_flag)
+        self.csr = self._resolve_csr_flag(csr_flag)
 
     def _load_config_file(self, path: Path):
         """Safely loads and parses a YAML file."""
@@ -98,6 +108,13 @@ class Config:
         optionset = self._resolve(cli_arg, 'OVPN_MANAGER_OPTIONSET', 'optionset')
         return optionset or 'default'
 
+    def _resolve_csr_flag(self, cli_arg):
+        """Resolves whether to generate the key locally and send a CSR, defaulting to False."""
+        csr = self._resolve(cli_arg, 'OVPN_MANAGER_CSR', 'csr')
+        if csr is not None:
+            return str(csr).lower() in ['true', '1', 't', 'y', 'yes']
+        return False
+
 class CallbackHandler(BaseHTTPRequestHandler):
     """
     A simple HTTP request handler that captures the 'token' query parameter,
@@ -119,14 +136,50 @@ class CallbackHandler(BaseHTTPRequestHandler):
             </html>
         """)
 
-        # Extract the token from the request path and store it globally.
-        if 'token=' in self.path:
-            token = self.path.split('token=')[1].split('&')[0]
-            RECEIVED_TOKEN.append(token)
+        # Extract the token (and any other parameters) from the request path and store them globally.
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        if 'token' in params:
+            RECEIVED_PARAMS.update(params)
+            RECEIVED_TOKEN.append(params['token'])
 
     def log_message(self, format, *args):
         return
 
+def generate_private_key(key_algorithm):
+    """Generates a private key for an algorithm named like 'rsa:4096', 'ec:P-256' or 'ed25519'."""
+    kind, _, param = (key_algorithm or 'ec:P-256').partition(':')
+    if kind == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=int(param or 4096))
+    if kind == 'ec':
+        curves = {'P-256': ec.SECP256R1, 'P-384': ec.SECP384R1}
+        if param not in curves:
+            raise click.ClickException(f"Unsupported EC curve '{param}' requested by the server.")
+        return ec.generate_private_key(curves[param]())
+    if kind == 'ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    raise click.ClickException(f"Unsupported key algorithm '{key_algorithm}' requested by the server.")
+
+def build_csr(private_key, subject):
+    """Builds a PEM-encoded CSR for the private key, with the subject as its Common Name."""
+    # Ed25519 signatures take no separate hash algorithm
+    algorithm = None if isinstance(private_key, ed25519.Ed25519PrivateKey) else hashes.SHA256()
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)])
+    ).sign(private_key, algorithm)
+    return csr.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+def add_private_key(profile, private_key):
+    """Puts the locally generated private key into the (key-less) profile from the server."""
+    key_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode('utf-8').strip()
+    key_block = f"<key>\n{key_pem}\n</key>"
+    if re.search(r"<key>\s*</key>", profile):
+        return re.sub(r"<key>\s*</key>", lambda _: key_block, profile, count=1)
+    return profile.rstrip('\n') + "\n" + key_block + "\n"
+
 def find_free_port():
     """Finds and returns an available TCP port on localhost."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -139,9 +192,10 @@ def find_free_port():
 @click.option('-o', '--output', help='Path to save the OVPN configuration file.')
 @click.option('-f', '--force', '--overwrite', 'overwrite', is_flag=True, default=False, help='Overwrite the output file if it already exists.')
 @click.option('--option', 'optionset', help='The OVPN optionset to use (e.g., UseTCP).')
-def get_config(server_url, output, overwrite, optionset):
+@click.option('--csr/--no-csr', 'csr', default=None, help='Generate the private key locally and only send a CSR to the server.')
+def get_config(server_url, output, overwrite, optionset, csr):
     try:
-        config = Config(server_url, output, overwrite, optionset)
+        config = Config(server_url, output, overwrite, optionset, csr_flag=csr)
     except Exception as e:
         raise click.ClickException(f"Failed to initialize configuration: {e}")
 
@@ -163,6 +217,8 @@ def get_config(server_url, output, overwrite, optionset):
     server_thread.start()
 
     login_url = f"{server_url}/login?cli_port={port}&optionset={config.optionset}"
+    if config.csr:
+        login_url += "&csr=1"
     click.echo("Your browser has been opened to complete authentication.")
     webbrowser.open(login_url)
 
@@ -179,20 +235,64 @@ def get_config(server_url, output, overwrite, optionset):
     token = RECEIVED_TOKEN[0]
     click.echo("Authentication successful. Token received.")
 
-    download_url = f"{config.server_url}/download?token={token}"
-    click.echo(f"Downloading configuration from {config.server_url}...")
-    try:
-        response = requests.get(download_url, timeout=30)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        raise click.ClickException(f"Failed to download file: {e}")
+    if config.csr:
+        content = request_signed_profile(config.server_url, token, RECEIVED_PARAMS)
+    else:
+        if RECEIVED_PARAMS.get('status') == 'pending':
+            wait_for_profile(config.server_url, token)
+        download_url = f"{config.server_url}/download?token={token}"
+        click.echo(f"Downloading configuration from {config.server_url}...")
+        try:
+            response = requests.get(download_url, timeout=30)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise click.ClickException(f"Failed to download file: {e}")
+        content = response.content
 
     try:
         with open(config.output_path, 'wb') as f:
-            f.write(response.content)
+            f.write(content)
         click.secho(f"Successfully saved configuration to {config.output_path}", fg="green")
     except IOError as e:
         raise click.ClickException(f"Failed to write to file {config.output_path}: {e}")
 
+def wait_for_profile(server_url, token, timeout_seconds=120, interval=1):
+    """Polls the server until a queued profile has been generated."""
+    click.echo("Waiting for the server to generate the configuration...")
+    start_time = time.time()
+    while True:
+        try:
+            response = requests.get(f"{server_url}/download/status/{token}", timeout=10)
+            status = response.json().get('status')
+        except (requests.RequestException, ValueError) as e:
+            raise click.ClickException(f"Failed to check the configuration status: {e}")
+        if status == 'ready':
+            return
+        if status != 'pending':
+            raise click.ClickException(f"The server could not generate the configuration (status: {status}).")
+        if time.time() - start_time > timeout_seconds:
+            raise click.ClickException("Timed out waiting for the configuration to be generated.")
+        time.sleep(interval)
+
+def request_signed_profile(server_url, token, params):
+    """Generates a key locally, has the server sign a CSR for it and returns the completed profile."""
+    if not params.get('sub'):
+        raise click.ClickException("The server did not return a subject for the CSR.")
+    click.echo(f"Generating a {params.get('key_algorithm', 'ec:P-256')} key locally...")
+    private_key = generate_private_key(params.get('key_algorithm'))
+
+    click.echo(f"Requesting a signed certificate from {server_url}...")
+    try:
+        response = requests.post(
+            f"{server_url}/sign",
+            json={"token": token, "csr": build_csr(private_key, params['sub'])},
+            timeout=30
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise click.ClickException(f"Failed to get the certificate signed: {e}")
+
+    return add_private_key(response.text, private_key).encode('utf-8')
+
 if __name__ == '__main__':
     get_config()
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""
+Compares the stored size and CPU cost of each PROFILE_COMPRESSION setting,
+for a profile of realistic size: an RSA-4096 device key, its certificate, the
+CA certificate and a tls-crypt-v2 client key, inline.
+
+Usage (from the repository root):
+    python dev/benchmark_compression.py [iterations]
+"""
+import os
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+from cryptography import x509
+from cryptography.fernet import Fernet
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.cert_utils import create_device_certificate
+from server.tlscrypt import pem_encode, wrap_client_key, SERVER_KEY_PEM_NAME
+from server.payload import encrypt_profile, decrypt_profile, zstandard
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+# A throwaway CA, the same shape as dev/generate_ca.py produces
+ca_key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u"benchmark-ca.localhost")])
+ca_cert = x509.CertificateBuilder().subject_name(ca_name).issuer_name(ca_name).public_key(
+    ca_key.public_key()
+).serial_number(x509.random_serial_number()).not_valid_before(
+    datetime.now(timezone.utc)
+).not_valid_after(
+    datetime.now(timezone.utc) + timedelta(days=1)
+).add_extension(
+    x509.BasicConstraints(ca=True, path_length=None), critical=True,
+).sign(ca_key, hashes.SHA256())
+
+device_key_pem, device_cert_pem, _, _ = create_device_certificate("benchmark.user", ca_cert, ca_key, key_algorithm="rsa:4096")
+tlscrypt_key = wrap_client_key(pem_encode(os.urandom(128), SERVER_KEY_PEM_NAME))
+profile = "\n".join([
+    "client", "dev tun", "proto udp", "remote vpn.example.org 1194", "nobind", "persist-key", "persist-tun",
+    "remote-cert-tls server", "verb 3",
+    "<ca>", ca_cert.public_bytes(serialization.Encoding.PEM).decode('utf-8'), "</ca>",
+    "<cert>", device_cert_pem.decode('utf-8'), "</cert>",
+    "<key>", device_key_pem.decode('utf-8'), "</key>",
+    "<tls-crypt-v2>", tlscrypt_key, "</tls-crypt-v2>",
+])
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode('utf-8'))
+app = Flask(__name__)
+settings = [("none", None), ("zlib", 1), ("zlib", 6), ("zlib", 9)]
+if zstandard is not None:
+    settings += [("zstd", 3), ("zstd", 19)]
+else:
+    print("zstandard is not installed, skipping zstd.")
+
+print(f"Profile is {len(profile.encode('utf-8'))} bytes; {iterations} iterations per setting.")
+print(f"{'setting':<10} {'stored B':>10} {'ratio':>7} {'store us':>10} {'load us':>10}")
+with app.app_context():
+    baseline = None
+    for compression, level in settings:
+        app.config.update({"PROFILE_COMPRESSION": compression, "PROFILE_COMPRESSION_LEVEL": level})
+        stored = encrypt_profile(profile)
+        assert decrypt_profile(stored).decode('utf-8') == profile
+        baseline = baseline or len(stored)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            encrypt_profile(profile)
+        store_us = (time.perf_counter() - start) * 1e6 / iterations
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decrypt_profile(stored)
+        load_us = (time.perf_counter() - start) * 1e6 / iterations
+
+        name = compression if level is None else f"{compression}:{level}"
+        print(f"{name:<10} {len(stored):>10} {len(stored) / baseline:>7.2f} {store_us:>10.1f} {load_us:>10.1f}")
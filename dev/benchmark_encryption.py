@@ -0,0 +1,41 @@
+"""
+Compares Fernet and AES-GCM encrypt and decrypt throughput for data the size
+of a stored profile, through the same key ring the server uses.
+
+Usage (from the repository root):
+    python dev/benchmark_encryption.py [iterations] [size in bytes]
+"""
+import os
+import sys
+import time
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.keyring import KeyRing
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+size = int(sys.argv[2]) if len(sys.argv) > 2 else 8 * 1024
+
+# Random data, as a compressed profile is; two keys, as during a rotation
+data = os.urandom(size)
+keys = [Fernet.generate_key().decode('utf-8'), Fernet.generate_key().decode('utf-8')]
+
+print(f"{iterations} iterations of {size} bytes")
+print(f"{'cipher':<8} {'stored B':>10} {'encrypt/s':>10} {'decrypt/s':>10} {'encrypt MB/s':>13} {'decrypt MB/s':>13}")
+for cipher in ("fernet", "aesgcm"):
+    ring = KeyRing(keys, cipher=cipher)
+    token = ring.encrypt(data)
+    assert ring.decrypt(token) == data
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        ring.encrypt(data)
+    encrypt_s = (time.perf_counter() - start) / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        ring.decrypt(token)
+    decrypt_s = (time.perf_counter() - start) / iterations
+
+    print(f"{cipher:<8} {len(token):>10} {1 / encrypt_s:>10.0f} {1 / decrypt_s:>10.0f} "
+          f"{size / encrypt_s / 1e6:>13.1f} {size / decrypt_s / 1e6:>13.1f}")
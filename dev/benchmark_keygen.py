@@ -0,0 +1,48 @@
+"""
+Compares device certificate issuance throughput for each supported key algorithm.
+
+Usage (from the repository root):
+    python dev/benchmark_keygen.py [iterations]
+"""
+import os
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.cert_utils import generate_device_key, create_device_certificate
+
+ALGORITHMS = ["rsa:4096", "rsa:3072", "rsa:2048", "ec:P-384", "ec:P-256", "ed25519"]
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+# A throwaway CA, the same shape as dev/generate_ca.py produces
+ca_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u"benchmark-ca.localhost")])
+ca_cert = x509.CertificateBuilder().subject_name(ca_name).issuer_name(ca_name).public_key(
+    ca_key.public_key()
+).serial_number(x509.random_serial_number()).not_valid_before(
+    datetime.now(timezone.utc)
+).not_valid_after(
+    datetime.now(timezone.utc) + timedelta(days=1)
+).add_extension(
+    x509.BasicConstraints(ca=True, path_length=None), critical=True,
+).sign(ca_key, hashes.SHA256())
+
+print(f"Issuing {iterations} certificates per algorithm...")
+print(f"{'algorithm':<10} {'keygen ms':>10} {'issue ms':>10} {'issues/s':>10} {'key PEM B':>10}")
+for key_algorithm in ALGORITHMS:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        generate_device_key(key_algorithm)
+    keygen_ms = (time.perf_counter() - start) * 1000 / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        device_key_pem, _, _, _ = create_device_certificate("benchmark.user", ca_cert, ca_key, key_algorithm=key_algorithm)
+    issue_seconds = (time.perf_counter() - start) / iterations
+
+    print(f"{key_algorithm:<10} {keygen_ms:>10.2f} {issue_seconds * 1000:>10.2f} {1 / issue_seconds:>10.1f} {len(device_key_pem):>10}")
@@ -46,4 +46,21 @@ Selector labels
 {{- define "ovpn-manager.selectorLabels" -}}
 app.kubernetes.io/name: {{ include "ovpn-manager.name" . }}
 app.kubernetes.io/instance: {{ .Release.Name }}
-{{- end }}
\ No newline at end of file
+{{- end }}
+{{/*
+Database connection pool settings, for every container that connects to the database
+*/}}
+{{- define "ovpn-manager.databasePoolEnv" -}}
+- name: DATABASE_POOL_SIZE
+  value: {{ .Values.database.pool.size | quote }}
+- name: DATABASE_MAX_OVERFLOW
+  value: {{ .Values.database.pool.maxOverflow | quote }}
+- name: DATABASE_POOL_PRE_PING
+  value: {{ .Values.database.pool.prePing | quote }}
+- name: DATABASE_POOL_RECYCLE
+  value: {{ .Values.database.pool.recycle | quote }}
+- name: DATABASE_STATEMENT_TIMEOUT
+  value: {{ .Values.database.pool.statementTimeout | quote }}
+- name: DATABASE_PGBOUNCER
+  value: {{ .Values.database.pool.pgbouncer | quote }}
+{{- end }}
@@ -0,0 +1,92 @@
+"""Move encrypted profiles out of download_tokens into download_payloads
+
+Revision ID: 9d3e5b71c2a8
+Revises: 4f0c7d2e9a15
+Create Date: 2026-10-17 15:40:03.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3e5b71c2a8'
+down_revision = '4f0c7d2e9a15'
+branch_labels = None
+depends_on = None
+
+# Rows are copied this many at a time, so a large table is never held in memory
+BATCH_SIZE = 500
+
+download_tokens = sa.table(
+    'download_tokens',
+    sa.column('id', sa.Integer),
+    sa.column('token', sa.String),
+    sa.column('ovpn_content', sa.LargeBinary),
+    sa.column('created_at', sa.DateTime(timezone=True)),
+)
+download_payloads = sa.table(
+    'download_payloads',
+    sa.column('id', sa.Integer),
+    sa.column('token', sa.String),
+    sa.column('payload', sa.LargeBinary),
+    sa.column('created_at', sa.DateTime(timezone=True)),
+)
+
+
+def upgrade():
+    op.create_table('download_payloads',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('token', sa.String(length=36), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('download_payloads', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_download_payloads_token'), ['token'], unique=True)
+
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(download_tokens.c.id, download_tokens.c.token, download_tokens.c.ovpn_content, download_tokens.c.created_at)
+            .where(download_tokens.c.id > last_id, download_tokens.c.ovpn_content.isnot(None))
+            .order_by(download_tokens.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        connection.execute(download_payloads.insert(), [
+            {"token": row.token, "payload": row.ovpn_content, "created_at": row.created_at} for row in rows
+        ])
+        last_id = rows[-1].id
+
+    with op.batch_alter_table('download_tokens', schema=None) as batch_op:
+        batch_op.drop_column('ovpn_content')
+
+
+def downgrade():
+    with op.batch_alter_table('download_tokens', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('ovpn_content', sa.LargeBinary(), nullable=True))
+
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(download_payloads.c.id, download_payloads.c.token, download_payloads.c.payload)
+            .where(download_payloads.c.id > last_id)
+            .order_by(download_payloads.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        for row in rows:
+            connection.execute(
+                download_tokens.update().where(download_tokens.c.token == row.token).values(ovpn_content=row.payload)
+            )
+        last_id = rows[-1].id
+
+    with op.batch_alter_table('download_payloads', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_download_payloads_token'))
+
+    op.drop_table('download_payloads')
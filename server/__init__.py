@@ -9,12 +9,26 @@ from .main_routes import main_bp
 from .auth import auth_bp
 from .admin import admin_bp
 from .tasks import tasks_bp
-from .utils import load_ovpn_templates, load_ovpn_optionsets
+from .utils import load_ovpn_templates, load_ovpn_optionsets, init_ovpn_template_cache
+from .keypool import init_keypool
+from .issuance import init_issuance, IssuanceBusy
+from .payload import init_payload
+from .payload_store import init_payload_store
+from .speculation import init_speculation
+from .reload import init_reload
+from .sweeper import init_sweeper
+from .cert_utils import normalize_key_algorithm, DEFAULT_KEY_ALGORITHM
+from .commands import keypool_cli, issuance_worker, encryption_cli, tokens_cli
+from .logging import init_logging
+from .database import init_database
 
 def create_app():
     app = Flask(__name__, instance_relative_config=True)
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
     
+    # --- Logging (LOG_LEVEL, default INFO) ---
+    init_logging(app)
+
     # --- Load Configuration ---
     app.secret_key = os.getenv("FLASK_SECRET_KEY")
     app.config["OIDC_ADMIN_GROUP"] = os.getenv("OIDC_ADMIN_GROUP", 'ovpn-manager-admins')
@@ -24,7 +38,8 @@ def create_app():
     if "sqlite" in db_url:
         os.makedirs(app.instance_path, exist_ok=True)
         
-    app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+    # --- Connection pool, pre-ping, recycle and statement timeout (or PgBouncer mode) ---
+    init_database(app, db_url)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     
     # --- Session Configuration ---
@@ -44,6 +59,34 @@ def create_app():
     if not app.config["OVPNS_OPTIONSETS"]:
         raise RuntimeError(f"No OptionSets found in '{app.config['OVPNS_OPTIONSETS_PATH']}'.")
 
+    # --- Compile every template and optionset combination once per worker ---
+    init_ovpn_template_cache(app)
+
+    # --- Device key algorithm (overridable per template or optionset) ---
+    app.config["DEVICE_KEY_ALGORITHM"] = normalize_key_algorithm(os.getenv("DEVICE_KEY_ALGORITHM", DEFAULT_KEY_ALGORITHM))
+
+    # --- Start the per-worker device key pools (disabled when KEYPOOL_SIZE=0) ---
+    init_keypool(app)
+    app.config["TLSCRYPT_V2_POOL_SIZE"] = int(os.getenv("TLSCRYPT_V2_POOL_SIZE", "0"))
+
+    # --- Stored profile compression (PROFILE_COMPRESSION, off by default) ---
+    init_payload(app)
+
+    # --- Where profiles wait to be downloaded (PAYLOAD_STORE, default table) ---
+    init_payload_store(app)
+
+    # --- Issuance worker processes (inline when ISSUANCE_PROCESSES=0) ---
+    init_issuance(app)
+
+    # --- Speculative key generation at /login (off unless SPECULATIVE_KEYGEN) ---
+    init_speculation(app)
+
+    # --- Reload templates, optionsets and CA when they change (off unless CONFIG_RELOAD) ---
+    init_reload(app)
+
+    # --- Sweep uncollected profiles once their download window closes (off unless PAYLOAD_SWEEP_INTERVAL) ---
+    init_sweeper(app)
+
     # --- Initialize Extensions (in the correct order) ---
     db.init_app(app)
     migrate.init_app(app, db)
@@ -70,6 +113,12 @@ def create_app():
     app.register_blueprint(admin_bp, url_prefix='/admin')
     app.register_blueprint(tasks_bp, url_prefix='/tasks')
 
+    # --- Register CLI Commands ---
+    app.cli.add_command(keypool_cli)
+    app.cli.add_command(issuance_worker)
+    app.cli.add_command(encryption_cli)
+    app.cli.add_command(tokens_cli)
+
     # --- Register Custom Error Handlers ---
     @app.errorhandler(403)
     def forbidden(e):
@@ -83,4 +132,8 @@ def create_app():
     def internal_server_error(e):
         return render_template('500.html'), 500
 
+    @app.errorhandler(IssuanceBusy)
+    def issuance_busy(e):
+        return render_template('503.html', retry_after=e.retry_after), 503, {"Retry-After": str(e.retry_after)}
+
     return app
\ No newline at end of file
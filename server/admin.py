@@ -3,6 +3,7 @@ from functools import wraps
 import os
 from .extensions import db, limiter
 from .models import DownloadToken
+from .utils import explain_ovpn_template
 from datetime import datetime, timedelta, timezone
 
 admin_bp = Blueprint('admin', __name__, template_folder='templates')
@@ -40,14 +41,13 @@ def index():
     """Renders the admin index page."""
     return render_template('admin/index.html', session=session, config=current_app.config)
 
-@admin_bp.route('/status')
-@limiter.limit("60/minute")
-@admin_required
-def status():
+def status_query(filter_by: str, time_limit: str):
+    """
+    Builds the status page query. Each filter is served by an index on
+    download_tokens: created_at, cert_expiry, or the partial index of
+    downloadable rows.
+    """
     query = DownloadToken.query
-    filter_by = request.args.get('filter_by', 'all_records')
-    time_limit = request.args.get('time_limit', '1d')
-
     if filter_by == 'downloadable':
         query = query.filter(DownloadToken.downloadable == True, DownloadToken.collected == False)
     elif filter_by == 'collected':
@@ -64,8 +64,15 @@ def status():
         query = query.filter(DownloadToken.created_at >= now - time_filter_map[time_limit])
     elif time_limit == 'expiring':
         query = query.filter(DownloadToken.cert_expiry.between(now, now + timedelta(days=30)))
-    
-    tokens = query.order_by(DownloadToken.created_at.desc()).limit(500).all()
+    return query.order_by(DownloadToken.created_at.desc()).limit(500)
+
+@admin_bp.route('/status')
+@limiter.limit("60/minute")
+@admin_required
+def status():
+    filter_by = request.args.get('filter_by', 'all_records')
+    time_limit = request.args.get('time_limit', '1d')
+    tokens = status_query(filter_by, time_limit).all()
     active_filters = {'filter_by': filter_by, 'time_limit': time_limit}
     
     return render_template(
@@ -75,3 +82,15 @@ def status():
         session=session,
         config=current_app.config
     )
+
+@admin_bp.route('/explain')
+@limiter.limit("60/minute")
+@admin_required
+def explain():
+    """
+    Shows which template and optionset a set of groups resolves to, e.g.
+    /admin/explain?group=engineering&group=staff&optionset=UseTCP
+    """
+    user_groups = [group for value in request.args.getlist('group') for group in value.split(',') if group]
+    optionset_name = request.args.get('optionset', 'default')
+    return explain_ovpn_template(user_groups, optionset_name), 200
@@ -1,11 +1,16 @@
 import uuid
+import json
 import user_agents
-from flask import Blueprint, session, redirect, url_for, request, abort, current_app
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+from flask import Blueprint, session, redirect, url_for, request, abort, current_app, Response
+from cryptography.fernet import InvalidToken
 from .extensions import db, oauth, limiter
-from .models import DownloadToken
-from .cert_utils import create_device_certificate
-from .utils import get_fernet, get_ca_certs, render_ovpn_template, normalize_userinfo, get_tlscrypt_key
-from cryptography.hazmat.primitives import serialization
+from .models import DownloadToken, DOWNLOAD_WINDOW
+from .payload_store import get_payload_store
+from .issuance import issue_profile, sign_profile, IssuanceBusy
+from .speculation import start_speculation
+from .utils import get_fernet, normalize_userinfo, select_ovpn_template, resolve_key_algorithm
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -22,6 +27,21 @@ def login():
             session['cli_port'] = cli_port
         except (ValueError, TypeError):
             abort(400, "Invalid 'cli_port' provided.")
+
+    # CSR issuance: the CLI client keeps its own private key and only asks us to sign
+    if request.args.get('csr', '').lower() in ['1', 'true', 'yes']:
+        if not cli_port:
+            abort(400, "CSR issuance is only available to the CLI client.")
+        session['issuance'] = 'csr'
+    else:
+        session.pop('issuance', None)
+
+    # Generate the device key while the user is at the IdP
+    session.pop('speculation', None)
+    if session.get('issuance') != 'csr' and 'next_url' not in session:
+        speculation_id = start_speculation(chosen_optionset)
+        if speculation_id:
+            session['speculation'] = speculation_id
     
     redirect_uri = url_for('auth.auth', _external=True)
     return oauth.oidc.authorize_redirect(redirect_uri)
@@ -32,7 +52,7 @@ def auth():
         token = oauth.oidc.authorize_access_token()
         user_info = normalize_userinfo(token.get('userinfo'))
     except Exception as e:
-        current_app.logger.error(f"Authentication error: {e}")
+        current_app.logger.error("Authentication error: %s", e)
         return redirect(url_for('main.error_page', message="Authentication failed."))
 
     if not user_info or not user_info.get('sub'):
@@ -45,64 +65,162 @@ def auth():
     if next_url:
         return redirect(next_url)
 
+    # CLI clients using a CSR are handed a signing token instead of a generated profile
+    if session.pop('issuance', None) == 'csr':
+        return start_csr_issuance(user_info)
+
     # If no 'next_url', proceed with the standard OVPN generation flow
     try:
-        fernet = get_fernet()
-        ca_cert, ca_key = get_ca_certs()
-        device_key_pem, device_cert_pem, common_name, cert_expiry = create_device_certificate(session['user']['sub'], ca_cert, ca_key)
-        ca_cert_pem = ca_cert.public_bytes(encoding=serialization.Encoding.PEM)
-        tlscrypt_type, tlscrypt_key = get_tlscrypt_key(device_cert_pem.decode('utf-8'))
-
         optionset_name = session.pop('optionset', 'default')
-        optionsets = current_app.config.get("OVPNS_OPTIONSETS", {})
-        optionset_content = optionsets.get(optionset_name, optionsets.get('default', ''))
-
-        render_context = {
-            "userinfo": user_info,
-            "device_key_pem": device_key_pem.decode('utf-8'),
-            "device_cert_pem": device_cert_pem.decode('utf-8'),
-            "ca_cert_pem": ca_cert_pem.decode('utf-8'),
-            "common_name": common_name,
-            "optionset": optionset_content,
-            "optionset_name": optionset_name,
-            "tlscrypt_key": tlscrypt_key,
-            "tlscrypt_type": tlscrypt_type
-        }
-
-        user_groups = user_info.get('groups', [])
-        ovpn_content = render_ovpn_template(user_groups, render_context)
-
-        encrypted_ovpn_content = fernet.encrypt(ovpn_content.encode('utf-8'))
-
-        user_agent_string = request.headers.get('User-Agent', '')
-        user_agent_parsed = user_agents.parse(user_agent_string)
-        detected_os = user_agent_parsed.os.family
-
         download_token = str(uuid.uuid4())
-        new_token = DownloadToken(
-            token=download_token, # type: ignore
-            ovpn_content=encrypted_ovpn_content, # type: ignore
-            user=session['user']['sub'], # type: ignore
-            cn=common_name, # type: ignore
-            requester_ip=request.remote_addr, # type: ignore
-            requester_user_agent=request.headers.get('User-Agent'), # type: ignore
-            cert_expiry=cert_expiry, # type: ignore
-            user_agent_string=user_agent_string, # type: ignore
-            detected_os=detected_os, # type: ignore
-            optionset_used=optionset_name, # type: ignore
-            downloadable=True, # type: ignore
-            collected=False # type: ignore
-        )
+
+        if current_app.config.get("ISSUANCE_ASYNC"):
+            # Queue the issuance for `flask issuance-worker`; the landing page
+            # and the CLI client poll /download/status until it is ready.
+            new_token = new_download_token(
+                token=download_token,
+                user=session['user']['sub'],
+                optionset_used=optionset_name,
+                status='pending',
+                issuance_context=encrypt_issuance_context(user_info, optionset_name),
+            )
+        else:
+            issued = issue_profile(user_info, optionset_name, session.pop('speculation', None))
+            get_payload_store().put(download_token, issued['encrypted_ovpn_content'])
+            new_token = new_download_token(
+                token=download_token,
+                user=session['user']['sub'],
+                cn=issued['common_name'],
+                cert_expiry=issued['cert_expiry'],
+                optionset_used=optionset_name,
+            )
         db.session.add(new_token)
         db.session.commit()
 
         cli_port = session.pop('cli_port', None)
         if cli_port:
-            return redirect(f"http://localhost:{cli_port}/callback?token={download_token}")
+            query = urlencode({"token": download_token, "status": new_token.status})
+            return redirect(f"http://localhost:{cli_port}/callback?{query}")
         else:
             landing_url = url_for('main.download_landing', token=download_token)
             return redirect(landing_url)
+    except IssuanceBusy:
+        current_app.logger.warning("Issuance at capacity, shedding /auth request.")
+        raise
     except Exception as e:
         db.session.rollback()
-        current_app.logger.error(f"Auth/Cert generation error: {e}")
+        current_app.logger.error("Auth/Cert generation error: %s", e)
         return redirect(url_for('main.error_page', message="Could not generate configuration file."))
+
+
+def new_download_token(**fields) -> DownloadToken:
+    """Creates a DownloadToken, recording who requested it from the current request."""
+    user_agent_string = request.headers.get('User-Agent', '')
+    user_agent_parsed = user_agents.parse(user_agent_string)
+
+    return DownloadToken(
+        requester_ip=request.remote_addr, # type: ignore
+        requester_user_agent=request.headers.get('User-Agent'), # type: ignore
+        user_agent_string=user_agent_string, # type: ignore
+        detected_os=user_agent_parsed.os.family, # type: ignore
+        downloadable=True, # type: ignore
+        collected=False, # type: ignore
+        **fields
+    )
+
+def encrypt_issuance_context(user_info, optionset_name) -> bytes:
+    """Encrypts what is needed to finish an issuance outside this request."""
+    issuance_context = json.dumps({"userinfo": user_info, "optionset_name": optionset_name})
+    return get_fernet().encrypt(issuance_context.encode('utf-8'))
+
+def start_csr_issuance(user_info):
+    """
+    Records a signing token for a CLI client which generates its own key, and
+    sends the client the token, the subject its CSR must use and the key
+    algorithm it must generate.
+    """
+    try:
+        optionset_name = session.pop('optionset', 'default')
+        key_algorithm = resolve_key_algorithm(select_ovpn_template(user_info.get('groups', [])), optionset_name)
+        signing_token = str(uuid.uuid4())
+        new_token = new_download_token(
+            token=signing_token,
+            user=user_info['sub'],
+            optionset_used=optionset_name,
+            status='awaiting_csr',
+            issuance_context=encrypt_issuance_context(user_info, optionset_name),
+        )
+        db.session.add(new_token)
+        db.session.commit()
+
+        cli_port = session.pop('cli_port')
+        query = urlencode({"token": signing_token, "sub": user_info['sub'], "key_algorithm": key_algorithm})
+        return redirect(f"http://localhost:{cli_port}/callback?{query}")
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error("CSR issuance setup error: %s", e)
+        return redirect(url_for('main.error_page', message="Could not start certificate signing."))
+
+def signing_refusal(token_str: str) -> tuple[int, str]:
+    """Works out why a signing token could not be claimed. Returns the status code and message."""
+    token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
+    if token_record is None or token_record.status != 'awaiting_csr':
+        return 403, "Invalid signing token."
+    if token_record.is_download_window_expired():
+        if token_record.downloadable:
+            token_record.downloadable = False
+            token_record.issuance_context = None
+            db.session.commit()
+        return 403, "Signing token has expired."
+    return 403, "This signing token has already been used."
+
+@auth_bp.route('/sign', methods=['POST'])
+@limiter.limit("20/minute")
+def sign():
+    """
+    Signs a CSR from the CLI client and returns the rendered profile without a
+    private key. Expects JSON: {"token": <signing token>, "csr": <PEM CSR>}.
+    """
+    payload = request.get_json(silent=True) or {}
+    token_str = payload.get('token')
+    csr_pem = payload.get('csr')
+    if not token_str or not csr_pem:
+        abort(400, "A signing token and a CSR are required.")
+
+    # Claim the token with one conditional UPDATE, as /download does, so that
+    # of any concurrent requests only one signs. The claim is rolled back if
+    # the CSR is refused, leaving the token for a corrected request.
+    claimed = db.session.query(DownloadToken).filter(
+        DownloadToken.token == token_str,
+        DownloadToken.status == 'awaiting_csr',
+        DownloadToken.collected == False,
+        DownloadToken.downloadable == True,
+        DownloadToken.created_at > datetime.now(timezone.utc) - DOWNLOAD_WINDOW,
+    ).update({"status": "ready", "collected": True, "downloadable": False}, synchronize_session=False)
+    if claimed != 1:
+        db.session.rollback()
+        abort(*signing_refusal(token_str))
+
+    token_record = db.session.query(DownloadToken).filter_by(token=token_str).one()
+    try:
+        context = json.loads(get_fernet().decrypt(token_record.issuance_context))
+    except (InvalidToken, TypeError):
+        db.session.rollback()
+        abort(500, "Failed to decrypt issuance data.")
+
+    try:
+        issued = sign_profile(context['userinfo'], context['optionset_name'], token_record.user, csr_pem.encode('utf-8'))
+    except ValueError as e:
+        db.session.rollback()
+        abort(400, str(e))
+
+    token_record.cn = issued['common_name']
+    token_record.cert_expiry = issued['cert_expiry']
+    token_record.issuance_context = None
+    db.session.commit()
+
+    return Response(
+        issued['ovpn_content'],
+        mimetype="application/x-openvpn-profile",
+        headers={"Content-disposition": "attachment; filename=config.ovpn"}
+    )
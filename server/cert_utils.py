@@ -4,7 +4,7 @@ from datetime import timezone
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 
 def load_ca(ca_cert_path, ca_key_path, password=None):
     """Loads the CA certificate and private key from file."""
@@ -17,38 +17,68 @@ def load_ca(ca_cert_path, ca_key_path, password=None):
         )
     return ca_cert, ca_key
 
-def create_device_certificate(username, ca_cert, ca_key):
-    """
-    Generates a new private key and a device certificate signed by the CA.
-
-    Args:
-        username (str): The username to embed in the certificate's Common Name.
-        ca_cert (x509.Certificate): The CA's certificate object.
-        ca_key (rsa.RSAPrivateKey): The CA's private key object.
+# Device key algorithms are written as "rsa:<bits>", "ec:<curve>" or "ed25519".
+DEFAULT_KEY_ALGORITHM = "rsa:4096"
+RSA_KEY_SIZES = (2048, 3072, 4096)
+EC_CURVES = {
+    "P-256": ec.SECP256R1,
+    "P-384": ec.SECP384R1,
+}
 
-    Returns:
-        tuple: A tuple containing the PEM-encoded private key and the
-               PEM-encoded signed certificate.
+def normalize_key_algorithm(key_algorithm):
     """
-    not_valid_before = datetime.now(timezone.utc)
+    Validates a device key algorithm and returns it in its canonical form,
+    e.g. "EC:p-256" becomes "ec:P-256" and a bare "rsa" becomes "rsa:4096".
+    """
+    kind, _, param = str(key_algorithm).strip().partition(':')
+    kind = kind.lower()
+    if kind == 'rsa':
+        size = int(param) if param.isdigit() else (4096 if not param else 0)
+        if size in RSA_KEY_SIZES:
+            return f"rsa:{size}"
+    elif kind in ('ec', 'ecdsa'):
+        curve = (param or "P-256").upper()
+        if not curve.startswith('P-'):
+            curve = f"P-{curve.lstrip('P')}"
+        if curve in EC_CURVES:
+            return f"ec:{curve}"
+    elif kind == 'ed25519' and not param:
+        return "ed25519"
+    raise RuntimeError(f"Unsupported device key algorithm '{key_algorithm}'.")
 
-    # 1. Generate a new private key for the device
-    device_key = rsa.generate_private_key(
+def generate_device_key(key_algorithm=DEFAULT_KEY_ALGORITHM):
+    """Generates a new private key for a device certificate using the given algorithm."""
+    kind, _, param = normalize_key_algorithm(key_algorithm).partition(':')
+    if kind == 'ec':
+        return ec.generate_private_key(EC_CURVES[param]())
+    if kind == 'ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    return rsa.generate_private_key(
         public_exponent=65537,
-        key_size=4096,
+        key_size=int(param),
     )
 
-    # 2. Create a subject for the new certificate
-    common_name = f"{username}-{not_valid_before.timestamp()}"
-    subject = x509.Name([
+def device_subject_attributes():
+    """The device certificate subject attributes set by the X509_* environment variables, i.e. all but the Common Name."""
+    return (
         x509.NameAttribute(NameOID.COUNTRY_NAME, os.getenv("X509_C", "GB")),
         x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, os.getenv("X509_ST", "England")),
         x509.NameAttribute(NameOID.LOCALITY_NAME, os.getenv("X509_L", "London")),
         x509.NameAttribute(NameOID.ORGANIZATION_NAME, os.getenv("X509_O", "OVPN Manager")),
+    )
+
+def _sign_device_public_key(public_key, username, ca_cert, ca_key, subject_attributes=None):
+    """Builds a device certificate for the given public key and signs it with the CA."""
+    not_valid_before = datetime.now(timezone.utc)
+
+    # Create a subject for the new certificate
+    common_name = f"{username}-{not_valid_before.timestamp()}"
+    subject = x509.Name([
+        *(subject_attributes or device_subject_attributes()),
         x509.NameAttribute(NameOID.COMMON_NAME, common_name),
     ])
 
-    # 3. Build the Certificate Signing Request (CSR)
+    # Build the certificate
     not_valid_after = not_valid_before + timedelta(days=365) # Certificate valid for 1 year
     
     builder = x509.CertificateBuilder().subject_name(
@@ -56,7 +86,7 @@ def create_device_certificate(username, ca_cert, ca_key):
     ).issuer_name(
         ca_cert.subject
     ).public_key(
-        device_key.public_key()
+        public_key
     ).serial_number(
         x509.random_serial_number()
     ).not_valid_before(
@@ -67,8 +97,33 @@ def create_device_certificate(username, ca_cert, ca_key):
         x509.BasicConstraints(ca=False, path_length=None), critical=True,
     )
 
-    # 4. Sign the certificate with the CA's private key
-    device_cert = builder.sign(ca_key, hashes.SHA256())
+    # Sign the certificate with the CA's private key
+    return builder.sign(ca_key, hashes.SHA256()), common_name, not_valid_after
+
+def create_device_certificate(username, ca_cert, ca_key, device_key=None, key_algorithm=DEFAULT_KEY_ALGORITHM, subject_attributes=None):
+    """
+    Generates a new private key and a device certificate signed by the CA.
+
+    Args:
+        username (str): The username to embed in the certificate's Common Name.
+        ca_cert (x509.Certificate): The CA's certificate object.
+        ca_key (rsa.RSAPrivateKey): The CA's private key object.
+        device_key (optional): A pre-generated private key to use instead of
+               generating a new one (e.g. one taken from the key pool).
+        key_algorithm (str): The algorithm used when a new key has to be generated.
+        subject_attributes (optional): Precomputed device_subject_attributes(),
+               to save reading them from the environment again.
+
+    Returns:
+        tuple: A tuple containing the PEM-encoded private key and the
+               PEM-encoded signed certificate.
+    """
+    # 1. Generate a new private key for the device, unless one was supplied
+    if device_key is None:
+        device_key = generate_device_key(key_algorithm)
+
+    # 2-4. Build and sign a certificate for the device's public key
+    device_cert, common_name, not_valid_after = _sign_device_public_key(device_key.public_key(), username, ca_cert, ca_key, subject_attributes)
 
     # 5. Serialize key and cert to PEM format
     pem_device_key = device_key.private_bytes(
@@ -79,4 +134,54 @@ def create_device_certificate(username, ca_cert, ca_key):
 
     pem_device_cert = device_cert.public_bytes(serialization.Encoding.PEM)
 
-    return pem_device_key, pem_device_cert, common_name, not_valid_after
\ No newline at end of file
+    return pem_device_key, pem_device_cert, common_name, not_valid_after
+
+def key_algorithm_of(public_key):
+    """Describes a public key in the same "rsa:4096" / "ec:P-256" / "ed25519" form as DEVICE_KEY_ALGORITHM."""
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return f"rsa:{public_key.key_size}"
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        for curve_name, curve in EC_CURVES.items():
+            if isinstance(public_key.curve, curve):
+                return f"ec:{curve_name}"
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return "ed25519"
+    raise ValueError(f"Unsupported device public key type '{type(public_key).__name__}'.")
+
+def sign_device_csr(csr_pem, username, ca_cert, ca_key, key_algorithm=None, subject_attributes=None):
+    """
+    Signs a client-generated Certificate Signing Request, so the device's private
+    key never leaves the client.
+
+    The CSR must be correctly self-signed and its Common Name must be the
+    username. Only its public key is used: the certificate subject and validity
+    are set by the server exactly as for create_device_certificate.
+
+    Args:
+        csr_pem (bytes): The PEM-encoded CSR.
+        username (str): The authenticated user the CSR must be for.
+        ca_cert (x509.Certificate): The CA's certificate object.
+        ca_key (rsa.RSAPrivateKey): The CA's private key object.
+        key_algorithm (str, optional): If set, the CSR's key must use this algorithm.
+        subject_attributes (optional): Precomputed device_subject_attributes().
+
+    Returns:
+        tuple: The PEM-encoded signed certificate, the Common Name and the expiry.
+    """
+    try:
+        csr = x509.load_pem_x509_csr(csr_pem)
+    except ValueError:
+        raise ValueError("The CSR could not be parsed.")
+    if not csr.is_signature_valid:
+        raise ValueError("The CSR signature is not valid.")
+
+    csr_common_names = csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    if len(csr_common_names) != 1 or csr_common_names[0].value != username:
+        raise ValueError("The CSR subject does not match the authenticated user.")
+
+    public_key = csr.public_key()
+    if key_algorithm and key_algorithm_of(public_key) != normalize_key_algorithm(key_algorithm):
+        raise ValueError(f"The CSR key must use {normalize_key_algorithm(key_algorithm)}.")
+
+    device_cert, common_name, not_valid_after = _sign_device_public_key(public_key, username, ca_cert, ca_key, subject_attributes)
+    return device_cert.public_bytes(serialization.Encoding.PEM), common_name, not_valid_after
\ No newline at end of file
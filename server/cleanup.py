@@ -0,0 +1,74 @@
+import os
+import time
+from datetime import datetime, timezone, timedelta
+from .extensions import db
+from .models import DownloadToken
+from .payload_store import get_payload_store
+from .partitions import is_partitioned, maintain_partitions, drop_default_partition_rows
+
+def cleanup_threshold(lifetime_hours: int | None = None) -> datetime:
+    """Token records created before this time are due for deletion (TOKEN_LIFETIME_HOURS, default 24)."""
+    if lifetime_hours is None:
+        lifetime_hours = int(os.getenv("TOKEN_LIFETIME_HOURS", "24"))
+    return datetime.now(timezone.utc) - timedelta(hours=lifetime_hours)
+
+def cleanup_tokens(threshold: datetime, batch_size: int = 1000, time_budget: float = 30.0, after: datetime | None = None) -> dict:
+    """
+    Deletes token records created before `threshold`, oldest first, in
+    batches of `batch_size` rows with a commit after each, so no single
+    transaction holds locks on (or writes WAL for) more than one batch. Stops
+    starting new batches once `time_budget` seconds have passed (0 for no
+    limit); the rest are left for the next run.
+
+    Each batch starts from the created_at of the last row deleted (the
+    cursor), so it does not walk back over index entries of rows that were
+    just deleted. A run can be resumed from a returned cursor with `after`.
+    Returns the number of rows deleted, the cursor, whether the run finished,
+    and the elapsed time and rate.
+
+    When download_tokens is partitioned (see server/partitions.py), whole
+    partitions past the threshold are dropped instead, and future partitions
+    are created.
+    """
+    started = time.monotonic()
+    if is_partitioned():
+        maintained = maintain_partitions(threshold)
+        deleted = maintained["rows"] + drop_default_partition_rows(threshold)
+        result = {"deleted": deleted, "cursor": None, "finished": True,
+                  "partitions_created": maintained["created"], "partitions_dropped": maintained["dropped"]}
+    else:
+        result = _delete_in_batches(threshold, batch_size, time_budget, after, started)
+
+    # Payloads are not tied to their token by a foreign key, so they are cleared separately
+    get_payload_store().purge(threshold, batch_size)
+    db.session.commit()
+
+    result["elapsed"] = time.monotonic() - started
+    result["rate"] = result["deleted"] / result["elapsed"] if result["elapsed"] else 0.0
+    return result
+
+def _delete_in_batches(threshold: datetime, batch_size: int, time_budget: float, after: datetime | None, started: float) -> dict:
+    result = {"deleted": 0, "cursor": after, "finished": False}
+    while True:
+        query = db.session.query(DownloadToken.id, DownloadToken.created_at).filter(DownloadToken.created_at < threshold)
+        if result["cursor"] is not None:
+            # Every row before the cursor has been deleted; rows sharing its created_at may not have been
+            query = query.filter(DownloadToken.created_at >= result["cursor"])
+        rows = query.order_by(DownloadToken.created_at, DownloadToken.id).limit(batch_size).all()
+        if not rows:
+            result["finished"] = True
+            break
+
+        db.session.query(DownloadToken).filter(
+            DownloadToken.id.in_([row_id for row_id, _ in rows])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        result["deleted"] += len(rows)
+        result["cursor"] = rows[-1][1]
+
+        if len(rows) < batch_size:
+            result["finished"] = True
+            break
+        if time_budget and time.monotonic() - started >= time_budget:
+            break
+    return result
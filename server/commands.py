@@ -0,0 +1,107 @@
+import os
+import time
+import click
+from datetime import datetime
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from .cert_utils import normalize_key_algorithm
+from .keypool import fill_pregenerated_keys, database_pool_stats
+from .issuance import run_issuance_worker
+from .utils import configured_key_algorithms, get_fernet
+from .keyring import reencrypt_all
+from .cleanup import cleanup_threshold, cleanup_tokens
+from .partitions import partition_table, PARTITION_INTERVALS
+from .sweeper import sweep_expired_payloads
+
+keypool_cli = AppGroup('keypool', help='Manage the shared pool of pre-generated device keys.')
+
+@keypool_cli.command('fill')
+@click.option('--target', type=int, default=lambda: int(os.getenv("KEYPOOL_DATABASE_TARGET", "50")), show_default="KEYPOOL_DATABASE_TARGET or 50", help='Number of unclaimed keys to keep in the pool.')
+@click.option('--batch-size', type=int, default=10, show_default=True, help='Number of keys to insert per transaction.')
+@click.option('--workers', type=int, default=1, show_default=True, help='Number of keys to generate in parallel.')
+@click.option('--algorithm', 'key_algorithms', multiple=True, help='Key algorithm to fill (repeatable). Defaults to every algorithm the configuration uses.')
+@click.option('--loop', is_flag=True, default=False, help='Keep the pool topped up until interrupted.')
+@click.option('--interval', type=float, default=5.0, show_default=True, help='Seconds to sleep between checks when looping.')
+def fill_keypool(target, batch_size, workers, key_algorithms, loop, interval):
+    """Tops the shared key pool up to the target depth."""
+    key_algorithms = [normalize_key_algorithm(a) for a in key_algorithms] or configured_key_algorithms(current_app)
+    while True:
+        for key_algorithm in key_algorithms:
+            added = fill_pregenerated_keys(target, key_type=key_algorithm, batch_size=batch_size, workers=workers)
+            if added or not loop:
+                click.echo(f"Added {added} {key_algorithm} keys to the shared pool (target {target}).")
+        if not loop:
+            break
+        time.sleep(interval)
+
+@keypool_cli.command('status')
+def keypool_status():
+    """Shows how many keys are waiting in the shared pool."""
+    available = database_pool_stats()['available']
+    if not available:
+        click.echo("Available keys: 0")
+    for key_algorithm, count in sorted(available.items()):
+        click.echo(f"Available {key_algorithm} keys: {count}")
+
+@click.command('issuance-worker')
+@click.option('--once', is_flag=True, default=False, help='Exit once there are no pending jobs, instead of waiting for more.')
+@click.option('--interval', type=float, default=1.0, show_default=True, help='Seconds to sleep between checks when the queue is empty.')
+@with_appcontext
+def issuance_worker(once, interval):
+    """Issues the profiles queued by /auth when ISSUANCE_ASYNC is enabled."""
+    processed = run_issuance_worker(once=once, interval=interval)
+    click.echo(f"Processed {processed} issuance jobs.")
+
+encryption_cli = AppGroup('encryption', help='Manage the keys data is encrypted with at rest.')
+
+@encryption_cli.command('reencrypt')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='Number of rows to re-encrypt per transaction.')
+@click.option('--max-rate', type=float, default=0, show_default=True, help='Most rows to process per second (0 for no limit).')
+def reencrypt(batch_size, max_rate):
+    """Re-encrypts stored data under the newest key (the first of ENCRYPTION_KEYS) and ENCRYPTION_CIPHER."""
+    started = time.monotonic()
+    counts = reencrypt_all(get_fernet(), batch_size=batch_size, max_rate=max_rate)
+    elapsed = time.monotonic() - started
+    for column, column_counts in counts.items():
+        click.echo(f"{column}: re-encrypted {column_counts['reencrypted']} of {column_counts['checked']} rows, {column_counts['failed']} undecryptable.")
+    checked = sum(column_counts['checked'] for column_counts in counts.values())
+    click.echo(f"Checked {checked} rows in {elapsed:.1f}s ({checked / elapsed if elapsed else 0:.0f} rows/s).")
+
+tokens_cli = AppGroup('tokens', help='Manage download token records.')
+
+@tokens_cli.command('cleanup')
+@click.option('--lifetime-hours', type=int, default=lambda: int(os.getenv("TOKEN_LIFETIME_HOURS", "24")), show_default="TOKEN_LIFETIME_HOURS or 24", help='Delete records created more than this many hours ago.')
+@click.option('--batch-size', type=int, default=lambda: int(os.getenv("CLEANUP_BATCH_SIZE", "1000")), show_default="CLEANUP_BATCH_SIZE or 1000", help='Number of rows to delete per transaction.')
+@click.option('--time-budget', type=float, default=lambda: float(os.getenv("CLEANUP_TIME_BUDGET", "30")), show_default="CLEANUP_TIME_BUDGET or 30", help='Seconds after which no new batch is started (0 for no limit).')
+@click.option('--after', default=None, help='Resume from the cursor (an ISO 8601 time) a previous run stopped at.')
+def cleanup(lifetime_hours, batch_size, time_budget, after):
+    """Deletes token records older than the token lifetime, in batches."""
+    after = datetime.fromisoformat(after) if after else None
+    result = cleanup_tokens(cleanup_threshold(lifetime_hours), batch_size=batch_size, time_budget=time_budget, after=after)
+    click.echo(f"Deleted {result['deleted']} records older than {lifetime_hours} hours in {result['elapsed']:.1f}s ({result['rate']:.0f} rows/s).")
+    if 'partitions_dropped' in result:
+        click.echo(f"Dropped {len(result['partitions_dropped'])} partitions and created {len(result['partitions_created'])}.")
+    if not result['finished']:
+        click.echo(f"Stopped at the time budget; resume with --after {result['cursor'].isoformat()}")
+
+@tokens_cli.command('partition')
+@click.option('--interval', type=click.Choice(list(PARTITION_INTERVALS)), default='daily', show_default=True, help='Width of each partition.')
+@click.option('--ahead', type=int, default=lambda: int(os.getenv("TOKEN_PARTITIONS_AHEAD", "7")), show_default="TOKEN_PARTITIONS_AHEAD or 7", help='Number of future partitions to create.')
+def partition(interval, ahead):
+    """Converts download_tokens into a table partitioned by creation time (PostgreSQL only)."""
+    try:
+        result = partition_table(interval, ahead)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Partitioned download_tokens {interval}: moved {result['rows']} records into {len(result['partitions'])} partitions.")
+
+@tokens_cli.command('sweep')
+@click.option('--batch-size', type=int, default=lambda: int(os.getenv("PAYLOAD_SWEEP_BATCH_SIZE", "500")), show_default="PAYLOAD_SWEEP_BATCH_SIZE or 500", help='Number of tokens to expire per transaction.')
+def sweep(batch_size):
+    """Expires tokens past their download window and deletes their uncollected profiles."""
+    result = sweep_expired_payloads(batch_size)
+    click.echo(f"Expired {result['expired']} tokens; deleted {result['payloads']} payloads, reclaiming {result['bytes']} bytes.")
+    stored = result['stored']
+    if stored['payloads'] is not None:
+        click.echo(f"Payload store holds {stored['payloads']} payloads ({stored['bytes']} bytes)"
+                   + (f", {stored['table_bytes']} bytes on disk." if 'table_bytes' in stored else "."))
@@ -0,0 +1,61 @@
+import os
+from flask import Flask
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+def engine_options(db_url: str) -> dict:
+    """
+    Builds SQLALCHEMY_ENGINE_OPTIONS for a database URL from the environment.
+
+    Each worker keeps a pool of DATABASE_POOL_SIZE connections, plus up to
+    DATABASE_MAX_OVERFLOW more under load. Connections are checked before use
+    (DATABASE_POOL_PRE_PING) and replaced after DATABASE_POOL_RECYCLE
+    seconds, so a database failover or idle timeout costs a reconnect rather
+    than failed requests. On Postgres, DATABASE_STATEMENT_TIMEOUT (ms) stops
+    any one statement running longer.
+
+    DATABASE_PGBOUNCER=true is for running behind PgBouncer in transaction
+    pooling mode, which does the pooling itself and may hand each transaction
+    a different server connection. Connections are not pooled here
+    (NullPool), and psycopg 3 does not prepare statements on the server.
+
+    SQLite is left to Flask-SQLAlchemy's defaults.
+    """
+    url = make_url(db_url)
+    if url.get_backend_name() == 'sqlite':
+        return {}
+
+    pgbouncer = os.getenv("DATABASE_PGBOUNCER", "false").lower() in ["true", "1", "yes"]
+    statement_timeout = int(os.getenv("DATABASE_STATEMENT_TIMEOUT", "0"))
+    connect_args = {}
+    if pgbouncer:
+        options = {"poolclass": NullPool}
+        if url.get_driver_name() == 'psycopg':
+            connect_args["prepare_threshold"] = None
+    else:
+        options = {
+            "pool_size": int(os.getenv("DATABASE_POOL_SIZE", "5")),
+            "max_overflow": int(os.getenv("DATABASE_MAX_OVERFLOW", "10")),
+            "pool_pre_ping": os.getenv("DATABASE_POOL_PRE_PING", "true").lower() in ["true", "1", "yes"],
+            "pool_recycle": int(os.getenv("DATABASE_POOL_RECYCLE", "1800")),
+        }
+
+    if statement_timeout > 0:
+        if url.get_backend_name() != 'postgresql':
+            raise RuntimeError("DATABASE_STATEMENT_TIMEOUT is only supported on PostgreSQL.")
+        if pgbouncer:
+            # PgBouncer refuses (or, with ignore_startup_parameters, drops) the options parameter
+            raise RuntimeError(
+                "DATABASE_STATEMENT_TIMEOUT cannot be sent through PgBouncer; "
+                "set statement_timeout on the database role instead (ALTER ROLE ... SET statement_timeout)."
+            )
+        connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+def init_database(app: Flask, db_url: str):
+    """Sets the database URL and the engine options for it."""
+    app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(db_url)
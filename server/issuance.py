@@ -0,0 +1,435 @@
+import os
+import json
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor
+from flask import Flask, current_app
+from sqlalchemy import or_
+from cryptography.hazmat.primitives import serialization
+from .extensions import db
+from .models import DownloadToken
+from .cert_utils import create_device_certificate, sign_device_csr
+from .keypool import take_device_key, try_take_device_key
+from .speculation import claim_speculation
+from .payload import encrypt_profile
+from .payload_store import get_payload_store
+from .utils import get_fernet, get_static_render_context, get_tlscrypt_key, render_ovpn_template, select_ovpn_template, resolve_key_algorithm
+
+# The parts of the app config an issuance worker process needs. Everything
+# else (CA, Fernet key, tls-crypt key) is read from the inherited environment.
+WORKER_CONFIG_KEYS = (
+    "OVPNS_TEMPLATES",
+    "OVPNS_OPTIONSETS",
+    "OVPNS_OPTIONSET_HEADERS",
+    "DEVICE_KEY_ALGORITHM",
+    "PROFILE_COMPRESSION",
+    "PROFILE_COMPRESSION_LEVEL",
+)
+
+def render_profile(user_info, optionset_name, device_key_pem, device_cert_pem, common_name, tlscrypt=None, static_context=None) -> str:
+    """Renders the OVPN profile for an issued certificate, using tls-crypt material prepared earlier if given."""
+    static_context = static_context or get_static_render_context()
+    if tlscrypt is None:
+        if static_context["tlscrypt_type"] == 2:
+            tlscrypt = get_tlscrypt_key(device_cert_pem.decode('utf-8'))
+        else:
+            tlscrypt = (static_context["tlscrypt_type"], static_context["tlscrypt_key"])
+    tlscrypt_type, tlscrypt_key = tlscrypt
+
+    optionsets = static_context["optionsets"]
+    optionset_content = optionsets.get(optionset_name, optionsets.get('default', ''))
+
+    # Only the per-user fields are added to the precomputed part of the context
+    render_context = dict(
+        static_context["context"],
+        userinfo=user_info,
+        device_key_pem=device_key_pem,
+        device_cert_pem=device_cert_pem.decode('utf-8'),
+        common_name=common_name,
+        optionset=optionset_content,
+        optionset_name=optionset_name,
+        tlscrypt_key=tlscrypt_key,
+        tlscrypt_type=tlscrypt_type,
+    )
+
+    return render_ovpn_template(user_info.get('groups', []), render_context)
+
+def issue_ovpn_profile(user_info, optionset_name, key_algorithm, device_key=None, tlscrypt=None) -> dict:
+    """
+    The CPU-heavy part of issuance: generate a key (unless one is supplied, as a
+    key object or PEM), sign the certificate, render the profile and encrypt it.
+    Runs in the request worker, or in an issuance worker process.
+    """
+    if isinstance(device_key, bytes):
+        device_key = serialization.load_pem_private_key(device_key, password=None)
+
+    static_context = get_static_render_context()
+    ca_cert, ca_key = static_context["ca_certs"]
+    device_key_pem, device_cert_pem, common_name, cert_expiry = create_device_certificate(
+        user_info['sub'], ca_cert, ca_key, device_key=device_key, key_algorithm=key_algorithm,
+        subject_attributes=static_context["subject_attributes"],
+    )
+    ovpn_content = render_profile(user_info, optionset_name, device_key_pem.decode('utf-8'), device_cert_pem, common_name, tlscrypt, static_context)
+
+    return {
+        "encrypted_ovpn_content": encrypt_profile(ovpn_content),
+        "common_name": common_name,
+        "cert_expiry": cert_expiry,
+    }
+
+def sign_ovpn_profile(user_info, optionset_name, key_algorithm, username, csr_pem) -> dict:
+    """
+    The CSR equivalent of issue_ovpn_profile: sign the client's CSR and render
+    the profile without a key. Raises ValueError if the CSR is not acceptable.
+    """
+    static_context = get_static_render_context()
+    ca_cert, ca_key = static_context["ca_certs"]
+    device_cert_pem, common_name, cert_expiry = sign_device_csr(
+        csr_pem, username, ca_cert, ca_key, key_algorithm=key_algorithm,
+        subject_attributes=static_context["subject_attributes"],
+    )
+    # The client adds its own key to the profile
+    ovpn_content = render_profile(user_info, optionset_name, "", device_cert_pem, common_name, static_context=static_context)
+
+    return {
+        "ovpn_content": ovpn_content,
+        "common_name": common_name,
+        "cert_expiry": cert_expiry,
+    }
+
+# --- Issuance worker processes ---
+
+_worker_app = None
+
+def _init_issuance_worker(config: dict):
+    """Runs once in each issuance worker process to give it a minimal app to run in."""
+    global _worker_app
+    _worker_app = Flask(__name__)
+    _worker_app.config.update(config)
+
+def _run_in_worker(function, *args):
+    with _worker_app.app_context():
+        return function(*args)
+
+class IssuanceExecutor:
+    """
+    Runs issuance steps in a pool of worker processes, so the CPU-bound work
+    does not hold the GIL of the process serving requests. With threaded
+    gunicorn workers the other threads keep serving /download, /healthz and
+    friends while a login is being processed.
+    """
+
+    def __init__(self, processes: int, config: dict, timeout: float = 60.0):
+        self.processes = processes
+        self.timeout = timeout
+        self._config = config
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            # An executor inherited across a fork is unusable, so start a fresh one.
+            if self._executor is None or self._pid != os.getpid():
+                # 'spawn' avoids forking a parent which has key pool threads running.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_issuance_worker,
+                    initargs=(self._config,),
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def run(self, function, *args):
+        """Runs function(*args) in a worker process and waits for the result."""
+        future = self._get_executor().submit(_run_in_worker, function, *args)
+        return future.result(timeout=self.timeout)
+
+    def reconfigure(self, config: dict):
+        """
+        Replaces the worker processes' config snapshot after a reload. Running
+        issuances finish in the old processes; new ones start fresh processes.
+        """
+        with self._lock:
+            self._config = config
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+# --- Admission control ---
+
+class IssuanceBusy(Exception):
+    """Raised when an issuance cannot be admitted; rendered as a 503 with Retry-After."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Issuance is at capacity, retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+class IssuanceGate:
+    """
+    Bounds the number of issuances a worker runs at once, with a short wait
+    queue in front. Requests which find the queue full, or which wait longer
+    than queue_timeout, are shed with IssuanceBusy rather than left to pile up.
+    A concurrency of 0 admits everything, but the counters are still kept.
+    """
+
+    def __init__(self, concurrency: int = 0, queue_size: int = 0, queue_timeout: float = 5.0, retry_after: int = 5):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(concurrency) if concurrency > 0 else None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = 0
+        self._admitted = 0
+        self._rejected = 0
+
+    def _acquire(self):
+        if self._slots is None or self._slots.acquire(blocking=False):
+            return
+
+        with self._lock:
+            if self._queued >= self.queue_size:
+                self._rejected += 1
+                raise IssuanceBusy(self.retry_after)
+            self._queued += 1
+
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self._queued -= 1
+            if not acquired:
+                self._rejected += 1
+        if not acquired:
+            raise IssuanceBusy(self.retry_after)
+
+    @contextmanager
+    def admit(self):
+        """Holds an issuance slot for the duration of the block, or raises IssuanceBusy."""
+        self._acquire()
+        with self._lock:
+            self._in_flight += 1
+            self._admitted += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            if self._slots is not None:
+                self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "queue_size": self.queue_size,
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+            }
+
+def init_issuance(app: Flask):
+    """
+    Sets up issuance admission control and the issuance executor from the
+    environment. With ISSUANCE_PROCESSES at 0 (the default) issuance runs inline
+    in the request worker; with ISSUANCE_CONCURRENCY at 0 it is not limited.
+    """
+    app.config["ISSUANCE_CONCURRENCY"] = int(os.getenv("ISSUANCE_CONCURRENCY", "0"))
+    app.config["ISSUANCE_QUEUE_SIZE"] = int(os.getenv("ISSUANCE_QUEUE_SIZE", "0"))
+    app.config["ISSUANCE_QUEUE_TIMEOUT"] = float(os.getenv("ISSUANCE_QUEUE_TIMEOUT", "5"))
+    app.config["ISSUANCE_RETRY_AFTER"] = int(os.getenv("ISSUANCE_RETRY_AFTER", "5"))
+    app.config['issuance_gate'] = IssuanceGate(
+        concurrency=app.config["ISSUANCE_CONCURRENCY"],
+        queue_size=app.config["ISSUANCE_QUEUE_SIZE"],
+        queue_timeout=app.config["ISSUANCE_QUEUE_TIMEOUT"],
+        retry_after=app.config["ISSUANCE_RETRY_AFTER"],
+    )
+
+    app.config["ISSUANCE_ASYNC"] = os.getenv("ISSUANCE_ASYNC", "false").lower() in ["true", "1", "yes"]
+    app.config["ISSUANCE_PROCESSES"] = int(os.getenv("ISSUANCE_PROCESSES", "0"))
+    app.config["ISSUANCE_TIMEOUT"] = float(os.getenv("ISSUANCE_TIMEOUT", "60"))
+    app.config["ISSUANCE_JOB_TIMEOUT"] = float(os.getenv("ISSUANCE_JOB_TIMEOUT", "120"))
+    app.config['issuance_executor'] = None
+    if app.config["ISSUANCE_PROCESSES"] > 0:
+        config = {key: app.config.get(key) for key in WORKER_CONFIG_KEYS}
+        app.config['issuance_executor'] = IssuanceExecutor(app.config["ISSUANCE_PROCESSES"], config, app.config["ISSUANCE_TIMEOUT"])
+        app.logger.info("Issuance will run in %s worker process(es).", app.config['ISSUANCE_PROCESSES'])
+
+def run_issuance(function, *args):
+    """Runs an issuance step in the worker processes if configured, otherwise inline."""
+    executor = current_app.config.get('issuance_executor')
+    if executor is None:
+        return function(*args)
+    return executor.run(function, *args)
+
+def issue_profile(user_info, optionset_name, speculation_id=None) -> dict:
+    """
+    Issues a new device certificate and encrypted profile for the user, using
+    the key material speculatively prepared at /login if there is any.
+    Raises IssuanceBusy if the worker is already issuing at capacity.
+    """
+    with current_app.config['issuance_gate'].admit():
+        return _issue_profile(user_info, optionset_name, speculation_id)
+
+def _issue_profile(user_info, optionset_name, speculation_id) -> dict:
+    key_algorithm = resolve_key_algorithm(select_ovpn_template(user_info.get('groups', [])), optionset_name)
+    executor = current_app.config.get('issuance_executor')
+
+    tlscrypt = None
+    prepared = claim_speculation(speculation_id, key_algorithm)
+    if prepared is not None:
+        device_key, tlscrypt = prepared['device_key'], prepared['tlscrypt']
+    elif executor is None:
+        device_key = take_device_key(key_algorithm)
+    else:
+        # Only hand over a key if one is ready; otherwise the worker process
+        # generates it, which is the point of having worker processes.
+        device_key = try_take_device_key(key_algorithm)
+
+    if executor is not None and device_key is not None:
+        device_key = device_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+
+    return run_issuance(issue_ovpn_profile, user_info, optionset_name, key_algorithm, device_key, tlscrypt)
+
+def sign_profile(user_info, optionset_name, username, csr_pem) -> dict:
+    """
+    Signs a client CSR and renders its key-less profile. Raises IssuanceBusy
+    if the worker is already issuing at capacity.
+    """
+    with current_app.config['issuance_gate'].admit():
+        key_algorithm = resolve_key_algorithm(select_ovpn_template(user_info.get('groups', [])), optionset_name)
+        return run_issuance(sign_ovpn_profile, user_info, optionset_name, key_algorithm, username, csr_pem)
+
+def issuance_stats() -> dict:
+    """Returns the issuance admission counters for the metrics endpoint."""
+    stats = current_app.config['issuance_gate'].stats()
+    stats["processes"] = current_app.config.get("ISSUANCE_PROCESSES", 0)
+    return stats
+
+# --- Asynchronous issuance jobs ---
+
+PENDING_STATUSES = ('pending', 'issuing')
+
+def _claim_issuance_job():
+    """
+    Atomically moves one pending job to 'issuing' and returns its id. On
+    PostgreSQL concurrent workers skip each other's locked rows; other
+    databases (SQLite) fall back to a conditional update only one worker wins.
+    """
+    query = db.session.query(DownloadToken).filter_by(status='pending').order_by(DownloadToken.id)
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        job = query.with_for_update(skip_locked=True).first()
+        if job is None:
+            db.session.rollback()
+            return None
+        job.status = 'issuing'
+        job.claimed_at = datetime.now(timezone.utc)
+        db.session.commit()
+        return job.id
+
+    for _ in range(5):
+        job_id = query.with_entities(DownloadToken.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+        claimed = db.session.query(DownloadToken).filter(
+            DownloadToken.id == job_id, DownloadToken.status == 'pending'
+        ).update({"status": 'issuing', "claimed_at": datetime.now(timezone.utc)}, synchronize_session=False)
+        db.session.commit()
+        if claimed == 1:
+            return job_id
+    return None
+
+def reclaim_stale_issuance_jobs(timeout: float) -> int:
+    """
+    Puts jobs that have been 'issuing' for longer than `timeout` seconds back
+    to 'pending', as the worker that claimed them has died or been killed.
+    Returns how many. A job whose download window has closed by the time it
+    is claimed again is marked failed, so one that kills every worker that
+    picks it up is not retried for ever.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=timeout)
+    reclaimed = db.session.query(DownloadToken).filter(
+        DownloadToken.status == 'issuing',
+        or_(DownloadToken.claimed_at == None, DownloadToken.claimed_at < cutoff),
+    ).update({"status": 'pending', "claimed_at": None}, synchronize_session=False)
+    db.session.commit()
+    if reclaimed:
+        current_app.logger.warning("Reclaimed %s issuance jobs left unfinished for over %ss.", reclaimed, timeout)
+    return reclaimed
+
+def process_issuance_job(job_id: int) -> bool:
+    """Issues the profile for a claimed job. Returns False if the job failed."""
+    job = db.session.get(DownloadToken, job_id)
+    try:
+        if job.is_download_window_expired():
+            raise RuntimeError("download window expired before the job was picked up")
+        context = json.loads(get_fernet().decrypt(job.issuance_context))
+        issued = issue_profile(context['userinfo'], context['optionset_name'])
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error("Issuance job %s failed: %s", job_id, e)
+        job = db.session.get(DownloadToken, job_id)
+        job.status = 'failed'
+        job.downloadable = False
+        job.issuance_context = None
+        db.session.commit()
+        return False
+
+    get_payload_store().put(job.token, issued['encrypted_ovpn_content'])
+    job.cn = issued['common_name']
+    job.cert_expiry = issued['cert_expiry']
+    job.status = 'ready'
+    job.issuance_context = None
+    db.session.commit()
+    return True
+
+def run_issuance_worker(once: bool = False, interval: float = 1.0) -> int:
+    """
+    Processes pending issuance jobs, sleeping `interval` seconds whenever the
+    queue is empty. With `once`, returns when the queue is empty. Returns the
+    number of jobs processed.
+    """
+    processed = 0
+    timeout = current_app.config.get("ISSUANCE_JOB_TIMEOUT", 120.0)
+    next_reclaim = 0.0
+    while True:
+        if time.monotonic() >= next_reclaim:
+            reclaim_stale_issuance_jobs(timeout)
+            next_reclaim = time.monotonic() + min(timeout, 30.0)
+        job_id = _claim_issuance_job()
+        if job_id is None:
+            if once:
+                return processed
+            time.sleep(interval)
+            continue
+        process_issuance_job(job_id)
+        processed += 1
+
+def issuance_job_status(token_record) -> str:
+    """Describes a token for the status endpoint: pending, ready, failed, collected or expired."""
+    if token_record.status == 'failed':
+        return 'failed'
+    if token_record.collected:
+        return 'collected'
+    if not token_record.downloadable or token_record.is_download_window_expired():
+        return 'expired'
+    if token_record.status in PENDING_STATUSES:
+        return 'pending'
+    return token_record.status
@@ -0,0 +1,301 @@
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, current_app
+from sqlalchemy import func
+from cryptography.hazmat.primitives import serialization
+from .extensions import db
+from .models import PregeneratedKey
+from .cert_utils import generate_device_key, DEFAULT_KEY_ALGORITHM
+
+log = logging.getLogger(__name__)
+
+KEYPOOL_FALLBACKS = ('generate', 'wait', 'error')
+
+class KeyPool:
+    """
+    A bounded queue of pre-generated items (normally device private keys)
+    which is kept topped up by background threads.
+
+    Taking an item from a warm pool is just a dequeue, so the expensive
+    generation step is moved off the request path. When the pool is empty
+    the configured fallback decides what happens:
+
+    * ``generate`` - generate an item inline (the old behaviour).
+    * ``wait``     - wait up to ``wait_seconds`` for a refill thread, then generate inline.
+    * ``error``    - raise a RuntimeError.
+    """
+
+    def __init__(self, factory, size: int, refill_workers: int = 1, fallback: str = 'generate', wait_seconds: float = 5.0, name: str = 'keypool'):
+        if fallback not in KEYPOOL_FALLBACKS:
+            raise RuntimeError(f"Invalid key pool fallback '{fallback}', expected one of {KEYPOOL_FALLBACKS}.")
+        self.factory = factory
+        self.size = size
+        self.refill_workers = max(1, refill_workers)
+        self.fallback = fallback
+        self.wait_seconds = wait_seconds
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=size)
+        self._stopped = threading.Event()
+        self._threads = []
+        self._pid = None
+
+    def start(self):
+        """Starts the refill threads. Safe to call more than once."""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive a fork (e.g. gunicorn --preload), so a
+            # pool inherited from a parent process starts again from empty.
+            if self._pid is not None:
+                self._queue = queue.Queue(maxsize=self.size)
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._threads = []
+            for i in range(self.refill_workers):
+                thread = threading.Thread(target=self._refill_loop, name=f"{self.name}-refill-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Signals the refill threads to exit once their current item is done."""
+        self._stopped.set()
+
+    def _refill_loop(self):
+        while not self._stopped.is_set():
+            try:
+                item = self.factory()
+            except Exception as e:
+                log.error("%s: failed to generate pooled item: %s", self.name, e)
+                self._stopped.wait(1)
+                continue
+            # Block until there is space; re-check the stop flag periodically.
+            while not self._stopped.is_set():
+                try:
+                    self._queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def try_take(self):
+        """Returns a pooled item if one is ready, otherwise None. Only hits are counted."""
+        self.start()
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            return None
+        self._record(hit=True)
+        return item
+
+    def take(self):
+        """Returns a pooled item, falling back as configured when the pool is empty."""
+        item = self.try_take()
+        if item is not None:
+            return item
+
+        self._record(hit=False)
+        if self.fallback == 'error':
+            raise RuntimeError(f"{self.name}: pool is empty and fallback is 'error'.")
+        if self.fallback == 'wait':
+            try:
+                return self._queue.get(timeout=self.wait_seconds)
+            except queue.Empty:
+                log.warning("%s: no pooled item after %ss, generating inline.", self.name, self.wait_seconds)
+        return self.factory()
+
+    def _record(self, hit: bool):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        """Returns the pool depth and hit/miss counters."""
+        with self._stats_lock:
+            return {
+                "size": self.size,
+                "available": self._queue.qsize(),
+                "refill_workers": self.refill_workers,
+                "fallback": self.fallback,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+_keypools_lock = threading.Lock()
+
+def init_keypool(app: Flask):
+    """
+    Reads the key pool settings and starts a pool for every device key algorithm
+    the configuration can ask for. Pooling is disabled (keys are generated
+    inline) when KEYPOOL_SIZE is 0.
+    """
+    app.config["KEYPOOL_DATABASE"] = os.getenv("KEYPOOL_DATABASE", "false").lower() in ['true', '1', 'yes']
+    app.config["KEYPOOL_SIZE"] = int(os.getenv("KEYPOOL_SIZE", "0"))
+    app.config["KEYPOOL_REFILL_WORKERS"] = int(os.getenv("KEYPOOL_REFILL_WORKERS", "1"))
+    app.config["KEYPOOL_FALLBACK"] = os.getenv("KEYPOOL_FALLBACK", "generate")
+    app.config["KEYPOOL_WAIT_SECONDS"] = float(os.getenv("KEYPOOL_WAIT_SECONDS", "5"))
+    app.config['keypool_instances'] = {}
+    if app.config["KEYPOOL_SIZE"] <= 0:
+        return
+
+    from .utils import configured_key_algorithms
+    for key_algorithm in configured_key_algorithms(app):
+        get_keypool(key_algorithm, app)
+
+def get_keypool(key_algorithm: str, app: Flask | None = None):
+    """Returns this worker's pool for a key algorithm, starting it on first use. None if pooling is disabled."""
+    app = app or current_app
+    if app.config.get("KEYPOOL_SIZE", 0) <= 0:
+        return None
+
+    pools = app.config.setdefault('keypool_instances', {})
+    with _keypools_lock:
+        pool = pools.get(key_algorithm)
+        if pool is None:
+            pool = KeyPool(
+                lambda: generate_device_key(key_algorithm),
+                size=app.config["KEYPOOL_SIZE"],
+                refill_workers=app.config["KEYPOOL_REFILL_WORKERS"],
+                fallback=app.config["KEYPOOL_FALLBACK"],
+                wait_seconds=app.config["KEYPOOL_WAIT_SECONDS"],
+                name=f"device-keypool-{key_algorithm}",
+            )
+            pool.start()
+            pools[key_algorithm] = pool
+            app.logger.info("Device key pool for %s started with depth %s and %s refill worker(s).", key_algorithm, pool.size, pool.refill_workers)
+    return pool
+
+def try_take_device_key(key_algorithm: str = DEFAULT_KEY_ALGORITHM):
+    """Takes a ready-made device key from this worker's pool or the shared database pool, or returns None."""
+    pool = get_keypool(key_algorithm)
+    if pool is not None:
+        device_key = pool.try_take()
+        if device_key is not None:
+            return device_key
+
+    if current_app.config.get("KEYPOOL_DATABASE"):
+        return claim_pregenerated_key(key_algorithm)
+    return None
+
+def take_device_key(key_algorithm: str = DEFAULT_KEY_ALGORITHM):
+    """
+    Takes a device key from the cheapest available source: this worker's pool,
+    then the shared database pool, and finally the worker pool's fallback
+    (or inline generation when pooling is disabled).
+    """
+    device_key = try_take_device_key(key_algorithm)
+    if device_key is not None:
+        return device_key
+
+    pool = get_keypool(key_algorithm)
+    if pool is not None:
+        return pool.take()
+    return generate_device_key(key_algorithm)
+
+# --- Shared (database) key pool ---
+
+_database_pool_stats = {"hits": 0, "misses": 0}
+_database_pool_stats_lock = threading.Lock()
+
+def _record_database_claim(hit: bool):
+    with _database_pool_stats_lock:
+        _database_pool_stats["hits" if hit else "misses"] += 1
+
+def _claim_encrypted_key(key_type: str):
+    """
+    Atomically removes one pregenerated key row and returns its encrypted key.
+    On PostgreSQL concurrent claimers skip each other's locked rows; other
+    databases (SQLite) fall back to a delete-by-id that only one claimer can win.
+    """
+    query = db.session.query(PregeneratedKey).filter_by(key_type=key_type).order_by(PregeneratedKey.id)
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        row = query.with_for_update(skip_locked=True).first()
+        if row is None:
+            db.session.rollback()
+            return None
+        encrypted_key = row.encrypted_key
+        db.session.delete(row)
+        db.session.commit()
+        return encrypted_key
+
+    for _ in range(5):
+        row = query.with_entities(PregeneratedKey.id, PregeneratedKey.encrypted_key).first()
+        if row is None:
+            db.session.rollback()
+            return None
+        deleted = db.session.query(PregeneratedKey).filter(PregeneratedKey.id == row.id).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted == 1:
+            return row.encrypted_key
+    return None
+
+def claim_pregenerated_key(key_type: str = DEFAULT_KEY_ALGORITHM):
+    """Claims a key from the shared database pool, returning None when it is empty."""
+    # Local import to prevent circular dependencies at startup
+    from .utils import get_fernet
+    try:
+        encrypted_key = _claim_encrypted_key(key_type)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error("Could not claim a pregenerated key: %s", e)
+        encrypted_key = None
+
+    _record_database_claim(hit=encrypted_key is not None)
+    if encrypted_key is None:
+        return None
+    return serialization.load_pem_private_key(get_fernet().decrypt(encrypted_key), password=None)
+
+def fill_pregenerated_keys(target: int, key_type: str = DEFAULT_KEY_ALGORITHM, batch_size: int = 10, workers: int = 1) -> int:
+    """
+    Tops the shared key pool up to `target` unclaimed keys of `key_type`,
+    generating `workers` keys in parallel and committing every `batch_size`.
+    Returns the number of keys added.
+    """
+    from .utils import get_fernet
+    fernet = get_fernet()
+
+    def generate_encrypted_key():
+        device_key = generate_device_key(key_type)
+        return fernet.encrypt(device_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        ))
+
+    available = db.session.query(func.count(PregeneratedKey.id)).filter_by(key_type=key_type).scalar() or 0
+    needed = max(0, target - available)
+    added = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while added < needed:
+            batch = min(batch_size, needed - added)
+            for encrypted_key in executor.map(lambda _: generate_encrypted_key(), range(batch)):
+                db.session.add(PregeneratedKey(key_type=key_type, encrypted_key=encrypted_key))  # type: ignore
+            db.session.commit()
+            added += batch
+    return added
+
+def database_pool_stats() -> dict:
+    """Returns the shared pool depth per key algorithm and this worker's claim counters."""
+    with _database_pool_stats_lock:
+        stats = dict(_database_pool_stats)
+    rows = db.session.query(PregeneratedKey.key_type, func.count(PregeneratedKey.id)).group_by(PregeneratedKey.key_type).all()
+    stats["available"] = {key_type: count for key_type, count in rows}
+    return stats
+
+def keypool_stats() -> dict:
+    """Returns the key pool counters for the metrics endpoint."""
+    pools = current_app.config.get('keypool_instances') or {}
+    stats = {"enabled": current_app.config.get("KEYPOOL_SIZE", 0) > 0}
+    if stats["enabled"]:
+        stats["pools"] = {key_algorithm: pool.stats() for key_algorithm, pool in pools.items()}
+    if current_app.config.get("KEYPOOL_DATABASE"):
+        stats["database"] = database_pool_stats()
+    return stats
@@ -0,0 +1,152 @@
+import os
+import time
+import base64
+import hashlib
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy import update
+from .extensions import db
+from .models import DownloadToken, DownloadPayload, PregeneratedKey
+
+CIPHERS = ("fernet", "aesgcm")
+
+# AES-GCM envelope: marker || key ID || nonce || ciphertext and tag. Fernet
+# tokens are URL-safe base64 text, so they can never start with the marker.
+AESGCM_MARKER = b"\x01"
+KEY_ID_LENGTH = 8
+NONCE_LENGTH = 12
+
+# The columns holding data encrypted with the key ring
+ENCRYPTED_COLUMNS = (
+    (DownloadPayload, DownloadPayload.payload),
+    (DownloadToken, DownloadToken.issuance_context),
+    (PregeneratedKey, PregeneratedKey.encrypted_key),
+)
+
+class KeyRing:
+    """
+    Encrypts with the first (newest) of its keys and decrypts with any of them,
+    so ENCRYPTION_KEY can be rotated without losing rows encrypted under the
+    old key. New data is written as Fernet tokens or as AES-GCM envelopes
+    tagged with the ID of the key used. Both formats are always readable.
+    Decryption failures raise cryptography's InvalidToken, as Fernet does.
+    """
+
+    def __init__(self, keys: list[str], cipher: str = "fernet"):
+        if not keys:
+            raise RuntimeError("At least one encryption key is needed.")
+        if cipher not in CIPHERS:
+            raise RuntimeError(f"Unsupported ENCRYPTION_CIPHER '{cipher}'.")
+        self.cipher = cipher
+        self._fernets = [Fernet(key) for key in keys]
+        self._multi_fernet = MultiFernet(self._fernets)
+        self._aesgcm = {}
+        for key in keys:
+            # A separate key is derived for AES-GCM rather than reusing the Fernet key bytes
+            derived = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"ovpn-manager aes-gcm").derive(base64.urlsafe_b64decode(key))
+            self._aesgcm.setdefault(hashlib.sha256(derived).digest()[:KEY_ID_LENGTH], AESGCM(derived))
+        self.primary_key_id = next(iter(self._aesgcm))
+
+    def encrypt(self, data: bytes) -> bytes:
+        if self.cipher == "aesgcm":
+            nonce = os.urandom(NONCE_LENGTH)
+            header = AESGCM_MARKER + self.primary_key_id
+            return header + nonce + self._aesgcm[self.primary_key_id].encrypt(nonce, data, header)
+        return self._multi_fernet.encrypt(data)
+
+    def decrypt(self, token: bytes) -> bytes:
+        if token is None:
+            raise TypeError("Nothing to decrypt.")
+        if not token.startswith(AESGCM_MARKER):
+            return self._multi_fernet.decrypt(token)
+        header, nonce, body = token[:1 + KEY_ID_LENGTH], token[1 + KEY_ID_LENGTH:1 + KEY_ID_LENGTH + NONCE_LENGTH], token[1 + KEY_ID_LENGTH + NONCE_LENGTH:]
+        aesgcm = self._aesgcm.get(header[1:])
+        if aesgcm is None:
+            raise InvalidToken
+        try:
+            return aesgcm.decrypt(nonce, body, header)
+        except Exception:
+            raise InvalidToken
+
+    def is_current(self, token: bytes) -> bool:
+        """
+        Whether a token is already in the configured cipher under the newest
+        key. Nothing is decrypted: AES-GCM envelopes are told by their key ID,
+        and Fernet tokens by checking only their HMAC against the newest key.
+        """
+        if token.startswith(AESGCM_MARKER):
+            return self.cipher == "aesgcm" and token[1:1 + KEY_ID_LENGTH] == self.primary_key_id
+        if self.cipher != "fernet":
+            return False
+        try:
+            self._fernets[0].extract_timestamp(token)
+            return True
+        except InvalidToken:
+            return False
+
+    def rotate(self, token: bytes) -> bytes:
+        """Re-encrypts a token in the configured cipher under the newest key, decrypting it once."""
+        if self.cipher == "fernet" and not token.startswith(AESGCM_MARKER):
+            return self._multi_fernet.rotate(token)
+        return self.encrypt(self.decrypt(token))
+
+def load_keyring() -> KeyRing:
+    """
+    Builds the key ring from ENCRYPTION_KEYS (comma separated, newest first)
+    or ENCRYPTION_KEY, and ENCRYPTION_CIPHER (fernet or aesgcm).
+    """
+    keys = [key.strip() for key in os.getenv("ENCRYPTION_KEYS", "").split(",") if key.strip()]
+    if not keys and os.getenv("ENCRYPTION_KEY"):
+        keys = [os.environ["ENCRYPTION_KEY"]]
+    if not keys:
+        raise RuntimeError("ENCRYPTION_KEY must be set for data encryption.")
+    return KeyRing(keys, os.getenv("ENCRYPTION_CIPHER", "fernet").lower())
+
+def reencrypt_column(keyring: KeyRing, model, column, batch_size: int = 500, max_rate: float = 0) -> dict:
+    """
+    Re-encrypts one column under the newest key, a batch per transaction,
+    and no faster than max_rate rows per second (0 for no limit). Each row is
+    only updated if it still holds the value that was read, so a profile
+    downloaded (and cleared) in the meantime is not brought back.
+    """
+    counts = {"checked": 0, "reencrypted": 0, "failed": 0}
+    last_id = 0
+    started = time.monotonic()
+    while True:
+        rows = db.session.query(model.id, column).filter(
+            model.id > last_id, column.isnot(None)
+        ).order_by(model.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        for row_id, token in rows:
+            last_id = row_id
+            counts["checked"] += 1
+            if keyring.is_current(token):
+                continue
+            try:
+                rotated = keyring.rotate(token)
+            except InvalidToken:
+                counts["failed"] += 1
+                continue
+            result = db.session.execute(
+                update(model).where(model.id == row_id, column == token).values({column.key: rotated})
+            )
+            counts["reencrypted"] += result.rowcount
+        db.session.commit()
+
+        if max_rate > 0:
+            # Sleep off any time the batch was ahead of the rate limit
+            ahead = counts["checked"] / max_rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return counts
+
+def reencrypt_all(keyring: KeyRing, batch_size: int = 500, max_rate: float = 0) -> dict:
+    """Re-encrypts every encrypted column. Returns the counts per column."""
+    return {
+        f"{model.__tablename__}.{column.key}": reencrypt_column(keyring, model, column, batch_size, max_rate)
+        for model, column in ENCRYPTED_COLUMNS
+    }
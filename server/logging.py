@@ -1,6 +1,66 @@
+import os
+import queue
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from flask import Flask
 from gunicorn.glogging import Logger
 
+# Flask names app.logger after the import name, so 'server' covers it as
+# well as the module level loggers under server.*
+APP_LOGGERS = ('server',)
+
+_queue_handler = None
+_queue_listener = None
+
+def log_level() -> int:
+    """The application log level from LOG_LEVEL (default INFO)."""
+    name = os.getenv("LOG_LEVEL", "INFO").upper()
+    level = logging.getLevelName(name)
+    if not isinstance(level, int):
+        raise RuntimeError(f"LOG_LEVEL '{name}' is not a valid log level.")
+    return level
+
+def init_logging(app: Flask):
+    """Sets the application loggers to LOG_LEVEL."""
+    app.config["LOG_LEVEL"] = logging.getLevelName(log_level())
+    for name in APP_LOGGERS:
+        logging.getLogger(name).setLevel(app.config["LOG_LEVEL"])
+
+def _start_queue_listener(handlers):
+    global _queue_listener
+    _queue_listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _queue_listener.start()
+
+def _restart_queue_listener():
+    # The listener thread does not survive a fork, so each gunicorn worker
+    # starts a new listener, with a fresh queue in case the fork caught a lock held.
+    if _queue_listener is not None:
+        _queue_handler.queue = queue.SimpleQueue()
+        _start_queue_listener(_queue_listener.handlers)
+
+def _stop_queue_listener():
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+def queue_log_handlers(handlers: list) -> QueueHandler:
+    """
+    Puts handlers behind a queue, so logging from a request thread only
+    enqueues the record and a background thread does the writing. Calling it
+    again (e.g. when gunicorn reloads its config) replaces the handlers.
+    """
+    global _queue_handler
+    if _queue_handler is None:
+        _queue_handler = QueueHandler(queue.SimpleQueue())
+        os.register_at_fork(after_in_child=_restart_queue_listener)
+        atexit.register(_stop_queue_listener)
+    else:
+        _stop_queue_listener()
+    _start_queue_listener(handlers)
+    return _queue_handler
+
 class CustomGunicornLogger(Logger):
     """
     A custom Gunicorn logger that filters out Kubernetes health check probes
@@ -12,17 +72,15 @@ class CustomGunicornLogger(Logger):
         """
         super().setup(cfg)
 
-        # --- THIS IS THE FIX ---
-        # Get the Flask application's logger
-        app_logger = logging.getLogger('flask.app')
-
-        # Add all of Gunicorn's handlers to the Flask logger.
-        # This makes Flask's debug messages go to the same place as Gunicorn's logs.
-        for handler in self.error_log.handlers:
-            app_logger.addHandler(handler)
-        
-        # Finally, ensure the Flask logger is set to DEBUG level.
-        app_logger.setLevel(logging.DEBUG)
+        # Send the application's logs to Gunicorn's error log handlers, through
+        # a queue so the handlers' I/O happens off the request threads.
+        handler = queue_log_handlers(list(self.error_log.handlers))
+        level = log_level()
+        for name in APP_LOGGERS:
+            app_logger = logging.getLogger(name)
+            app_logger.handlers = [h for h in app_logger.handlers if not isinstance(h, QueueHandler)] + [handler]
+            app_logger.setLevel(level)
+            app_logger.propagate = False
 
     def access(self, resp, req, environ, request_time):
         """
@@ -36,4 +94,4 @@ class CustomGunicornLogger(Logger):
         if user_agent.startswith('kube-probe/') and req.method == 'GET' and req.path == '/healthz':
             return
 
-        super().access(resp, req, environ, request_time)
\ No newline at end of file
+        super().access(resp, req, environ, request_time)
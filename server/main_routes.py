@@ -1,8 +1,17 @@
 from flask import Blueprint, request, abort, Response, render_template, url_for, session, current_app, redirect
 from .extensions import db
-from .models import DownloadToken
-from .utils import get_fernet
+from .models import DownloadToken, DOWNLOAD_WINDOW
+from .utils import tlscrypt_stats, template_index_stats
+from .keypool import keypool_stats
+from .issuance import issuance_stats, issuance_job_status, PENDING_STATUSES
+from .speculation import speculation_stats
+from .reload import reload_stats
+from .sweeper import sweeper_stats
+from .payload import decrypt_profile, payload_stats
+from .payload_store import get_payload_store
 from cryptography.fernet import InvalidToken
+from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime, timezone
 
 main_bp = Blueprint('main', __name__)
 
@@ -19,39 +28,73 @@ def index():
 @main_bp.route('/download-landing/<token>')
 def download_landing(token):
     download_url = url_for('main.download', token=token)
-    return render_template('download_landing.html', download_url=download_url)
+    status_url = url_for('main.download_status', token=token)
+    return render_template('download_landing.html', download_url=download_url, status_url=status_url)
+
+@main_bp.route('/download/status/<token>')
+def download_status(token):
+    """Reports whether a token's profile is ready, for the landing page and CLI client to poll."""
+    token_record = db.session.query(DownloadToken).filter_by(token=token).first()
+    if token_record is None:
+        return {"status": "unknown"}, 404
+    return {"status": issuance_job_status(token_record)}, 200
+
+def download_refusal(token_str: str) -> tuple[int, str]:
+    """Works out why a token could not be claimed for download. Returns the status code and message."""
+    token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
+    if token_record is None:
+        return 403, "Invalid download token."
+    if token_record.is_download_window_expired():
+        if token_record.downloadable:
+            token_record.downloadable = False
+            get_payload_store().discard(token_str)
+            db.session.commit()
+        return 403, "Download token has expired."
+    if token_record.collected:
+        return 403, "This download token has already been used."
+    if token_record.status in PENDING_STATUSES:
+        return 409, "This configuration file is still being generated."
+    return 403, "This token is not available for download."
 
 @main_bp.route('/download')
 def download():
-    fernet = get_fernet()
     token_str = request.args.get('token')
     if not token_str:
         abort(401, "Missing download token.")
 
-    token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
-    if token_record is None:
-        abort(403, "Invalid download token.")
+    # Claim the token with one conditional UPDATE. However many requests race
+    # for the same token, exactly one of them matches the row, and a normal
+    # download needs no SELECT first. The claim is only committed once the
+    # profile has been decrypted; if anything fails before then, the payload
+    # is put back so the token can still be downloaded.
+    claimed = db.session.query(DownloadToken).filter(
+        DownloadToken.token == token_str,
+        DownloadToken.collected == False,
+        DownloadToken.downloadable == True,
+        DownloadToken.status == 'ready',
+        DownloadToken.created_at > datetime.now(timezone.utc) - DOWNLOAD_WINDOW,
+    ).update({"collected": True, "downloadable": False}, synchronize_session=False)
+    if claimed != 1:
+        db.session.rollback()
+        abort(*download_refusal(token_str))
 
-    if token_record.is_download_window_expired():
-        token_record.downloadable = False
-        token_record.ovpn_content = None
-        db.session.commit()
-        abort(403, "Download token has expired.")
-
-    if token_record.collected:
-        abort(403, "This download token has already been used.")
-    if not token_record.downloadable:
+    store = get_payload_store()
+    encrypted_ovpn_content = store.take(token_str)
+    if encrypted_ovpn_content is None:
+        # Expired out of the store before its token did
+        db.session.rollback()
         abort(403, "This token is not available for download.")
-
     try:
-        decrypted_ovpn_content = fernet.decrypt(token_record.ovpn_content)
-    except (InvalidToken, TypeError):
+        decrypted_ovpn_content = decrypt_profile(encrypted_ovpn_content)
+        db.session.commit()
+    except (InvalidToken, TypeError, ValueError):
+        db.session.rollback()
+        store.restore(token_str, encrypted_ovpn_content)
         abort(500, "Failed to decrypt configuration data.")
-
-    token_record.collected = True
-    token_record.downloadable = False
-    token_record.ovpn_content = None
-    db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        store.restore(token_str, encrypted_ovpn_content)
+        raise
 
     return Response(
         decrypted_ovpn_content,
@@ -66,4 +109,9 @@ def error_page():
 
 @main_bp.route('/healthz')
 def healthz():
-    return {"status": "ok"}, 200
\ No newline at end of file
+    return {"status": "ok"}, 200
+
+@main_bp.route('/metrics')
+def metrics():
+    """Exposes this worker's issuance counters as JSON."""
+    return {"keypool": keypool_stats(), "issuance": issuance_stats(), "speculation": speculation_stats(), "tlscrypt": tlscrypt_stats(), "templates": template_index_stats(), "reload": reload_stats(), "payload": payload_stats(), "sweeper": sweeper_stats()}, 200
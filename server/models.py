@@ -1,6 +1,9 @@
 from datetime import datetime, timezone, timedelta
 from .extensions import db
 
+# How long an issued profile can be downloaded for
+DOWNLOAD_WINDOW = timedelta(minutes=5)
+
 class DownloadToken(db.Model):
     __tablename__ = 'download_tokens'
     id = db.Column(db.Integer, primary_key=True)
@@ -9,17 +12,52 @@ class DownloadToken(db.Model):
     cn = db.Column(db.String(255), nullable=True, index=True)
     requester_ip = db.Column(db.String(45), nullable=True)
     requester_user_agent = db.Column(db.Text, nullable=True)
-    cert_expiry = db.Column(db.DateTime(timezone=True), nullable=True)
+    cert_expiry = db.Column(db.DateTime(timezone=True), nullable=True, index=True)
     user_agent_string = db.Column(db.String(255), nullable=True)
     detected_os = db.Column(db.String(50), nullable=True)
     optionset_used = db.Column(db.String(255), nullable=True)
-    ovpn_content = db.Column(db.LargeBinary, nullable=True)
+    # 'ready' once a profile has been issued, 'awaiting_csr' while a CLI client is expected to POST its CSR
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready')
+    # Fernet-encrypted JSON of what is needed to finish issuance later (userinfo, optionset)
+    issuance_context = db.Column(db.LargeBinary, nullable=True)
+    # When an issuance worker claimed the job, so jobs left by a dead worker can be reclaimed
+    claimed_at = db.Column(db.DateTime(timezone=True), nullable=True)
     downloadable = db.Column(db.Boolean, nullable=False, default=True)
     collected = db.Column(db.Boolean, nullable=False, default=False)
-    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc), index=True)
+
+    # Only a small fraction of the table is ever downloadable, so the admin
+    # "downloadable" filter is served by a partial index of just those rows
+    __table_args__ = (
+        db.Index(
+            'ix_download_tokens_downloadable_created_at', 'created_at',
+            postgresql_where=db.text('downloadable AND NOT collected'),
+            sqlite_where=db.text('downloadable = 1 AND collected = 0'),
+        ),
+    )
 
     def is_download_window_expired(self):
         created_at_utc = self.created_at
         if created_at_utc.tzinfo is None:
             created_at_utc = created_at_utc.replace(tzinfo=timezone.utc)
-        return datetime.now(timezone.utc) > created_at_utc + timedelta(minutes=5)
+        return datetime.now(timezone.utc) > created_at_utc + DOWNLOAD_WINDOW
+
+class PregeneratedKey(db.Model):
+    """A device private key generated ahead of time and shared between all workers."""
+    __tablename__ = 'pregenerated_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    key_type = db.Column(db.String(32), nullable=False, index=True)
+    encrypted_key = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+class DownloadPayload(db.Model):
+    """
+    An encrypted profile waiting to be downloaded, kept apart from the audit
+    row in download_tokens and deleted when it is collected. It is matched to
+    its token by value rather than by a foreign key.
+    """
+    __tablename__ = 'download_payloads'
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(36), unique=True, nullable=False, index=True)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc), index=True)
@@ -0,0 +1,200 @@
+import os
+import re
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import text
+from .extensions import db
+from .models import DownloadToken
+
+PARTITION_INTERVALS = {"daily": timedelta(days=1), "weekly": timedelta(weeks=1)}
+
+TABLE = DownloadToken.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+# How Postgres describes a range partition's bounds, e.g.
+# FOR VALUES FROM ('2026-10-17 00:00:00+00') TO ('2026-10-18 00:00:00+00')
+BOUND_PATTERN = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+def partition_start(moment: datetime, interval: timedelta) -> datetime:
+    """The start of the partition a time falls in: midnight UTC, on a Monday for weekly partitions."""
+    start = moment.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == PARTITION_INTERVALS["weekly"]:
+        start -= timedelta(days=start.weekday())
+    return start
+
+def partition_name(start: datetime) -> str:
+    return f"{TABLE}_p{start:%Y%m%d}"
+
+def is_partitioned() -> bool:
+    """Whether download_tokens is a partitioned table. Always False except on Postgres."""
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return False
+    return bool(db.session.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"),
+        {"table": TABLE},
+    ).scalar())
+
+def list_partitions() -> list[tuple[str, datetime, datetime]]:
+    """Returns the (name, from, to) of each range partition, oldest first. The default partition is left out."""
+    rows = db.session.execute(text(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(:table)"
+    ), {"table": TABLE}).all()
+    partitions = []
+    for name, bound in rows:
+        match = BOUND_PATTERN.search(bound or "")
+        if match:
+            partitions.append((name, datetime.fromisoformat(match[1]), datetime.fromisoformat(match[2])))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def create_partitions(interval: timedelta, first: datetime, last: datetime) -> list[str]:
+    """
+    Creates any missing partitions covering first to last. Returns the names
+    of those created. Rows the default partition took in the meantime (while
+    maintenance was not running) are moved into the new partitions, which
+    Postgres would otherwise refuse to create.
+    """
+    existing = list_partitions()
+    created = []
+    lower = partition_start(first, interval)
+    while lower <= last:
+        upper = lower + interval
+        if not any(start < upper and lower < end for _, start, end in existing):
+            name = partition_name(lower)
+            if _default_partition_has_rows(lower, upper):
+                _create_partition_from_default(name, lower, upper)
+            else:
+                _create_partition(name, lower, upper)
+            created.append(name)
+        lower = upper
+    return created
+
+def _create_partition(name: str, lower: datetime, upper: datetime):
+    # The bounds are times formatted here, never user input. They are
+    # sent as is, as text() would take the colons in them for parameters.
+    db.session.connection().exec_driver_sql(
+        f'CREATE TABLE "{name}" PARTITION OF {TABLE} '
+        f"FOR VALUES FROM ('{lower.isoformat(sep=' ')}') TO ('{upper.isoformat(sep=' ')}')"
+    )
+
+def _default_partition_has_rows(lower: datetime, upper: datetime) -> bool:
+    if db.session.execute(text("SELECT to_regclass(:name)"), {"name": DEFAULT_PARTITION}).scalar() is None:
+        return False
+    return bool(db.session.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper)"),
+        {"lower": lower, "upper": upper},
+    ).scalar())
+
+def _create_partition_from_default(name: str, lower: datetime, upper: datetime) -> int:
+    """
+    Creates a partition for a range the default partition holds rows in, by
+    detaching the default partition, creating the new one, moving the rows
+    across and attaching the default partition again. Detaching locks the
+    table until the transaction ends. Returns the number of rows moved.
+    """
+    bounds = {"lower": lower, "upper": upper}
+    in_range = "created_at >= :lower AND created_at < :upper"
+    db.session.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}"))
+    _create_partition(name, lower, upper)
+    moved = db.session.execute(text(f'INSERT INTO "{name}" SELECT * FROM {DEFAULT_PARTITION} WHERE {in_range}'), bounds).rowcount
+    db.session.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}"), bounds)
+    db.session.execute(text(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    return moved
+
+def drop_partitions_before(threshold: datetime) -> tuple[list[str], int]:
+    """
+    Detaches and drops every partition whose rows are all older than the
+    threshold, a partition per transaction. Returns the names dropped and
+    the planner's estimate of the rows they held.
+    """
+    dropped, rows = [], 0
+    for name, _, upper in list_partitions():
+        if upper > threshold:
+            continue
+        rows += max(0, int(db.session.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"), {"name": name}
+        ).scalar() or 0))
+        db.session.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION "{name}"'))
+        db.session.execute(text(f'DROP TABLE "{name}"'))
+        db.session.commit()
+        dropped.append(name)
+    return dropped, rows
+
+def drop_default_partition_rows(threshold: datetime) -> int:
+    """
+    Deletes old rows from the default partition, which only holds rows
+    created while no partition covered their time. Returns how many.
+    """
+    deleted = db.session.execute(
+        text(f"DELETE FROM {DEFAULT_PARTITION} WHERE created_at < :threshold"), {"threshold": threshold}
+    ).rowcount
+    db.session.commit()
+    return deleted
+
+def maintain_partitions(threshold: datetime, ahead: int | None = None) -> dict:
+    """
+    Creates partitions for the next `ahead` intervals (TOKEN_PARTITIONS_AHEAD,
+    default 7) and drops those wholly older than the threshold. The interval
+    is that of the newest existing partition.
+    """
+    if ahead is None:
+        ahead = int(os.getenv("TOKEN_PARTITIONS_AHEAD", "7"))
+    partitions = list_partitions()
+    interval = partitions[-1][2] - partitions[-1][1] if partitions else PARTITION_INTERVALS["daily"]
+    now = datetime.now(timezone.utc)
+    created = create_partitions(interval, now, now + interval * ahead)
+    db.session.commit()
+    dropped, rows = drop_partitions_before(threshold)
+    return {"created": created, "dropped": dropped, "rows": rows}
+
+def partition_table(interval_name: str, ahead: int = 7) -> dict:
+    """
+    Converts download_tokens into a table range partitioned by created_at, in
+    one transaction holding an exclusive lock on the table while its rows are
+    copied. Partitioned tables need the partition key in every unique index,
+    so the primary key becomes (id, created_at) and the unique token index
+    becomes (token, created_at). A default partition catches any row no
+    partition covers.
+    """
+    if interval_name not in PARTITION_INTERVALS:
+        raise RuntimeError(f"Unsupported partition interval '{interval_name}', expected one of {tuple(PARTITION_INTERVALS)}.")
+    if db.session.get_bind().dialect.name != 'postgresql':
+        raise RuntimeError("Partitioning download_tokens needs PostgreSQL.")
+    if is_partitioned():
+        raise RuntimeError(f"{TABLE} is already partitioned.")
+    interval = PARTITION_INTERVALS[interval_name]
+    old_table = f"{TABLE}_unpartitioned"
+
+    db.session.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+    sequence = db.session.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": TABLE}).scalar()
+    oldest = db.session.execute(text(f"SELECT min(created_at) FROM {TABLE}")).scalar()
+    db.session.execute(text(f"ALTER TABLE {TABLE} RENAME TO {old_table}"))
+    if sequence:
+        # Otherwise the id sequence would be dropped along with the old table
+        db.session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+    db.session.execute(text(
+        f"CREATE TABLE {TABLE} (LIKE {old_table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) "
+        "PARTITION BY RANGE (created_at)"
+    ))
+    db.session.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"))
+    now = datetime.now(timezone.utc)
+    partitions = create_partitions(interval, oldest or now, now + interval * ahead)
+    rows = db.session.execute(text(f"INSERT INTO {TABLE} SELECT * FROM {old_table}")).rowcount
+    db.session.execute(text(f"DROP TABLE {old_table}"))
+    if sequence:
+        db.session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id"))
+
+    # Recreate the model's indexes, now that their names are free again
+    db.session.execute(text(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, created_at)"))
+    for index in DownloadToken.__table__.indexes:
+        columns = [column.name for column in index.columns]
+        if index.unique and 'created_at' not in columns:
+            columns.append('created_at')
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        where = index.dialect_options['postgresql']['where']
+        db.session.execute(text(
+            f"CREATE {'UNIQUE ' if index.unique else ''}INDEX {index.name} ON {TABLE} ({column_list})"
+            + (f" WHERE {where}" if where is not None else "")
+        ))
+    db.session.commit()
+    return {"rows": rows, "partitions": partitions}
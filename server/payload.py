@@ -0,0 +1,97 @@
+import os
+import zlib
+import threading
+from flask import Flask, current_app
+from .utils import get_fernet
+
+try:
+    import zstandard
+except ImportError:  # Optional: only needed for PROFILE_COMPRESSION=zstd
+    zstandard = None
+
+# A stored profile is the Fernet encryption of its encoded form. Profiles
+# stored before compression existed, or with PROFILE_COMPRESSION=none, are the
+# bare profile text. Compressed profiles start with a NUL byte, which never
+# starts an OVPN profile, followed by a format byte saying how they were
+# compressed. Rows in any of these formats can always be read back.
+FORMAT_MARKER = b"\x00"
+FORMAT_ZLIB = 1
+FORMAT_ZSTD = 2
+
+COMPRESSION_FORMATS = {"none": None, "zlib": FORMAT_ZLIB, "zstd": FORMAT_ZSTD}
+DEFAULT_COMPRESSION_LEVELS = {"zlib": 6, "zstd": 3}
+
+_stats_lock = threading.Lock()
+_stats = {"encoded": 0, "plain_bytes": 0, "stored_bytes": 0}
+
+def compress_profile(content: bytes, compression: str, level: int | None = None) -> bytes:
+    """Encodes a profile for storage with the given compression ('none', 'zlib' or 'zstd')."""
+    if compression not in COMPRESSION_FORMATS:
+        raise RuntimeError(f"Unsupported PROFILE_COMPRESSION '{compression}'.")
+    level = DEFAULT_COMPRESSION_LEVELS.get(compression) if level is None else level
+    if compression == "zlib":
+        return FORMAT_MARKER + bytes([FORMAT_ZLIB]) + zlib.compress(content, level)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("PROFILE_COMPRESSION=zstd needs the zstandard package.")
+        return FORMAT_MARKER + bytes([FORMAT_ZSTD]) + zstandard.ZstdCompressor(level=level).compress(content)
+    return content
+
+def decompress_profile(data: bytes) -> bytes:
+    """Decodes a stored profile in any of the formats. Raises ValueError if it cannot be decoded."""
+    if not data.startswith(FORMAT_MARKER):
+        return data
+    profile_format, body = data[1:2], data[2:]
+    try:
+        if profile_format == bytes([FORMAT_ZLIB]):
+            return zlib.decompress(body)
+        if profile_format == bytes([FORMAT_ZSTD]):
+            if zstandard is None:
+                raise ValueError("this profile is zstd compressed, which needs the zstandard package")
+            return zstandard.ZstdDecompressor().decompress(body)
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise ValueError(f"Stored profile could not be decompressed: {e}")
+    raise ValueError(f"Stored profile has an unknown format {profile_format!r}.")
+
+def encrypt_profile(content: str) -> bytes:
+    """Compresses (if configured) and encrypts a rendered profile for storage."""
+    plain = content.encode('utf-8')
+    encoded = compress_profile(
+        plain,
+        current_app.config.get("PROFILE_COMPRESSION", "none"),
+        current_app.config.get("PROFILE_COMPRESSION_LEVEL"),
+    )
+    encrypted = get_fernet().encrypt(encoded)
+    with _stats_lock:
+        _stats["encoded"] += 1
+        _stats["plain_bytes"] += len(plain)
+        _stats["stored_bytes"] += len(encrypted)
+    return encrypted
+
+def decrypt_profile(encrypted: bytes) -> bytes:
+    """
+    Decrypts and decompresses a stored profile. Raises InvalidToken or
+    TypeError if it cannot be decrypted, and ValueError if it cannot be decoded.
+    """
+    return decompress_profile(get_fernet().decrypt(encrypted))
+
+def payload_stats() -> dict:
+    """Returns this worker's stored profile size counters for the metrics endpoint."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["compression"] = current_app.config.get("PROFILE_COMPRESSION", "none")
+    stats["ratio"] = round(stats["stored_bytes"] / stats["plain_bytes"], 3) if stats["plain_bytes"] else None
+    stats["store"] = current_app.config.get("PAYLOAD_STORE", "table")
+    return stats
+
+def init_payload(app: Flask):
+    """
+    Reads how stored profiles are compressed from PROFILE_COMPRESSION (none,
+    zlib or zstd) and PROFILE_COMPRESSION_LEVEL. Stored profiles in every
+    format are readable whatever is configured.
+    """
+    app.config["PROFILE_COMPRESSION"] = os.getenv("PROFILE_COMPRESSION", "none").lower()
+    level = os.getenv("PROFILE_COMPRESSION_LEVEL")
+    app.config["PROFILE_COMPRESSION_LEVEL"] = int(level) if level else None
+    # Fail at startup rather than at the first issuance
+    compress_profile(b"", app.config["PROFILE_COMPRESSION"], app.config["PROFILE_COMPRESSION_LEVEL"])
@@ -0,0 +1,230 @@
+import os
+import re
+import threading
+import redis
+from datetime import datetime
+from flask import Flask, current_app
+from sqlalchemy import delete, func
+from .extensions import db
+from .models import DownloadPayload, DOWNLOAD_WINDOW
+
+PAYLOAD_STORES = ('table', 'filesystem', 'redis')
+
+# Tokens are UUIDs; anything else is refused before it gets near a file name
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9-]{1,36}")
+
+class TablePayloadStore:
+    """
+    Keeps payloads in the download_payloads table. Writes and deletes go
+    through the caller's session, so they are committed (or rolled back)
+    together with the change to the token's audit row.
+    """
+    name = 'table'
+
+    def put(self, token: str, payload: bytes):
+        db.session.add(DownloadPayload(token=token, payload=payload))  # type: ignore
+
+    def get(self, token: str) -> bytes | None:
+        return db.session.query(DownloadPayload.payload).filter_by(token=token).scalar()
+
+    def take(self, token: str) -> bytes | None:
+        """Returns a payload and deletes it, or None if there is none to take."""
+        if db.session.get_bind().dialect.delete_returning:
+            # One DELETE ... RETURNING, on Postgres and SQLite 3.35+
+            return db.session.execute(
+                delete(DownloadPayload).where(DownloadPayload.token == token).returning(DownloadPayload.payload)
+            ).scalar()
+        payload = self.get(token)
+        if payload is not None:
+            self.discard(token)
+        return payload
+
+    def restore(self, token: str, payload: bytes):
+        """Puts back a taken payload. The caller's rollback already undid the delete."""
+
+    def discard(self, token: str):
+        db.session.query(DownloadPayload).filter_by(token=token).delete(synchronize_session=False)
+
+    def purge(self, before: datetime, batch_size: int = 500) -> dict:
+        """
+        Deletes payloads written before a time, oldest first, `batch_size`
+        rows per transaction, so no one transaction holds locks on more than
+        a batch. Unlike the other writes, each batch is committed here.
+        Returns how many were deleted, and their size.
+        """
+        purged = {"payloads": 0, "bytes": 0}
+        while True:
+            rows = db.session.query(DownloadPayload.id, func.length(DownloadPayload.payload)).filter(
+                DownloadPayload.created_at < before
+            ).order_by(DownloadPayload.created_at).limit(batch_size).all()
+            if not rows:
+                break
+            db.session.query(DownloadPayload).filter(
+                DownloadPayload.id.in_([row_id for row_id, _ in rows])
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            purged["payloads"] += len(rows)
+            purged["bytes"] += sum(length or 0 for _, length in rows)
+            if len(rows) < batch_size:
+                break
+        return purged
+
+    def size(self) -> dict:
+        """Returns how many payloads are stored, and their total size."""
+        count, total = db.session.query(func.count(DownloadPayload.id), func.coalesce(func.sum(func.length(DownloadPayload.payload)), 0)).one()
+        return {"payloads": count, "bytes": int(total)}
+
+class FilesystemPayloadStore:
+    """
+    Keeps each payload in its own file, readable only by this user, in a
+    directory shared by every worker. Files are written to a temporary name
+    and renamed into place, and taken by renaming them away first, so a
+    payload is only ever handed to one request.
+    """
+    name = 'filesystem'
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def _file(self, token: str) -> str:
+        if not TOKEN_PATTERN.fullmatch(token or ""):
+            raise ValueError(f"Invalid payload token '{token}'.")
+        return os.path.join(self.path, f"{token}.payload")
+
+    def put(self, token: str, payload: bytes):
+        target = self._file(token)
+        temporary = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        os.replace(temporary, target)
+
+    def get(self, token: str) -> bytes | None:
+        try:
+            with open(self._file(token), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def take(self, token: str) -> bytes | None:
+        """Returns a payload and deletes it, or None if there is none to take."""
+        target = self._file(token)
+        claimed = f"{target}.{os.getpid()}.{threading.get_ident()}.claimed"
+        try:
+            os.rename(target, claimed)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(claimed, 'rb') as f:
+                return f.read()
+        finally:
+            os.unlink(claimed)
+
+    def restore(self, token: str, payload: bytes):
+        """Puts back a payload taken by a download that then failed."""
+        self.put(token, payload)
+
+    def discard(self, token: str):
+        try:
+            os.unlink(self._file(token))
+        except FileNotFoundError:
+            pass
+
+    def purge(self, before: datetime, batch_size: int = 500) -> dict:
+        """Deletes payloads written before a time. Returns how many were deleted, and their size."""
+        cutoff = before.timestamp()
+        purged = {"payloads": 0, "bytes": 0}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                    if entry.is_file() and stat.st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        purged["payloads"] += 1
+                        purged["bytes"] += stat.st_size
+                except FileNotFoundError:
+                    # Taken or purged by another worker in the meantime
+                    continue
+        return purged
+
+    def size(self) -> dict:
+        """Returns how many payloads are stored, and their total size."""
+        stored = {"payloads": 0, "bytes": 0}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stored["bytes"] += entry.stat().st_size
+                        stored["payloads"] += 1
+                except FileNotFoundError:
+                    continue
+        return stored
+
+class RedisPayloadStore:
+    """
+    Keeps payloads in Redis, written with SET EX so they expire on their own
+    when the download window closes, and claimed with GETDEL so only one
+    request can ever read each one. Nothing is left behind to purge.
+    """
+    name = 'redis'
+
+    def __init__(self, url: str, ttl: int, prefix: str = "ovpn-manager:payload:"):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def put(self, token: str, payload: bytes):
+        self.client.set(self.prefix + token, payload, ex=self.ttl)
+
+    def get(self, token: str) -> bytes | None:
+        return self.client.get(self.prefix + token)
+
+    def take(self, token: str) -> bytes | None:
+        """Returns a payload and deletes it, or None if there is none to take."""
+        return self.client.getdel(self.prefix + token)
+
+    def restore(self, token: str, payload: bytes):
+        """Puts back a payload taken by a download that then failed."""
+        self.put(token, payload)
+
+    def discard(self, token: str):
+        self.client.delete(self.prefix + token)
+
+    def purge(self, before: datetime, batch_size: int = 500) -> dict:
+        """Redis expires payloads itself, so there is never anything to purge."""
+        return {"payloads": 0, "bytes": 0}
+
+    def size(self) -> dict:
+        """Counting would mean scanning the keyspace, so the size is not reported."""
+        return {"payloads": None, "bytes": None}
+
+def get_payload_store():
+    """Returns the configured payload store, created on first use."""
+    store = current_app.config.get("payload_store")
+    if store is None:
+        if current_app.config["PAYLOAD_STORE"] == 'filesystem':
+            store = FilesystemPayloadStore(current_app.config["PAYLOAD_STORE_PATH"])
+        elif current_app.config["PAYLOAD_STORE"] == 'redis':
+            store = RedisPayloadStore(current_app.config["PAYLOAD_STORE_REDIS_URL"], int(DOWNLOAD_WINDOW.total_seconds()))
+        else:
+            store = TablePayloadStore()
+        current_app.config["payload_store"] = store
+    return store
+
+def init_payload_store(app: Flask):
+    """
+    Reads where encrypted profiles wait to be downloaded from PAYLOAD_STORE:
+    'table' (the download_payloads table, the default), 'filesystem' (files
+    under PAYLOAD_STORE_PATH, which every worker must share) or 'redis' (at
+    PAYLOAD_STORE_REDIS_URL, by default the rate limiter's Redis).
+    """
+    app.config["PAYLOAD_STORE"] = os.getenv("PAYLOAD_STORE", "table").lower()
+    if app.config["PAYLOAD_STORE"] not in PAYLOAD_STORES:
+        raise RuntimeError(f"Unsupported PAYLOAD_STORE '{app.config['PAYLOAD_STORE']}', expected one of {PAYLOAD_STORES}.")
+    app.config["PAYLOAD_STORE_PATH"] = os.getenv("PAYLOAD_STORE_PATH", os.path.join(app.instance_path, "payloads"))
+
+    ratelimit_url = os.getenv("RATELIMIT_STORAGE_URL", "")
+    app.config["PAYLOAD_STORE_REDIS_URL"] = os.getenv("PAYLOAD_STORE_REDIS_URL") or (ratelimit_url if ratelimit_url.startswith(("redis://", "rediss://")) else "")
+    if app.config["PAYLOAD_STORE"] == 'redis' and not app.config["PAYLOAD_STORE_REDIS_URL"]:
+        raise RuntimeError("PAYLOAD_STORE=redis needs PAYLOAD_STORE_REDIS_URL, or a redis:// RATELIMIT_STORAGE_URL.")
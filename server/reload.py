@@ -0,0 +1,207 @@
+import os
+import time
+import logging
+import threading
+from flask import Flask, current_app
+from cryptography.hazmat.primitives import serialization
+from .cert_utils import load_ca
+from .issuance import WORKER_CONFIG_KEYS
+from .utils import load_ovpn_templates, read_ovpn_optionsets, build_ovpn_template_environment, OvpnTemplateIndex
+
+log = logging.getLogger(__name__)
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # Optional: without it changes are found by polling alone
+    INotify = None
+
+def path_fingerprint(path: str | None):
+    """
+    Summarises the state of a watched file or directory, so that any change
+    gives a different value. A Kubernetes ConfigMap or Secret volume is
+    updated by atomically re-pointing its `..data` symlink at a new
+    timestamped directory, which changes the resolved paths even when the
+    file timestamps do not.
+    """
+    if not path:
+        return None
+    try:
+        if os.path.isdir(path):
+            data_link = os.path.join(path, '..data')
+            entries = []
+            for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                # Kubernetes' own ..data and ..<timestamp> entries are covered by the symlink target
+                if entry.name.startswith('..'):
+                    continue
+                stat = entry.stat()
+                entries.append((entry.name, os.path.realpath(entry.path), stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            return (os.path.realpath(data_link) if os.path.islink(data_link) else None, tuple(entries))
+        stat = os.stat(path)
+        return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    except OSError:
+        return None
+
+class ConfigReloader:
+    """
+    Watches the OVPN templates, optionsets and CA files, and rebuilds them in
+    a background thread when they change. Everything is loaded and compiled
+    before it is swapped into the app config, so requests never wait for a
+    reload and keep using the old configuration if the new one is broken.
+    """
+
+    def __init__(self, app: Flask, interval: float = 10.0):
+        self.app = app
+        self.interval = interval
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._fingerprints = self._current_fingerprints()
+
+    def _watched_paths(self) -> dict:
+        return {
+            "templates": (self.app.config.get("OVPN_TEMPLATES_PATH"), self.app.config.get("OVPNS_OPTIONSETS_PATH")),
+            "ca": (os.environ.get("CA_CERT_PATH"), os.environ.get("CA_KEY_PATH")),
+        }
+
+    def _current_fingerprints(self) -> dict:
+        return {group: tuple(path_fingerprint(p) for p in paths) for group, paths in self._watched_paths().items()}
+
+    def start(self):
+        """Starts the watcher thread in this process. Safe to call more than once (e.g. on every request)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            # Threads do not survive a fork, so each worker starts its own
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="config-reloader", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _open_inotify(self):
+        if INotify is None:
+            return None
+        inotify = INotify()
+        mask = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MOVED_TO |
+                inotify_flags.MOVED_FROM | inotify_flags.CLOSE_WRITE | inotify_flags.ATTRIB)
+        directories = set()
+        for paths in self._watched_paths().values():
+            for path in paths:
+                if path:
+                    directories.add(path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path)))
+        for directory in directories:
+            try:
+                inotify.add_watch(directory, mask)
+            except OSError as e:
+                log.warning("Cannot watch %s with inotify, relying on polling: %s", directory, e)
+        return inotify
+
+    def _run(self):
+        inotify = self._open_inotify()
+        log.info("Watching templates, optionsets and CA for changes (%s, every %ss).", 'inotify' if inotify else 'polling', self.interval)
+        while not self._stopped.is_set():
+            if inotify is not None:
+                # Wakes early on a change; the timeout keeps polling as a safety net
+                inotify.read(timeout=int(self.interval * 1000))
+            else:
+                self._stopped.wait(self.interval)
+            if not self._stopped.is_set():
+                self.check()
+
+    def check(self) -> list:
+        """Reloads whatever has changed since the last check. Returns the names of the reloaded groups."""
+        reloaded = []
+        with self._lock:
+            fingerprints = self._current_fingerprints()
+            for group, fingerprint in fingerprints.items():
+                if fingerprint == self._fingerprints.get(group):
+                    continue
+                try:
+                    getattr(self, f"_reload_{group}")()
+                except Exception as e:
+                    # Keep serving the old configuration; the next check tries again
+                    self.failures += 1
+                    log.error("Could not reload %s, keeping the current configuration: %s", group, e)
+                    continue
+                self._fingerprints[group] = fingerprint
+                self.reloads += 1
+                self.last_reload = time.time()
+                reloaded.append(group)
+                log.info("Reloaded %s.", group)
+        if reloaded:
+            self._restart_issuance_workers()
+        return reloaded
+
+    def _reload_templates(self):
+        app = self.app
+        templates = load_ovpn_templates(app)
+        if not any(tpl['group_name'] == 'default' for tpl in templates):
+            raise RuntimeError(f"no default template in '{app.config.get('OVPN_TEMPLATES_PATH')}'")
+        optionsets, optionset_headers = read_ovpn_optionsets(app)
+        if not optionsets:
+            raise RuntimeError(f"no optionsets in '{app.config.get('OVPNS_OPTIONSETS_PATH')}'")
+        environment = build_ovpn_template_environment(app, templates, optionsets)
+        index = OvpnTemplateIndex(templates, cache_size=app.config.get("OVPN_TEMPLATE_MATCH_CACHE_SIZE", 1024))
+
+        # Each key is swapped in a single assignment. The index and compiled
+        # environment go last: a request which sees new templates with the old
+        # ones builds fresh ones instead of using stale templates.
+        app.config["OVPNS_OPTIONSET_HEADERS"] = optionset_headers
+        app.config["OVPNS_OPTIONSETS"] = optionsets
+        app.config["OVPNS_TEMPLATES"] = templates
+        app.config['ovpn_template_index'] = index
+        app.config['ovpn_jinja_env'] = environment
+
+    def _reload_ca(self):
+        ca_cert, ca_key = load_ca(os.environ["CA_CERT_PATH"], os.environ["CA_KEY_PATH"])
+        # Guard against catching a non-atomic update half way through
+        public_format = (serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        if ca_cert.public_key().public_bytes(*public_format) != ca_key.public_key().public_bytes(*public_format):
+            raise RuntimeError("the CA certificate and key do not match")
+        self.app.config['ca_certs'] = (ca_cert, ca_key)
+
+    def _restart_issuance_workers(self):
+        executor = self.app.config.get('issuance_executor')
+        if executor is not None:
+            executor.reconfigure({key: self.app.config.get(key) for key in WORKER_CONFIG_KEYS})
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "watcher": "inotify" if INotify is not None else "polling",
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_reload": self.last_reload,
+        }
+
+def init_reload(app: Flask):
+    """
+    Starts watching the templates, optionsets and CA for changes when
+    CONFIG_RELOAD is enabled, checking at least every CONFIG_RELOAD_INTERVAL seconds.
+    """
+    app.config["CONFIG_RELOAD"] = os.getenv("CONFIG_RELOAD", "false").lower() in ["true", "1", "yes"]
+    app.config["CONFIG_RELOAD_INTERVAL"] = float(os.getenv("CONFIG_RELOAD_INTERVAL", "10"))
+    app.config['config_reloader'] = None
+    if not app.config["CONFIG_RELOAD"]:
+        return
+
+    reloader = ConfigReloader(app, interval=app.config["CONFIG_RELOAD_INTERVAL"])
+    app.config['config_reloader'] = reloader
+    reloader.start()
+    # Restarts the watcher in workers forked after create_app (gunicorn --preload)
+    app.before_request(reloader.start)
+
+def reload_stats() -> dict:
+    """Returns the reload counters for the metrics endpoint."""
+    reloader = current_app.config.get('config_reloader')
+    if reloader is None:
+        return {"enabled": False}
+    return reloader.stats()
@@ -37,7 +37,7 @@ class RunCommand:
         if env is not None and len(env) > 0:
             for env_item in env.keys():
                 self.running_env[env_item] = env[env_item]
-        self.logger.debug(f'exec: {" ".join(command)}')
+        self.logger.debug("exec: %s", " ".join(command))
         try:
             result = subprocess.run(
                 command,
@@ -58,12 +58,10 @@ class RunCommand:
             self.stderr = (e.stderr or "").splitlines()
 
         # If verbose mode is on, output the results and errors from the command execution
-        if len(self.stdout) > 0:
-            stdout = "\n".join(self.stdout)
-            self.logger.debug(f'stdout: {stdout}')
-        if len(self.stderr) > 0:
-            stderr = "\n".join(self.stderr)
-            self.logger.debug(f'stderr: {stderr}')
+        if len(self.stdout) > 0 and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("stdout: %s", "\n".join(self.stdout))
+        if len(self.stderr) > 0 and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("stderr: %s", "\n".join(self.stderr))
 
         # If it failed and we want to raise an exception on failure, record the command and args
         # then Raise Away!
@@ -0,0 +1,154 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, current_app
+from .cert_utils import generate_device_key
+from .utils import get_tlscrypt_key, select_ovpn_template, resolve_key_algorithm
+
+log = logging.getLogger(__name__)
+
+class SpeculativeIssuance:
+    """
+    Prepares the expensive, user-independent parts of an issuance (the device
+    key and the tls-crypt key material) while the user is away at the IdP.
+
+    Each speculation is keyed by an ID stored in the user's session. /auth
+    claims it if it is still fresh and was made for the key algorithm it ends
+    up needing; anything unclaimed after ``ttl`` seconds is discarded. The
+    store is per worker, so a login whose /auth lands on another worker just
+    misses and issues as normal.
+    """
+
+    def __init__(self, app: Flask, workers: int = 2, ttl: float = 120.0, max_pending: int = 100):
+        self.app = app
+        self.workers = max(1, workers)
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._executor = None
+        self._pid = None
+        self._stats = {"started": 0, "claimed": 0, "discarded": 0, "expired": 0, "skipped": 0}
+
+    def _get_executor(self):
+        # Threads do not survive a fork, so a worker starts its own executor.
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="speculative-keygen")
+            self._pending = {}
+            self._pid = os.getpid()
+        return self._executor
+
+    def _prepare(self, key_algorithm: str) -> dict:
+        # Speculation starts from the unauthenticated /login, so it generates
+        # its keys rather than draining the pools authenticated /auth relies on.
+        with self.app.app_context():
+            return {
+                "key_algorithm": key_algorithm,
+                "device_key": generate_device_key(key_algorithm),
+                "tlscrypt": get_tlscrypt_key(None, pooled=False),
+            }
+
+    def _expire(self, now: float):
+        """Drops speculations nobody came back for. Must be called with the lock held."""
+        for speculation_id, (future, created, _) in list(self._pending.items()):
+            if now - created > self.ttl:
+                future.cancel()
+                del self._pending[speculation_id]
+                self._stats["expired"] += 1
+
+    def start(self, key_algorithm: str) -> str | None:
+        """Starts preparing material for a login and returns its ID, or None if too many are pending."""
+        now = time.monotonic()
+        with self._lock:
+            executor = self._get_executor()
+            self._expire(now)
+            if len(self._pending) >= self.max_pending:
+                self._stats["skipped"] += 1
+                return None
+            speculation_id = str(uuid.uuid4())
+            self._pending[speculation_id] = (executor.submit(self._prepare, key_algorithm), now, key_algorithm)
+            self._stats["started"] += 1
+        return speculation_id
+
+    def claim(self, speculation_id: str | None, key_algorithm: str, timeout: float = 30.0) -> dict | None:
+        """
+        Takes the prepared material for a login, waiting for it if it is still
+        being generated. Returns None if there is nothing usable.
+        """
+        if not speculation_id:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._pending.pop(speculation_id, None)
+            if entry is not None and entry[2] != key_algorithm:
+                # The user's groups picked a template with another algorithm
+                entry[0].cancel()
+                self._stats["discarded"] += 1
+                entry = None
+        if entry is None:
+            return None
+
+        try:
+            prepared = entry[0].result(timeout=timeout)
+        except Exception as e:
+            log.warning("Speculative key generation failed: %s", e)
+            with self._lock:
+                self._stats["discarded"] += 1
+            return None
+
+        with self._lock:
+            self._stats["claimed"] += 1
+        return prepared
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return dict(self._stats, pending=len(self._pending))
+
+def init_speculation(app: Flask):
+    """
+    Sets up speculative key generation at /login from the environment. It is
+    off unless SPECULATIVE_KEYGEN is set.
+    """
+    app.config["SPECULATIVE_KEYGEN"] = os.getenv("SPECULATIVE_KEYGEN", "false").lower() in ["true", "1", "yes"]
+    app.config["SPECULATIVE_KEYGEN_WORKERS"] = int(os.getenv("SPECULATIVE_KEYGEN_WORKERS", "2"))
+    app.config["SPECULATIVE_KEYGEN_TTL"] = float(os.getenv("SPECULATIVE_KEYGEN_TTL", "120"))
+    app.config["SPECULATIVE_KEYGEN_MAX_PENDING"] = int(os.getenv("SPECULATIVE_KEYGEN_MAX_PENDING", "100"))
+    app.config['speculative_issuance'] = None
+    if app.config["SPECULATIVE_KEYGEN"]:
+        app.config['speculative_issuance'] = SpeculativeIssuance(
+            app,
+            workers=app.config["SPECULATIVE_KEYGEN_WORKERS"],
+            ttl=app.config["SPECULATIVE_KEYGEN_TTL"],
+            max_pending=app.config["SPECULATIVE_KEYGEN_MAX_PENDING"],
+        )
+
+def start_speculation(optionset_name: str) -> str | None:
+    """Starts preparing a login's key material if speculation is enabled. Returns the ID to keep in the session."""
+    speculative = current_app.config.get('speculative_issuance')
+    # Asynchronous issuance happens in another process, which could not claim it
+    if speculative is None or current_app.config.get("ISSUANCE_ASYNC"):
+        return None
+    # The user's groups are not known until /auth, so guess the default
+    # template's key algorithm; claim() discards the guess if it was wrong.
+    key_algorithm = resolve_key_algorithm(select_ovpn_template([]), optionset_name)
+    return speculative.start(key_algorithm)
+
+def claim_speculation(speculation_id: str | None, key_algorithm: str) -> dict | None:
+    """Claims a login's prepared key material, if there is any for this key algorithm."""
+    speculative = current_app.config.get('speculative_issuance')
+    if speculative is None:
+        return None
+    return speculative.claim(speculation_id, key_algorithm)
+
+def speculation_stats() -> dict:
+    """Returns the speculation counters for the metrics endpoint."""
+    speculative = current_app.config.get('speculative_issuance')
+    if speculative is None:
+        return {"enabled": False}
+    return dict(speculative.stats(), enabled=True)
@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from flask import Flask, current_app
+from sqlalchemy import text
+from .extensions import db
+from .models import DownloadToken, DownloadPayload, DOWNLOAD_WINDOW
+from .payload_store import get_payload_store
+
+log = logging.getLogger(__name__)
+
+_stats_lock = threading.Lock()
+_stats = {"runs": 0, "expired": 0, "payloads": 0, "bytes": 0, "last_run": None}
+
+def payload_store_size() -> dict:
+    """
+    Returns how many payloads the store holds and their size. For the table
+    store on Postgres, also the size of the table on disk, which only shrinks
+    once vacuum has reused the space.
+    """
+    store = get_payload_store()
+    size = store.size()
+    if store.name == 'table' and db.session.get_bind().dialect.name == 'postgresql':
+        size["table_bytes"] = db.session.execute(
+            text("SELECT pg_total_relation_size(:table)"), {"table": DownloadPayload.__tablename__}
+        ).scalar()
+    return size
+
+def sweep_expired_payloads(batch_size: int = 500) -> dict:
+    """
+    Marks tokens whose download window has closed without a download as no
+    longer downloadable, `batch_size` rows per transaction, found through the
+    partial index of downloadable rows. Then deletes payloads older than the
+    download window, which can no longer be downloaded, from the payload
+    store, also `batch_size` at a time. Returns how many tokens expired, how many payloads were deleted
+    and their size, and the size of the store afterwards.
+    """
+    cutoff = datetime.now(timezone.utc) - DOWNLOAD_WINDOW
+    expired = 0
+    while True:
+        ids = [row_id for (row_id,) in db.session.query(DownloadToken.id).filter(
+            DownloadToken.downloadable == True, DownloadToken.collected == False, DownloadToken.created_at < cutoff
+        ).order_by(DownloadToken.created_at).limit(batch_size)]
+        if not ids:
+            break
+        db.session.query(DownloadToken).filter(DownloadToken.id.in_(ids)).update({"downloadable": False}, synchronize_session=False)
+        db.session.commit()
+        expired += len(ids)
+        if len(ids) < batch_size:
+            break
+
+    purged = get_payload_store().purge(cutoff, batch_size)
+    stored = payload_store_size()
+
+    with _stats_lock:
+        _stats["runs"] += 1
+        _stats["expired"] += expired
+        _stats["payloads"] += purged["payloads"]
+        _stats["bytes"] += purged["bytes"]
+        _stats["last_run"] = time.time()
+    return {"expired": expired, "payloads": purged["payloads"], "bytes": purged["bytes"], "stored": stored}
+
+class PayloadSweeper:
+    """
+    Runs sweep_expired_payloads every `interval` seconds in a background
+    thread, so profiles nobody collected are deleted as soon as their download
+    window closes rather than at the next token cleanup.
+    """
+
+    def __init__(self, app: Flask, interval: float = 60.0, batch_size: int = 500):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Starts the sweeper thread in this process. Safe to call more than once (e.g. on every request)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            # Threads do not survive a fork, so each worker starts its own
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="payload-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    result = sweep_expired_payloads(self.batch_size)
+                    if result["expired"] or result["payloads"]:
+                        log.info("Expired %s tokens and deleted %s payloads (%s bytes); %s payloads (%s bytes) remain.",
+                                 result["expired"], result["payloads"], result["bytes"],
+                                 result["stored"]["payloads"], result["stored"]["bytes"])
+                except Exception as e:
+                    db.session.rollback()
+                    log.error("Payload sweep failed: %s", e)
+                finally:
+                    db.session.remove()
+
+def init_sweeper(app: Flask):
+    """
+    Starts the in-process payload sweeper when PAYLOAD_SWEEP_INTERVAL (seconds)
+    is set. Otherwise `flask tokens sweep` can be run on a schedule instead.
+    """
+    app.config["PAYLOAD_SWEEP_INTERVAL"] = float(os.getenv("PAYLOAD_SWEEP_INTERVAL", "0"))
+    app.config["PAYLOAD_SWEEP_BATCH_SIZE"] = int(os.getenv("PAYLOAD_SWEEP_BATCH_SIZE", "500"))
+    if app.config["PAYLOAD_SWEEP_INTERVAL"] <= 0:
+        return
+
+    sweeper = PayloadSweeper(app, app.config["PAYLOAD_SWEEP_INTERVAL"], app.config["PAYLOAD_SWEEP_BATCH_SIZE"])
+    app.config['payload_sweeper'] = sweeper
+    sweeper.start()
+    # Restarts the sweeper in workers forked after create_app (gunicorn --preload)
+    app.before_request(sweeper.start)
+
+def sweeper_stats() -> dict:
+    """Returns this worker's sweep counters for the metrics endpoint."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["enabled"] = current_app.config.get('payload_sweeper') is not None
+    return stats
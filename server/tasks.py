@@ -1,8 +1,7 @@
 from flask import Blueprint
 import os
-from datetime import datetime, timezone, timedelta
 from .extensions import db, limiter
-from .models import DownloadToken
+from .cleanup import cleanup_threshold, cleanup_tokens as delete_old_tokens
 
 tasks_bp = Blueprint('tasks', __name__)
 
@@ -11,17 +10,18 @@ tasks_bp = Blueprint('tasks', __name__)
 def cleanup_tokens():
     """
     A dedicated endpoint for PERMANENTLY DELETING old token records.
-    This should be called periodically by a scheduler like a Kubernetes CronJob.
+    `flask tokens cleanup` does the same without going through HTTP, and is
+    what the Kubernetes CronJob runs.
     """
     token_lifetime_hours = int(os.getenv("TOKEN_LIFETIME_HOURS", "24"))
-    cleanup_threshold = datetime.now(timezone.utc) - timedelta(hours=token_lifetime_hours)
     
     try:
-        num_deleted = db.session.query(DownloadToken).filter(
-            DownloadToken.created_at < cleanup_threshold
-        ).delete()
-        db.session.commit()
-        return {"message": f"Cleanup successful. Deleted {num_deleted} records older than {token_lifetime_hours} hours."}, 200
+        result = delete_old_tokens(
+            cleanup_threshold(token_lifetime_hours),
+            batch_size=int(os.getenv("CLEANUP_BATCH_SIZE", "1000")),
+            time_budget=float(os.getenv("CLEANUP_TIME_BUDGET", "30")),
+        )
+        return {"message": f"Cleanup successful. Deleted {result['deleted']} records older than {token_lifetime_hours} hours."}, 200
     except Exception as e:
         db.session.rollback()
-        return {"message": "An error occurred during cleanup.", "error": str(e)}, 500
\ No newline at end of file
+        return {"message": "An error occurred during cleanup.", "error": str(e)}, 500
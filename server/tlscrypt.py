@@ -0,0 +1,118 @@
+import os
+import hmac
+import time
+import base64
+import struct
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hmac as crypto_hmac
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# tls-crypt-v2 client key wrapping, as implemented by OpenVPN's
+# `openvpn --genkey tls-crypt-v2-client` (see doc/tls-crypt-v2.txt and
+# src/openvpn/tls_crypt.c in the OpenVPN sources):
+#
+#   Kc  = 256 random bytes (two 128 byte "struct key"s)
+#   len = 2 byte, big endian length of WKc
+#   T   = HMAC-SHA256(Ka, len || Kc || metadata)
+#   WKc = T || AES-256-CTR(Ke, IV=T[:16], Kc || metadata) || len
+#
+# and the client key file is the PEM encoding of Kc || WKc. Ke and Ka are
+# the first 32 bytes of the cipher and HMAC halves of the 128 byte server key.
+
+SERVER_KEY_PEM_NAME = "OpenVPN tls-crypt-v2 server key"
+CLIENT_KEY_PEM_NAME = "OpenVPN tls-crypt-v2 client key"
+
+SERVER_KEY_LENGTH = 128
+CLIENT_KEY_LENGTH = 256
+TAG_LENGTH = 32
+MAX_WKC_LENGTH = 1024
+MAX_METADATA_LENGTH = MAX_WKC_LENGTH - CLIENT_KEY_LENGTH - TAG_LENGTH - 2
+
+METADATA_TYPE_USER = 0x00
+METADATA_TYPE_TIMESTAMP = 0x01
+
+def pem_decode(content: str, name: str) -> bytes:
+    """Decodes an OpenVPN PEM block with the given name. Raises ValueError if there is none."""
+    begin, end = f"-----BEGIN {name}-----", f"-----END {name}-----"
+    start = content.find(begin)
+    finish = content.find(end, start)
+    if start == -1 or finish == -1:
+        raise ValueError(f"No '{name}' PEM block found.")
+    body = "".join(content[start + len(begin):finish].split())
+    try:
+        return base64.b64decode(body, validate=True)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid '{name}' PEM data: {e}")
+
+def pem_encode(data: bytes, name: str) -> str:
+    """Encodes data as a PEM block in the 64 column layout OpenVPN writes."""
+    body = base64.b64encode(data).decode('ascii')
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return "\n".join([f"-----BEGIN {name}-----", *lines, f"-----END {name}-----"])
+
+def load_server_key(server_key_pem: str) -> tuple[bytes, bytes]:
+    """Returns the (encryption, authentication) keys from a tls-crypt-v2 server key file."""
+    server_key = pem_decode(server_key_pem, SERVER_KEY_PEM_NAME)
+    if len(server_key) != SERVER_KEY_LENGTH:
+        raise ValueError(f"tls-crypt-v2 server key is {len(server_key)} bytes, expected {SERVER_KEY_LENGTH}.")
+    half = SERVER_KEY_LENGTH // 2
+    return server_key[:32], server_key[half:half + 32]
+
+def timestamp_metadata(timestamp: int | None = None) -> bytes:
+    """The metadata `openvpn --genkey tls-crypt-v2-client` adds when none is given."""
+    return bytes([METADATA_TYPE_TIMESTAMP]) + struct.pack(">q", int(time.time() if timestamp is None else timestamp))
+
+def _tag(auth_key: bytes, net_len: bytes, client_key: bytes, metadata: bytes) -> bytes:
+    mac = crypto_hmac.HMAC(auth_key, hashes.SHA256())
+    mac.update(net_len + client_key + metadata)
+    return mac.finalize()
+
+def _ctr(encryption_key: bytes, tag: bytes, data: bytes) -> bytes:
+    # CTR mode is its own inverse, so this both encrypts and decrypts
+    cipher = Cipher(algorithms.AES(encryption_key), modes.CTR(tag[:16]))
+    context = cipher.encryptor()
+    return context.update(data) + context.finalize()
+
+def wrap_client_key(server_key_pem: str, client_key: bytes | None = None, metadata: bytes | None = None) -> str:
+    """
+    Generates (unless one is given) and wraps a tls-crypt-v2 client key with
+    the server key, returning the client key file contents. Without metadata
+    the current time is used, as the openvpn binary does.
+    """
+    encryption_key, auth_key = load_server_key(server_key_pem)
+    client_key = os.urandom(CLIENT_KEY_LENGTH) if client_key is None else client_key
+    metadata = timestamp_metadata() if metadata is None else metadata
+    if len(client_key) != CLIENT_KEY_LENGTH:
+        raise ValueError(f"tls-crypt-v2 client key must be {CLIENT_KEY_LENGTH} bytes.")
+    if len(metadata) > MAX_METADATA_LENGTH:
+        raise ValueError(f"tls-crypt-v2 metadata must be at most {MAX_METADATA_LENGTH} bytes.")
+
+    net_len = struct.pack(">H", TAG_LENGTH + CLIENT_KEY_LENGTH + len(metadata) + 2)
+    tag = _tag(auth_key, net_len, client_key, metadata)
+    wrapped_key = tag + _ctr(encryption_key, tag, client_key + metadata) + net_len
+    return pem_encode(client_key + wrapped_key, CLIENT_KEY_PEM_NAME)
+
+def unwrap_client_key(server_key_pem: str, client_key_pem: str) -> tuple[bytes, bytes]:
+    """
+    Unwraps a tls-crypt-v2 client key file with the server key, the way the
+    server does when a client connects. Returns (client key, metadata), and
+    raises ValueError if the key was not wrapped with this server key.
+    """
+    encryption_key, auth_key = load_server_key(server_key_pem)
+    data = pem_decode(client_key_pem, CLIENT_KEY_PEM_NAME)
+    client_key, wrapped_key = data[:CLIENT_KEY_LENGTH], data[CLIENT_KEY_LENGTH:]
+    if len(client_key) != CLIENT_KEY_LENGTH or len(wrapped_key) < TAG_LENGTH + CLIENT_KEY_LENGTH + 2:
+        raise ValueError("tls-crypt-v2 client key is truncated.")
+
+    net_len = wrapped_key[-2:]
+    if struct.unpack(">H", net_len)[0] != len(wrapped_key):
+        raise ValueError("tls-crypt-v2 wrapped key length does not match.")
+    tag = wrapped_key[:TAG_LENGTH]
+    plaintext = _ctr(encryption_key, tag, wrapped_key[TAG_LENGTH:-2])
+    unwrapped_key, metadata = plaintext[:CLIENT_KEY_LENGTH], plaintext[CLIENT_KEY_LENGTH:]
+
+    if not hmac.compare_digest(tag, _tag(auth_key, net_len, unwrapped_key, metadata)):
+        raise ValueError("tls-crypt-v2 client key was not wrapped with this server key.")
+    if unwrapped_key != client_key:
+        raise ValueError("tls-crypt-v2 client key does not match its wrapped copy.")
+    return unwrapped_key, metadata
@@ -1,8 +1,12 @@
 import os
 import jinja2
+import functools
+import logging
+import threading
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from cryptography.fernet import Fernet
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
 from flask import Flask, current_app
 from typing import Union, Dict, Any, List
 from .extensions import oauth
@@ -10,14 +14,16 @@ from authlib.oidc.core.claims import UserInfo
 from .runcommand import RunCommand
 
 def get_fernet():
-    """Gets the Fernet instance, creating it if it doesn't exist on the app context."""
+    """
+    Gets the key ring used to encrypt data at rest, creating it if it doesn't
+    exist on the app context. Like Fernet it has encrypt() and decrypt(), and
+    raises InvalidToken for data it cannot decrypt.
+    """
     # Use a key on the app config to cache the object per-app-instance
     if 'fernet_instance' not in current_app.config:
-        try:
-            encryption_key = os.environ["ENCRYPTION_KEY"]
-            current_app.config['fernet_instance'] = Fernet(encryption_key.encode('utf-8'))
-        except KeyError:
-            raise RuntimeError("ENCRYPTION_KEY must be set for data encryption.")
+        # Local import to prevent circular dependencies at startup
+        from .keyring import load_keyring
+        current_app.config['fernet_instance'] = load_keyring()
     return current_app.config['fernet_instance']
 
 def get_oidc_client():
@@ -44,47 +50,171 @@ def get_ca_certs():
             raise RuntimeError("CA_CERT_PATH and CA_KEY_PATH must be set and valid")
     return current_app.config['ca_certs']
 
-def get_tlscrypt_key(device_cert: str) -> tuple[int | None, str | None]:
+# Per-worker cache of the tls-crypt key file: path -> (file signature, key type, content, V2 client key pool)
+_tlscrypt_cache = {}
+_tlscrypt_cache_lock = threading.Lock()
+
+def _tlscrypt_file_signature(path: str) -> tuple:
+    """Identifies a version of the key file. A Kubernetes secret update swaps the file, which changes all of these."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise RuntimeError(f"TLSCRYPT_KEY_PATH '{path}' does not exist")
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def _load_tlscrypt_key(path: str) -> tuple:
+    """Returns the cached (key type, content, pool) for the key file, re-reading it if it has changed."""
+    signature = _tlscrypt_file_signature(path)
+    with _tlscrypt_cache_lock:
+        cached = _tlscrypt_cache.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1:]
+
+        try:
+            with open(path, "r") as f:
+                key_content = f.read()
+        except FileNotFoundError:
+            raise RuntimeError(f"TLSCRYPT_KEY_PATH '{path}' does not exist")
+
+        if key_content.startswith('-----BEGIN OpenVPN Static key V1-----'):
+            key_type = 1
+        elif key_content.startswith('-----BEGIN OpenVPN tls-crypt-v2 server key-----'):
+            key_type = 2
+        else:
+            raise RuntimeError('TLSCRYPT_KEY is not valid')
+
+        # Client keys wrapped with the old server key are useless now
+        if cached is not None and cached[3] is not None:
+            cached[3].stop()
+        _tlscrypt_cache[path] = (signature, key_type, key_content, None)
+        return key_type, key_content, None
+
+def _get_tlscrypt_v2_pool(path: str):
+    """Returns this worker's pool of ready V2 client keys for the server key, or None if pooling is disabled."""
+    pool_size = current_app.config.get("TLSCRYPT_V2_POOL_SIZE", 0)
+    if pool_size <= 0:
+        return None
+
+    with _tlscrypt_cache_lock:
+        signature, key_type, key_content, pool = _tlscrypt_cache[path]
+        if pool is None:
+            from .keypool import KeyPool # Local import to prevent circular dependencies
+            logger = logging.getLogger(__name__)
+            pool = KeyPool(
+                lambda: generate_tlscrypt_v2_client_key(path, key_content, logger),
+                size=pool_size,
+                name="tlscrypt-v2-client-keypool",
+            )
+            _tlscrypt_cache[path] = (signature, key_type, key_content, pool)
+    return pool
+
+def generate_tlscrypt_v2_client_key(server_key_path: str, server_key: str, logger=None) -> str:
     """
-    Reads a tls-crypt key file and returns the key type and content.
-    For V2 keys, it generates the client-specific key.
+    Generates a tls-crypt-v2 client key wrapped with the server key, natively
+    unless TLSCRYPT_V2_GENERATOR is 'openvpn'.
+    """
+    logger = logger or current_app.logger
+    # Wrap the client key in-process; the openvpn binary is only needed if asked for, or as a fallback
+    if os.environ.get("TLSCRYPT_V2_GENERATOR", "native").lower() == "native":
+        from .tlscrypt import wrap_client_key # Local import
+        try:
+            return wrap_client_key(server_key)
+        except ValueError as e:
+            logger.warning("Native tls-crypt-v2 client key generation failed, falling back to openvpn: %s", e)
+
+    with TemporaryDirectory() as d:
+        temp_filename = Path(d) / 'cert.pem'
+
+        RunCommand(
+            [
+                "openvpn",
+                "--tls-crypt-v2", server_key_path,
+                "--genkey", "tls-crypt-v2-client",
+                str(temp_filename)
+            ],
+            raise_on_error=True,
+            logger=logger
+        )
+        with open(temp_filename, 'r') as f:
+            client_key = f.read()
+        return client_key.strip()
+
+def get_tlscrypt_key(device_cert: str | None = None, pooled: bool = True) -> tuple[int | None, str | None]:
+    """
+    Returns the tls-crypt key type and the content to put in a profile. The
+    key file is read once per worker and re-read when it changes. V1 keys are
+    shared by every client; for V2 keys a client key is generated (or taken
+    from the pool, unless ``pooled`` is False). Neither depends on the device
+    certificate.
     """
     tlscrypt_key_path = os.environ.get("TLSCRYPT_KEY_PATH")
     if not tlscrypt_key_path:
         return None, None
 
+    key_type, key_content, _ = _load_tlscrypt_key(tlscrypt_key_path)
+    if key_type == 1:
+        return 1, key_content
+
+    pool = _get_tlscrypt_v2_pool(tlscrypt_key_path) if pooled else None
+    if pool is not None:
+        client_key = pool.try_take()
+        if client_key is not None:
+            return 2, client_key
+    return 2, generate_tlscrypt_v2_client_key(tlscrypt_key_path, key_content)
+
+def get_static_render_context() -> Dict[str, Any]:
+    """
+    Returns the parts of an issuance which are the same for every user: the
+    CA, its certificate and chain as PEM, a V1 tls-crypt key, the optionsets
+    and the device certificate subject attributes. It is built once per
+    worker, and again when the CA, optionsets or tls-crypt key file it was
+    built from have been replaced.
+    """
+    from .cert_utils import device_subject_attributes
+    ca_certs = get_ca_certs()
+    optionsets = current_app.config.get("OVPNS_OPTIONSETS", {})
+    tlscrypt_key_path = os.environ.get("TLSCRYPT_KEY_PATH")
+    # The cached key content is the same object for as long as the file is unchanged
+    tlscrypt_type, tlscrypt_content, _ = _load_tlscrypt_key(tlscrypt_key_path) if tlscrypt_key_path else (None, None, None)
+
+    generation = (ca_certs, optionsets, tlscrypt_content)
+    static_context = current_app.config.get('static_render_context')
+    if static_context is not None and all(old is new for old, new in zip(static_context['generation'], generation)):
+        return static_context
+
+    ca_cert, _ = ca_certs
+    ca_cert_pem = ca_cert.public_bytes(encoding=serialization.Encoding.PEM).decode('utf-8')
     try:
-        with open(tlscrypt_key_path, "r") as f:
-            key_content = f.read()
-    except FileNotFoundError:
-        raise RuntimeError(f"TLSCRYPT_KEY_PATH '{tlscrypt_key_path}' does not exist")
+        # The CA file may carry intermediates after the CA certificate itself
+        with open(os.environ["CA_CERT_PATH"], "rb") as f:
+            chain = x509.load_pem_x509_certificates(f.read())
+        ca_chain_pem = "".join(cert.public_bytes(encoding=serialization.Encoding.PEM).decode('utf-8') for cert in chain)
+    except (KeyError, OSError, ValueError):
+        ca_chain_pem = ca_cert_pem
 
-    if key_content.startswith('-----BEGIN OpenVPN Static key V1-----'):
-        return 1, key_content
-    elif key_content.startswith('-----BEGIN OpenVPN tls-crypt-v2 server key-----'):
-        from .runcommand import RunCommand # Local import
-        from tempfile import TemporaryDirectory
-        from pathlib import Path
+    static_context = {
+        "generation": generation,
+        "ca_certs": ca_certs,
+        "optionsets": optionsets,
+        "subject_attributes": device_subject_attributes(),
+        "tlscrypt_type": tlscrypt_type,
+        # V2 client keys are made for each profile, so only a V1 key is shared
+        "tlscrypt_key": tlscrypt_content if tlscrypt_type == 1 else None,
+        "context": {
+            "ca_cert_pem": ca_cert_pem,
+            "ca_chain_pem": ca_chain_pem,
+        },
+    }
+    current_app.config['static_render_context'] = static_context
+    return static_context
 
-        with TemporaryDirectory() as d:
-            temp_filename = Path(d) / 'cert.pem'
-            
-            # Pass the logger from the current app context to RunCommand
-            RunCommand(
-                [
-                    "openvpn",
-                    "--tls-crypt-v2", tlscrypt_key_path,
-                    "--genkey", "tls-crypt-v2-client",
-                    str(temp_filename)
-                ],
-                raise_on_error=True,
-                logger=current_app.logger
-            )
-            with open(temp_filename, 'r') as f:
-                client_key = f.read()
-            return 2, client_key.strip()
-    else:
-        raise RuntimeError('TLSCRYPT_KEY is not valid')
+def tlscrypt_stats() -> dict:
+    """Returns the V2 client key pool counters for the metrics endpoint."""
+    with _tlscrypt_cache_lock:
+        pools = [entry[3] for entry in _tlscrypt_cache.values() if entry[3] is not None]
+    if not pools:
+        return {"enabled": False}
+    return dict(pools[-1].stats(), enabled=True)
 
 # def get_tlscrypt_key(device_cert):
 #     tlscrypt_key_path = os.environ.get("TLSCRYPT_KEY_PATH", None)
@@ -131,12 +261,37 @@ def get_tlscrypt_key(device_cert: str) -> tuple[int | None, str | None]:
 
 #     return current_app.config.get('tlscrypt_type', None), this_tlscrypt_key
 
+def split_frontmatter(content: str) -> tuple[Dict[str, str], str]:
+    """
+    Splits an optional frontmatter header off the top of a template or optionset file.
+    The header is a block of "key: value" lines between two "---" lines, e.g.
+
+        ---
+        key_algorithm: ec:P-256
+        ---
+
+    Returns the header as a dict (with lower-cased keys) and the remaining content.
+    """
+    lines = content.splitlines(keepends=True)
+    if not lines or lines[0].strip() != '---':
+        return {}, content
+
+    headers = {}
+    for index, line in enumerate(lines[1:], start=1):
+        if line.strip() == '---':
+            return headers, "".join(lines[index + 1:])
+        key, sep, value = line.partition(':')
+        if sep and key.strip():
+            headers[key.strip().lower()] = value.strip()
+    # No closing marker, so this was not a header after all
+    return {}, content
+
 def load_ovpn_templates(app: Flask):
     """Scans a directory for .ovpn template files and loads them in priority order."""
     path = app.config.get("OVPN_TEMPLATES_PATH", "server/templates/ovpn")
-    app.logger.info(f"Loading OVPN templates from {path}")
+    app.logger.info("Loading OVPN templates from %s", path)
     if not os.path.isdir(path):
-        app.logger.error(f"WARNING: OVPN template path '{path}' not found or not a directory.")
+        app.logger.error("WARNING: OVPN template path '%s' not found or not a directory.", path)
         return []
     
     loaded_templates = []
@@ -149,69 +304,242 @@ def load_ovpn_templates(app: Flask):
             priority = int(parts[0])
             group_name = parts[1]
             with open(os.path.join(path, filename), 'r') as f:
-                content = f.read()
+                headers, content = split_frontmatter(f.read())
             loaded_templates.append({
                 "priority": priority,
                 "group_name": group_name,
                 "file_name": filename,
+                "headers": headers,
                 "content": content
             })
     result = sorted(loaded_templates, key=lambda x: x['priority'])
-    app.logger.debug(f'Loaded templates: {result}')
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Loaded templates: %s", [tpl['file_name'] for tpl in result])
     return result
 
-def render_ovpn_template(user_groups: List[str], context: Dict[str, Any]) -> str:
-    """Finds the best matching template and renders it with the given context."""
-    templates = current_app.config.get("OVPNS_TEMPLATES", [])
-    
-    user_groups_lower = {group.lower() for group in (user_groups or [])}
-    
-    best_template_info = None
-    for tpl in templates:
-        if tpl['group_name'].lower() in user_groups_lower:
-            best_template_info = tpl
-            break
-            
-    if not best_template_info:
-        default_templates = [tpl for tpl in templates if tpl['group_name'] == 'default']
-        if not default_templates:
+class OvpnTemplateIndex:
+    """
+    Resolves a user's groups to their template with one dictionary lookup per
+    group, rather than a scan of every template. Each group name maps to its
+    highest priority template, and resolutions are memoized for repeated group
+    lists, which are the same for every login of the same user. An index only
+    ever serves the template list it was built for.
+    """
+
+    def __init__(self, templates: List[Dict[str, Any]], cache_size: int = 1024):
+        self.templates = templates
+        self.default = next((tpl for tpl in templates if tpl['group_name'] == 'default'), None)
+        self._by_group = {}
+        for position, tpl in enumerate(templates):
+            # Templates are sorted by priority, so the first one for a group wins
+            self._by_group.setdefault(tpl['group_name'].lower(), (position, tpl))
+        self._resolve_cached = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, user_groups: tuple) -> tuple[Dict[str, Any], str | None]:
+        best = None
+        for group in user_groups:
+            entry = self._by_group.get(group.lower())
+            if entry is not None and (best is None or entry[0] < best[0]):
+                best = (entry[0], entry[1], group)
+        if best is not None:
+            return best[1], best[2]
+        if self.default is None:
             raise RuntimeError("OVPN template configuration error: no 'default' template found.")
-        best_template_info = default_templates[0]
+        return self.default, None
 
-    main_template_content = best_template_info['content']
-    current_app.logger.debug(f'Loaded template pre-render is:')
-    current_app.logger.debug(main_template_content)
+    def resolve(self, user_groups: List[str]) -> tuple[Dict[str, Any], str | None]:
+        """Returns the user's template and the group which selected it (None for the default template)."""
+        return self._resolve_cached(tuple(user_groups or ()))
 
-    # We will now use this content to build the final template.
-    optionset_name = context.get("optionset_name", "default")
+    def stats(self) -> dict:
+        info = self._resolve_cached.cache_info()
+        return {"templates": len(self.templates), "groups": len(self._by_group), "hits": info.hits, "misses": info.misses, "cached": info.currsize}
+
+def get_ovpn_template_index() -> OvpnTemplateIndex:
+    """Returns the index for the currently loaded templates, building a new one if they have been replaced since."""
+    app = current_app._get_current_object()
+    templates = app.config.get("OVPNS_TEMPLATES", [])
+    index = app.config.get('ovpn_template_index')
+    if index is None or index.templates is not templates:
+        index = OvpnTemplateIndex(templates, cache_size=app.config.get("OVPN_TEMPLATE_MATCH_CACHE_SIZE", 1024))
+        app.config['ovpn_template_index'] = index
+    return index
+
+def select_ovpn_template(user_groups: List[str]) -> Dict[str, Any]:
+    """Finds the highest priority template for the user's groups, or the default template."""
+    return get_ovpn_template_index().resolve(user_groups)[0]
+
+def explain_ovpn_template(user_groups: List[str], optionset_name: str) -> Dict[str, Any]:
+    """Describes which template and optionset a set of groups and a requested optionset resolve to."""
+    template_info, matched_group = get_ovpn_template_index().resolve(user_groups)
     optionsets = current_app.config.get("OVPNS_OPTIONSETS", {})
-    optionset_content = optionsets.get(optionset_name, optionsets.get('default', ''))
+    resolved_optionset = optionset_name if optionset_name in optionsets else 'default'
+    return {
+        "groups": list(user_groups),
+        "template": template_info['file_name'],
+        "template_group": template_info['group_name'],
+        "template_priority": template_info['priority'],
+        "matched_group": matched_group,
+        "optionset": resolved_optionset,
+        "requested_optionset": optionset_name,
+        "key_algorithm": resolve_key_algorithm(template_info, resolved_optionset),
+    }
+
+def template_index_stats() -> dict:
+    """Returns the template resolution counters for the metrics endpoint."""
+    return get_ovpn_template_index().stats()
+
+def resolve_key_algorithm(template_info: Dict[str, Any], optionset_name: str) -> str:
+    """
+    Picks the device key algorithm for an issuance. A `key_algorithm` header in the
+    optionset wins over one in the template, which wins over DEVICE_KEY_ALGORITHM.
+    """
+    from .cert_utils import normalize_key_algorithm, DEFAULT_KEY_ALGORITHM
+    optionset_headers = current_app.config.get("OVPNS_OPTIONSET_HEADERS", {})
+    headers = optionset_headers.get(optionset_name, optionset_headers.get('default', {}))
+    key_algorithm = (
+        headers.get('key_algorithm')
+        or template_info.get('headers', {}).get('key_algorithm')
+        or current_app.config.get("DEVICE_KEY_ALGORITHM", DEFAULT_KEY_ALGORITHM)
+    )
+    return normalize_key_algorithm(key_algorithm)
+
+def configured_key_algorithms(app: Flask) -> List[str]:
+    """Lists every device key algorithm the current configuration can ask for, default first."""
+    from .cert_utils import normalize_key_algorithm, DEFAULT_KEY_ALGORITHM
+    key_algorithms = [normalize_key_algorithm(app.config.get("DEVICE_KEY_ALGORITHM", DEFAULT_KEY_ALGORITHM))]
+    headers = [tpl.get('headers', {}) for tpl in app.config.get("OVPNS_TEMPLATES", [])]
+    headers += list(app.config.get("OVPNS_OPTIONSET_HEADERS", {}).values())
+    for header in headers:
+        if header.get('key_algorithm'):
+            key_algorithm = normalize_key_algorithm(header['key_algorithm'])
+            if key_algorithm not in key_algorithms:
+                key_algorithms.append(key_algorithm)
+    return key_algorithms
 
-    current_app.logger.info(f"For cert: {context['common_name']} use {best_template_info['file_name']} with optionset {optionset_name}.opts")
+class InMemoryBytecodeCache(jinja2.BytecodeCache):
+    """
+    Keeps compiled template bytecode for the life of the worker, so a template
+    evicted from the environment's LRU is reloaded without being recompiled.
+    """
 
-    current_app.logger.debug(f'Loaded optionset pre-render is:')
-    current_app.logger.debug(optionset_content)
+    def __init__(self):
+        self._bytecode = {}
 
-    final_template_string = optionset_content + "\n" + main_template_content
+    def load_bytecode(self, bucket):
+        bytecode = self._bytecode.get(bucket.key)
+        if bytecode is not None:
+            bucket.bytecode_from_string(bytecode)
 
-    current_app.logger.debug(f'Combined pre-render template is:')
-    current_app.logger.debug(final_template_string)
+    def dump_bytecode(self, bucket):
+        self._bytecode[bucket.key] = bucket.bytecode_to_string()
 
-    final_template = jinja2.Template(final_template_string)
-    rendered_template = final_template.render(context)
+    def clear(self):
+        self._bytecode.clear()
 
-    current_app.logger.debug(f'Rendered Output is:')
-    current_app.logger.debug(rendered_template)    
-    
-    return rendered_template
+def ovpn_template_name(template_info: Dict[str, Any], optionset_name: str) -> str:
+    """The name a template and optionset pair is compiled and cached under."""
+    return f"{template_info['file_name']}|{optionset_name}"
+
+def _load_ovpn_template_source(templates: List[Dict[str, Any]], optionsets: Dict[str, str], name: str):
+    """Jinja loader function: the source of a template and optionset pair is the optionset followed by the template."""
+    file_name, _, optionset_name = name.rpartition('|')
+    template_info = next((tpl for tpl in templates if tpl['file_name'] == file_name), None)
+    if template_info is None:
+        return None
+
+    source = optionsets.get(optionset_name, optionsets.get('default', '')) + "\n" + template_info['content']
+    # An environment only ever serves the templates and optionsets it was built for
+    return source, name, None
+
+def build_ovpn_template_environment(app: Flask, templates: List[Dict[str, Any]], optionsets: Dict[str, str], precompile: bool = True) -> jinja2.Environment:
+    """
+    Creates a Jinja environment for one set of templates and optionsets and,
+    unless told not to, compiles every combination of the two into it.
+    """
+    environment = jinja2.Environment(
+        loader=jinja2.FunctionLoader(lambda name: _load_ovpn_template_source(templates, optionsets, name)),
+        cache_size=app.config.get("OVPN_TEMPLATE_CACHE_SIZE", 400),
+        bytecode_cache=app.config.get('ovpn_bytecode_cache'),
+    )
+    environment.ovpn_templates = templates
+    environment.ovpn_optionsets = optionsets
+
+    if precompile:
+        for template_info in templates:
+            for optionset_name in optionsets:
+                name = ovpn_template_name(template_info, optionset_name)
+                try:
+                    environment.get_template(name)
+                except jinja2.TemplateError as e:
+                    # Left for render time to report, as it was before templates were precompiled
+                    app.logger.error("Could not compile OVPN template %s: %s", name, e)
+    return environment
+
+def init_ovpn_template_cache(app: Flask) -> jinja2.Environment:
+    """
+    Creates the worker's Jinja environment for OVPN profiles and compiles every
+    template and optionset combination into it, so issuance only has to render.
+    """
+    app.config["OVPN_TEMPLATE_CACHE_SIZE"] = int(os.getenv("OVPN_TEMPLATE_CACHE_SIZE", "400"))
+    app.config["OVPN_TEMPLATE_BYTECODE_DIR"] = os.getenv("OVPN_TEMPLATE_BYTECODE_DIR")
+    app.config["OVPN_TEMPLATE_MATCH_CACHE_SIZE"] = int(os.getenv("OVPN_TEMPLATE_MATCH_CACHE_SIZE", "1024"))
+    app.config['ovpn_template_index'] = OvpnTemplateIndex(
+        app.config.get("OVPNS_TEMPLATES", []), cache_size=app.config["OVPN_TEMPLATE_MATCH_CACHE_SIZE"]
+    )
+
+    # Bytecode is keyed on the template source, so one cache serves every environment built later
+    bytecode_dir = app.config["OVPN_TEMPLATE_BYTECODE_DIR"]
+    app.config['ovpn_bytecode_cache'] = jinja2.FileSystemBytecodeCache(bytecode_dir) if bytecode_dir else InMemoryBytecodeCache()
+    app.config['ovpn_jinja_env'] = build_ovpn_template_environment(
+        app, app.config.get("OVPNS_TEMPLATES", []), app.config.get("OVPNS_OPTIONSETS", {})
+    )
+    return app.config['ovpn_jinja_env']
+
+def get_ovpn_jinja_env() -> jinja2.Environment:
+    """
+    Returns the Jinja environment for the currently loaded templates and
+    optionsets, building a new one if they have been replaced since.
+    """
+    app = current_app._get_current_object()
+    if 'ovpn_bytecode_cache' not in app.config:
+        return init_ovpn_template_cache(app)
+
+    templates = app.config.get("OVPNS_TEMPLATES", [])
+    optionsets = app.config.get("OVPNS_OPTIONSETS", {})
+    environment = app.config.get('ovpn_jinja_env')
+    if environment is None or environment.ovpn_templates is not templates or environment.ovpn_optionsets is not optionsets:
+        environment = build_ovpn_template_environment(app, templates, optionsets, precompile=False)
+        app.config['ovpn_jinja_env'] = environment
+    return environment
+
+def render_ovpn_template(user_groups: List[str], context: Dict[str, Any]) -> str:
+    """Finds the best matching template and renders it with the given context."""
+    logger = current_app.logger
+    best_template_info = select_ovpn_template(user_groups)
+
+    optionset_name = context.get("optionset_name", "default")
+    optionsets = current_app.config.get("OVPNS_OPTIONSETS", {})
+
+    logger.info("For cert: %s use %s with optionset %s.opts", context['common_name'], best_template_info['file_name'], optionset_name)
+    # The template sources are only assembled for the log when someone is reading it
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Loaded template pre-render is:\n%s", best_template_info['content'])
+        logger.debug("Loaded optionset pre-render is:\n%s", optionsets.get(optionset_name, optionsets.get('default', '')))
+
+    environment = get_ovpn_jinja_env()
+    # Unknown optionsets render with the default one, so share its compiled template
+    cache_optionset = optionset_name if optionset_name in optionsets else 'default'
+    final_template = environment.get_template(ovpn_template_name(best_template_info, cache_optionset))
+    # The rendered profile holds the device's private key, so it is never logged
+    return final_template.render(context)
 
 def normalize_userinfo(raw_userinfo: Union[UserInfo, Dict[str, Any]]) -> Dict[str, Any]:
     """
     Takes a raw userinfo object (which supports .get()) and returns a
     clean, consistent dictionary containing only the claims we care about.
     """
-    # for key, value in raw_userinfo.items():
-    current_app.logger.debug(f'userinfo: {raw_userinfo}')
+    current_app.logger.debug("userinfo: %s", raw_userinfo)
 
     clean_data: Dict[str, Any] = dict(raw_userinfo)
     clean_data['groups'] = clean_data.get('groups') or []
@@ -220,12 +548,21 @@ def normalize_userinfo(raw_userinfo: Union[UserInfo, Dict[str, Any]]) -> Dict[st
 
 def load_ovpn_optionsets(app: Flask) -> Dict[str, str]:
     """Scans a directory for .opts files and loads their content."""
+    optionsets, optionset_headers = read_ovpn_optionsets(app)
+    if optionsets:
+        # Frontmatter headers (e.g. key_algorithm) are kept alongside the optionset bodies
+        app.config["OVPNS_OPTIONSET_HEADERS"] = optionset_headers
+    return optionsets
+
+def read_ovpn_optionsets(app: Flask) -> tuple[Dict[str, str], Dict[str, Dict[str, str]]]:
+    """Reads the .opts files and their frontmatter headers, without touching the loaded configuration."""
     path = app.config.get("OVPNS_OPTIONSETS_PATH", "server/optionsets")
-    app.logger.info(f"Loading OVPN optionsets from {path}")
+    app.logger.info("Loading OVPN optionsets from %s", path)
     optionsets = {}
+    optionset_headers = {}
     if not os.path.isdir(path):
-        app.logger.error(f"WARNING: OVPN optionsets path '{path}' not found or not a directory.")
-        return optionsets
+        app.logger.error("WARNING: OVPN optionsets path '%s' not found or not a directory.", path)
+        return optionsets, optionset_headers
     
     for filename in os.listdir(path):
         if not filename.endswith(".opts"):
@@ -234,11 +571,11 @@ def load_ovpn_optionsets(app: Flask) -> Dict[str, str]:
         # Key is the filename without extension, e.g., "UseTCP"
         key = os.path.splitext(filename)[0]
         with open(os.path.join(path, filename), 'r') as f:
-            optionsets[key] = f.read()
+            optionset_headers[key], optionsets[key] = split_frontmatter(f.read())
             
     if 'default' not in optionsets:
         raise RuntimeError(f"OVPN optionset configuration error: no 'default.opts' file found in '{path}'.")
-    
-    app.logger.debug(f"Loaded optionsets: {list(optionsets.keys())}")
+
+    app.logger.debug("Loaded optionsets: %s", list(optionsets))
         
-    return optionsets
+    return optionsets, optionset_headers
@@ -137,3 +137,22 @@ def test_unauthenticated_admin_redirect_flow(client, mocker):
         # 3. Assert that the FINAL redirect goes back to the original destination
         assert auth_response.status_code == 302
         assert auth_response.location == '/admin/status'
+
+def test_admin_explain_template_resolution(client, mocker):
+    """Tests that the explain endpoint shows the template, matching group and optionset a group set resolves to."""
+    mock_authorize_access_token = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_access_token')
+    mock_authorize_access_token.return_value = {
+        'userinfo': {'sub': 'auth|admin-user', 'groups': ['vpn-admins']}
+    }
+    with client:
+        client.get('/auth')
+        response = client.get('/admin/explain?group=staff,Engineering&optionset=UseTCP')
+        default_response = client.get('/admin/explain?group=staff&optionset=NoSuchOptionset')
+
+    assert response.status_code == 200
+    assert response.json["template"] == "000.engineering.ovpn"
+    assert response.json["matched_group"] == "Engineering"
+    assert response.json["optionset"] == "UseTCP"
+    assert default_response.json["template"] == "999.default.ovpn"
+    assert default_response.json["matched_group"] is None
+    assert default_response.json["optionset"] == "default"
@@ -1,6 +1,15 @@
-from urllib.parse import urlparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from sqlalchemy import create_engine
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from server.models import DownloadToken
+from server.payload_store import get_payload_store
 from server.extensions import db
+from server.auth import encrypt_issuance_context
 from flask import redirect
 from authlib.common.errors import AuthlibBaseError
 
@@ -52,7 +61,7 @@ def test_auth_group_selects_correct_template(client, app, mocker):
         from server.utils import get_fernet
         fernet = get_fernet()
         token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
-        decrypted_content = fernet.decrypt(token_record.ovpn_content).decode('utf-8') # type: ignore
+        decrypted_content = fernet.decrypt(get_payload_store().get(token_str)).decode('utf-8') # type: ignore
     
     assert "engineering-template-for-auth|eng-user" in decrypted_content
     
@@ -101,3 +110,120 @@ def test_login_fails_gracefully_on_authlib_error(app, client, mocker):
     assert b"Internal Server Error" in response.data
     
     app.config['PROPAGATE_EXCEPTIONS'] = True
+
+def start_csr_login(client, mocker, sub='auth|csr-user'):
+    """Logs a CLI client in with CSR issuance and returns the callback parameters."""
+    mock_authorize_redirect = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_redirect')
+    mock_authorize_redirect.return_value = redirect("/fake-oidc")
+    mock_authorize_access_token = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_access_token')
+    mock_authorize_access_token.return_value = {
+        'userinfo': {'sub': sub, 'groups': ['engineering']}
+    }
+    client.get('/login?cli_port=12345&csr=1')
+    response = client.get('/auth')
+    assert response.status_code == 302
+    assert response.location.startswith("http://localhost:12345/callback?")
+    return {key: values[0] for key, values in parse_qs(urlparse(response.location).query).items()}
+
+def make_csr(common_name, key_algorithm='ec:P-256'):
+    """Builds a PEM CSR with the given Common Name, returning the key and the CSR."""
+    private_key = ec.generate_private_key(ec.SECP256R1()) if key_algorithm == 'ec:P-256' else rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    ).sign(private_key, hashes.SHA256())
+    return private_key, csr.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+def test_csr_flow_signs_client_key(client, app, mocker):
+    """
+    Tests the CSR flow: /auth hands the CLI a signing token, and /sign returns
+    a profile for the client's own key without storing any key material.
+    """
+    mocker.patch.dict(app.config, {"DEVICE_KEY_ALGORITHM": "ec:P-256"})
+    with client:
+        params = start_csr_login(client, mocker)
+    assert params['sub'] == 'auth|csr-user'
+    assert params['key_algorithm'] == 'ec:P-256'
+
+    with app.app_context():
+        token_record = db.session.query(DownloadToken).filter_by(token=params['token']).first()
+        assert token_record.status == 'awaiting_csr'
+        assert get_payload_store().get(params['token']) is None
+
+    private_key, csr_pem = make_csr(params['sub'])
+    response = client.post('/sign', json={"token": params['token'], "csr": csr_pem})
+    assert response.status_code == 200
+    assert "engineering-template-for-auth|csr-user" in response.data.decode('utf-8')
+
+    with app.app_context():
+        token_record = db.session.query(DownloadToken).filter_by(token=params['token']).first()
+        assert token_record.collected is True
+        assert token_record.status == 'ready'
+        assert token_record.issuance_context is None
+        assert get_payload_store().get(params['token']) is None
+        assert token_record.cn.startswith('auth|csr-user-')
+
+    # The signing token is single use
+    response = client.post('/sign', json={"token": params['token'], "csr": csr_pem})
+    assert response.status_code == 403
+
+def test_csr_flow_rejects_wrong_subject_and_key(client, app, mocker):
+    """Tests that /sign refuses CSRs for another user or with the wrong key algorithm."""
+    mocker.patch.dict(app.config, {"DEVICE_KEY_ALGORITHM": "ec:P-256"})
+    with client:
+        params = start_csr_login(client, mocker)
+
+    _, other_user_csr = make_csr('auth|someone-else')
+    response = client.post('/sign', json={"token": params['token'], "csr": other_user_csr})
+    assert response.status_code == 400
+    assert b"does not match the authenticated user" in response.data
+
+    _, rsa_csr = make_csr(params['sub'], key_algorithm='rsa:2048')
+    response = client.post('/sign', json={"token": params['token'], "csr": rsa_csr})
+    assert response.status_code == 400
+    assert b"must use ec:P-256" in response.data
+
+    response = client.post('/sign', json={"token": params['token'], "csr": "not a csr"})
+    assert response.status_code == 400
+
+def test_concurrent_signing_with_one_token(app, mocker, tmp_path):
+    """Tests that when many requests race to sign with one token, exactly one gets a certificate."""
+    mocker.patch.dict(app.config, {"DEVICE_KEY_ALGORITHM": "ec:P-256"})
+    # As in the concurrent download test, the race needs a connection per
+    # thread, which the shared in-memory test database cannot give it.
+    engine = create_engine(f"sqlite:///{tmp_path / 'race.db'}")
+    DownloadToken.__table__.create(engine)
+    with app.app_context():
+        mocker.patch.dict(db.engines, {None: engine})
+    user_info = {'sub': 'auth|race-user', 'groups': ['engineering']}
+    with app.test_request_context():
+        db.session.add(DownloadToken(
+            token="raced-signing-token", user=user_info['sub'], status='awaiting_csr',  # type: ignore
+            issuance_context=encrypt_issuance_context(user_info, 'default'),  # type: ignore
+        ))
+        db.session.commit()
+    _, csr_pem = make_csr(user_info['sub'])
+
+    barrier = threading.Barrier(16)
+    def sign(_):
+        client = app.test_client()
+        barrier.wait()
+        return client.post('/sign', json={"token": "raced-signing-token", "csr": csr_pem})
+
+    try:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            responses = list(pool.map(sign, range(16)))
+
+        assert [response.status_code for response in responses].count(200) == 1
+        assert [response.status_code for response in responses if response.status_code != 200] == [403] * 15
+
+        with app.app_context():
+            token_record = db.session.query(DownloadToken).filter_by(token="raced-signing-token").first()
+            assert token_record.status == 'ready'
+            assert token_record.issuance_context is None
+    finally:
+        engine.dispose()
+
+def test_csr_login_requires_cli_port(client):
+    """Tests that CSR issuance is refused for browser logins."""
+    response = client.get('/login?csr=1')
+    assert response.status_code == 400
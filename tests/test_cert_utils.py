@@ -1,7 +1,9 @@
 import os
-from server.cert_utils import load_ca, create_device_certificate
+import pytest
+from server.cert_utils import load_ca, create_device_certificate, normalize_key_algorithm
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 
 def test_load_ca(test_ca):
     """
@@ -47,4 +49,44 @@ def test_create_device_certificate_with_env_vars(test_ca, mocker):
     # --- THIS IS THE FIX ---
     # Correctly use the 'device_key_pem' variable that was defined above
     device_key = serialization.load_pem_private_key(device_key_pem, password=None)
-    assert device_key.key_size == 4096
\ No newline at end of file
+    assert device_key.key_size == 4096
+
+
+def test_create_device_certificate_with_supplied_key(test_ca):
+    """Tests that a pre-generated (pooled) key is used instead of generating a new one."""
+    ca_cert, ca_key = load_ca(*test_ca)
+    supplied_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    device_key_pem, device_cert_pem, _, _ = create_device_certificate("pool.user@example.org", ca_cert, ca_key, device_key=supplied_key)
+
+    device_cert = x509.load_pem_x509_certificate(device_cert_pem)
+    assert device_cert.public_key().public_numbers() == supplied_key.public_key().public_numbers()
+    assert serialization.load_pem_private_key(device_key_pem, password=None).key_size == 2048
+
+def test_normalize_key_algorithm():
+    """Tests that key algorithm names are validated and canonicalised."""
+    assert normalize_key_algorithm("rsa") == "rsa:4096"
+    assert normalize_key_algorithm("RSA:2048") == "rsa:2048"
+    assert normalize_key_algorithm("ec") == "ec:P-256"
+    assert normalize_key_algorithm("ecdsa:p-384") == "ec:P-384"
+    assert normalize_key_algorithm("Ed25519") == "ed25519"
+    for invalid in ["rsa:1024", "ec:P-521", "dsa"]:
+        with pytest.raises(RuntimeError, match="Unsupported device key algorithm"):
+            normalize_key_algorithm(invalid)
+
+@pytest.mark.parametrize("key_algorithm, key_class", [
+    ("ec:P-256", ec.EllipticCurvePrivateKey),
+    ("ec:P-384", ec.EllipticCurvePrivateKey),
+    ("ed25519", ed25519.Ed25519PrivateKey),
+])
+def test_create_device_certificate_with_other_algorithms(test_ca, key_algorithm, key_class):
+    """Tests that non-RSA device keys are generated and certified by the (RSA) CA."""
+    ca_cert, ca_key = load_ca(*test_ca)
+
+    device_key_pem, device_cert_pem, _, _ = create_device_certificate("ec.user@example.org", ca_cert, ca_key, key_algorithm=key_algorithm)
+
+    device_key = serialization.load_pem_private_key(device_key_pem, password=None)
+    assert isinstance(device_key, key_class)
+    device_cert = x509.load_pem_x509_certificate(device_cert_pem)
+    assert device_cert.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo) == \
+        device_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
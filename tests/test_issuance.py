@@ -0,0 +1,268 @@
+import os
+import json
+from datetime import datetime, timezone, timedelta
+import threading
+import pytest
+from urllib.parse import urlparse
+from flask import redirect
+from cryptography.hazmat.primitives import serialization
+from server.extensions import db
+from server.models import DownloadToken
+from server.payload_store import get_payload_store
+from server.issuance import IssuanceExecutor, IssuanceGate, IssuanceBusy, WORKER_CONFIG_KEYS, issue_ovpn_profile, run_issuance
+from server.cert_utils import generate_device_key
+from server.utils import get_fernet
+
+OIDC_CLIENT_PATH = 'server.extensions.oauth.oidc'
+
+def test_run_issuance_is_inline_by_default(app, mocker):
+    """Tests that without ISSUANCE_PROCESSES the issuance step runs in the request worker."""
+    with app.app_context():
+        assert app.config['issuance_executor'] is None
+        assert run_issuance(len, "inline") == 6
+
+def test_issue_ovpn_profile_accepts_pem_key(app):
+    """Tests that a key handed over as PEM (as it is to a worker process) is the one issued."""
+    device_key = generate_device_key("ec:P-256")
+    device_key_pem = device_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    with app.app_context():
+        issued = issue_ovpn_profile({'sub': 'pem-user', 'groups': []}, 'default', "ec:P-256", device_key_pem)
+        ovpn_content = get_fernet().decrypt(issued['encrypted_ovpn_content']).decode('utf-8')
+
+    assert "default-template-for-pem-user" in ovpn_content
+    assert issued['common_name'].startswith("pem-user")
+
+def test_auth_issues_profile_in_worker_process(client, app, mocker):
+    """
+    Tests the full /auth flow with issuance running in a real worker process,
+    which needs everything it is handed to survive pickling.
+    """
+    config = {key: app.config.get(key) for key in WORKER_CONFIG_KEYS}
+    config["DEVICE_KEY_ALGORITHM"] = "ec:P-256"
+    executor = IssuanceExecutor(1, config, timeout=60)
+    mocker.patch.dict(app.config, {"issuance_executor": executor, "ISSUANCE_PROCESSES": 1, "DEVICE_KEY_ALGORITHM": "ec:P-256"})
+    mock_authorize_redirect = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_redirect')
+    mock_authorize_redirect.return_value = redirect("/fake-oidc")
+    mock_authorize_access_token = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_access_token')
+    mock_authorize_access_token.return_value = {
+        'userinfo': {'sub': 'auth|process-user', 'groups': []}
+    }
+
+    try:
+        with client:
+            client.get('/login')
+            auth_response = client.get('/auth')
+            metrics = client.get('/metrics').json
+    finally:
+        executor.shutdown()
+
+    assert auth_response.status_code == 302
+    assert "/download" in auth_response.location
+    token_str = urlparse(auth_response.location).path.split('/')[-1]
+    with app.app_context():
+        token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
+        ovpn_content = get_fernet().decrypt(get_payload_store().get(token_str)).decode('utf-8')
+
+    assert "default-template-for-auth|process-user" in ovpn_content
+    assert metrics["issuance"]["processes"] == 1
+    assert metrics["issuance"]["in_flight"] == 0
+
+def test_issuance_gate_queues_then_sheds():
+    """Tests that the gate admits up to its concurrency, queues briefly, then rejects."""
+    gate = IssuanceGate(concurrency=1, queue_size=1, queue_timeout=5, retry_after=7)
+    release = threading.Event()
+    entered = threading.Event()
+    results = []
+
+    def hold_slot():
+        with gate.admit():
+            entered.set()
+            release.wait(5)
+
+    def queue_for_slot():
+        with gate.admit():
+            results.append("queued-and-admitted")
+
+    holder = threading.Thread(target=hold_slot)
+    holder.start()
+    entered.wait(5)
+    waiter = threading.Thread(target=queue_for_slot)
+    waiter.start()
+    while gate.stats()["queued"] == 0:
+        pass
+
+    # The slot is taken and the queue is full, so this is shed straight away
+    with pytest.raises(IssuanceBusy) as excinfo:
+        with gate.admit():
+            pass
+    assert excinfo.value.retry_after == 7
+    assert gate.stats()["in_flight"] == 1
+
+    release.set()
+    holder.join(5)
+    waiter.join(5)
+    assert results == ["queued-and-admitted"]
+    assert gate.stats() == {
+        "concurrency": 1, "queue_size": 1, "in_flight": 0, "queued": 0, "admitted": 2, "rejected": 1,
+    }
+
+def test_issuance_gate_queue_timeout():
+    """Tests that a request which waits in the queue too long is shed."""
+    gate = IssuanceGate(concurrency=1, queue_size=5, queue_timeout=0.05)
+    with gate.admit():
+        with pytest.raises(IssuanceBusy):
+            with gate.admit():
+                pass
+    assert gate.stats()["rejected"] == 1
+
+def test_auth_returns_503_when_issuance_is_at_capacity(client, app, mocker):
+    """Tests that /auth sheds load with a 503 and Retry-After instead of queueing forever."""
+    gate = IssuanceGate(concurrency=1, queue_size=0, retry_after=9)
+    mocker.patch.dict(app.config, {"issuance_gate": gate})
+    mock_authorize_redirect = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_redirect')
+    mock_authorize_redirect.return_value = redirect("/fake-oidc")
+    mock_authorize_access_token = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_access_token')
+    mock_authorize_access_token.return_value = {
+        'userinfo': {'sub': 'auth|busy-user', 'groups': []}
+    }
+
+    with gate.admit():
+        with client:
+            client.get('/login')
+            auth_response = client.get('/auth')
+
+    assert auth_response.status_code == 503
+    assert auth_response.headers["Retry-After"] == "9"
+    assert b"try again in 9 seconds" in auth_response.data
+    assert gate.stats()["rejected"] == 1
+
+def test_async_issuance_job_flow(client, app, mocker):
+    """
+    Tests that with ISSUANCE_ASYNC /auth only queues a job, the status endpoint
+    reports it as pending until `flask issuance-worker` has issued it, and the
+    profile can then be downloaded.
+    """
+    mocker.patch.dict(app.config, {"ISSUANCE_ASYNC": True, "DEVICE_KEY_ALGORITHM": "ec:P-256"})
+    mock_issue_profile = mocker.patch('server.auth.issue_profile')
+    mock_authorize_redirect = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_redirect')
+    mock_authorize_redirect.return_value = redirect("/fake-oidc")
+    mock_authorize_access_token = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_access_token')
+    mock_authorize_access_token.return_value = {
+        'userinfo': {'sub': 'auth|async-user', 'groups': []}
+    }
+
+    with client:
+        client.get('/login')
+        auth_response = client.get('/auth')
+
+    assert auth_response.status_code == 302
+    mock_issue_profile.assert_not_called()
+    token_str = urlparse(auth_response.location).path.split('/')[-1]
+
+    assert client.get(f'/download/status/{token_str}').json == {"status": "pending"}
+    assert client.get(f'/download?token={token_str}').status_code == 409
+
+    result = app.test_cli_runner().invoke(args=['issuance-worker', '--once'])
+    assert "Processed 1 issuance jobs." in result.output
+
+    assert client.get(f'/download/status/{token_str}').json == {"status": "ready"}
+    download_response = client.get(f'/download?token={token_str}')
+    assert download_response.status_code == 200
+    assert b"default-template-for-auth|async-user" in download_response.data
+    assert client.get(f'/download/status/{token_str}').json == {"status": "collected"}
+
+def test_async_issuance_job_failure(client, app):
+    """Tests that a job which cannot be issued is marked failed rather than left pending."""
+    with app.app_context():
+        db.session.add(DownloadToken(
+            token='broken-job', user='broken-user', status='pending', issuance_context=b'not-fernet'  # type: ignore
+        ))
+        db.session.commit()
+
+        from server.issuance import run_issuance_worker
+        assert run_issuance_worker(once=True) == 1
+
+    assert client.get('/download/status/broken-job').json == {"status": "failed"}
+    assert client.get('/download/status/no-such-token').status_code == 404
+
+def test_stale_issuing_job_is_reclaimed(client, app, mocker):
+    """Tests that a job left 'issuing' by a worker that died is issued by the next worker, and an expired one fails."""
+    mocker.patch.dict(app.config, {"ISSUANCE_JOB_TIMEOUT": 60.0, "DEVICE_KEY_ALGORITHM": "ec:P-256"})
+    now = datetime.now(timezone.utc)
+    with app.app_context():
+        context = get_fernet().encrypt(json.dumps({
+            'userinfo': {'sub': 'auth|orphan-user', 'groups': []}, 'optionset_name': 'default'
+        }).encode())
+        db.session.add(DownloadToken(
+            token='orphaned-job', user='auth|orphan-user', status='issuing', issuance_context=context,  # type: ignore
+            claimed_at=now - timedelta(seconds=90),  # type: ignore
+        ))
+        db.session.add(DownloadToken(
+            token='busy-job', user='auth|busy-user', status='issuing', issuance_context=context,  # type: ignore
+            claimed_at=now - timedelta(seconds=5),  # type: ignore
+        ))
+        db.session.add(DownloadToken(
+            token='expired-orphan', user='auth|late-user', status='issuing', issuance_context=context,  # type: ignore
+            created_at=now - timedelta(minutes=10), claimed_at=now - timedelta(minutes=9),  # type: ignore
+        ))
+        db.session.commit()
+
+        from server.issuance import run_issuance_worker
+        assert run_issuance_worker(once=True) == 2
+
+    assert client.get('/download/status/orphaned-job').json == {"status": "ready"}
+    assert client.get('/download/status/busy-job').json == {"status": "pending"}
+    assert client.get('/download/status/expired-orphan').json == {"status": "failed"}
+
+    with app.app_context():
+        db.session.query(DownloadToken).filter(
+            DownloadToken.token.in_(['orphaned-job', 'busy-job', 'expired-orphan'])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+def test_static_render_context_is_reused_until_replaced(app, mocker, tmp_path, test_ca):
+    """
+    Tests that the user-independent render context is built once, and rebuilt
+    when the CA or optionsets it was built from are replaced.
+    """
+    from server.utils import get_static_render_context
+    ca_pem = open(test_ca[0], "rb").read()
+    chain_file = tmp_path / "chain.crt"
+    chain_file.write_bytes(ca_pem + ca_pem)
+    mocker.patch.dict(os.environ, {"CA_CERT_PATH": str(chain_file), "X509_O": "Static Org"})
+    mocker.patch.dict(app.config, {"static_render_context": None})
+
+    with app.app_context():
+        first = get_static_render_context()
+        assert get_static_render_context() is first
+        assert first["context"]["ca_chain_pem"].count("BEGIN CERTIFICATE") == 2
+        assert first["context"]["ca_cert_pem"].count("BEGIN CERTIFICATE") == 1
+        assert any(attribute.value == "Static Org" for attribute in first["subject_attributes"])
+
+        mocker.patch.dict(app.config, {"OVPNS_OPTIONSETS": dict(app.config["OVPNS_OPTIONSETS"])})
+        second = get_static_render_context()
+        assert second is not first
+        ca_cert, ca_key = app.config["ca_certs"]
+        mocker.patch.dict(app.config, {"ca_certs": (ca_cert, ca_key)})
+        assert get_static_render_context() is not second
+
+def test_issued_certificate_uses_precomputed_subject(app, mocker):
+    """Tests that the X509_* subject attributes reach the certificate through the static context."""
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    mocker.patch.dict(os.environ, {"X509_O": "Precomputed Org"})
+    mocker.patch.dict(app.config, {"static_render_context": None})
+    mock_render = mocker.patch('server.issuance.render_ovpn_template', return_value="profile")
+
+    with app.app_context():
+        issue_ovpn_profile({'sub': 'subject-user', 'groups': []}, 'default', "ec:P-256")
+
+    context = mock_render.call_args[0][1]
+    device_cert = x509.load_pem_x509_certificate(context["device_cert_pem"].encode('utf-8'))
+    assert device_cert.subject.get_attributes_for_oid(NameOID.ORGANIZATION_NAME)[0].value == "Precomputed Org"
+    assert context["ca_cert_pem"].startswith("-----BEGIN CERTIFICATE-----")
+    assert context["optionset"] == app.config["OVPNS_OPTIONSETS"]["default"]
@@ -0,0 +1,131 @@
+import time
+import itertools
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+import server.keypool
+from server.extensions import db
+from server.models import PregeneratedKey
+from server.keypool import KeyPool, keypool_stats, take_device_key, get_keypool, fill_pregenerated_keys, claim_pregenerated_key
+
+def wait_for(predicate, timeout=5):
+    """Polls a predicate until it is true or the timeout is reached."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_keypool_fills_and_serves_hits():
+    """Tests that the refill threads fill the pool and takes are counted as hits."""
+    counter = itertools.count()
+    pool = KeyPool(lambda: next(counter), size=3, refill_workers=2)
+    pool.start()
+    try:
+        assert wait_for(lambda: pool.stats()["available"] == 3)
+        pool.take()
+        pool.take()
+        stats = pool.stats()
+        assert stats["hits"] == 2
+        assert stats["misses"] == 0
+        # The pool tops itself back up after items are taken
+        assert wait_for(lambda: pool.stats()["available"] == 3)
+    finally:
+        pool.stop()
+
+def test_keypool_generate_fallback_counts_miss():
+    """Tests that an empty pool generates inline and records a miss."""
+    pool = KeyPool(lambda: "inline-key", size=1, fallback='generate')
+    pool.start = lambda: None  # No refill threads, so the pool stays empty
+
+    assert pool.take() == "inline-key"
+    assert pool.stats()["misses"] == 1
+    assert pool.stats()["hits"] == 0
+
+def test_keypool_error_fallback_raises():
+    """Tests that the 'error' fallback raises when the pool is empty."""
+    pool = KeyPool(lambda: "unused", size=1, fallback='error')
+    pool.start = lambda: None  # No refill threads, so the pool stays empty
+
+    with pytest.raises(RuntimeError, match="pool is empty"):
+        pool.take()
+
+def test_keypool_rejects_unknown_fallback():
+    """Tests that a misconfigured fallback fails fast."""
+    with pytest.raises(RuntimeError, match="Invalid key pool fallback"):
+        KeyPool(lambda: None, size=1, fallback='sometimes')
+
+def test_take_device_key_without_pool(app, mocker):
+    """Tests that keys are generated inline when the pool is disabled."""
+    mock_generate = mocker.patch('server.keypool.generate_device_key', return_value="fresh-key")
+    with app.app_context():
+        assert take_device_key() == "fresh-key"
+        assert keypool_stats() == {"enabled": False}
+    mock_generate.assert_called_once()
+
+def test_metrics_endpoint_reports_keypool(client):
+    """Tests that the metrics endpoint exposes the key pool counters."""
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.json["keypool"] == {"enabled": False}
+
+@pytest.fixture
+def small_device_key(mocker):
+    """Patches key generation to hand out a cheap, reusable RSA-2048 key."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    mocker.patch('server.keypool.generate_device_key', return_value=key)
+    return key
+
+def test_database_pool_fill_and_claim(app, small_device_key):
+    """Tests that filled keys can be claimed exactly once each."""
+    with app.app_context():
+        db.session.query(PregeneratedKey).delete()
+        db.session.commit()
+
+        assert fill_pregenerated_keys(target=2, batch_size=1) == 2
+        # Already at the target, so nothing more is added
+        assert fill_pregenerated_keys(target=2) == 0
+
+        first = claim_pregenerated_key()
+        second = claim_pregenerated_key()
+        assert first.public_key().public_numbers() == small_device_key.public_key().public_numbers()
+        assert second is not None
+        assert claim_pregenerated_key() is None
+        assert db.session.query(PregeneratedKey).count() == 0
+
+def test_take_device_key_prefers_database_pool(app, mocker, small_device_key):
+    """Tests that /auth key acquisition claims from the shared pool when enabled."""
+    mocker.patch.dict(app.config, {"KEYPOOL_DATABASE": True})
+    with app.app_context():
+        db.session.query(PregeneratedKey).delete()
+        fill_pregenerated_keys(target=1)
+        mock_claim = mocker.spy(server.keypool, 'claim_pregenerated_key')
+
+        assert take_device_key() is not None
+        assert mock_claim.spy_return is not None
+        assert keypool_stats()["database"]["available"] == {}
+
+def test_keypool_fill_cli_command(app, small_device_key):
+    """Tests the 'flask keypool fill' command tops up the shared pool."""
+    with app.app_context():
+        db.session.query(PregeneratedKey).delete()
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['keypool', 'fill', '--target', '3'])
+    assert result.exit_code == 0
+    assert "Added 3 rsa:4096 keys to the shared pool" in result.output
+
+    result = runner.invoke(args=['keypool', 'status'])
+    assert "Available rsa:4096 keys: 3" in result.output
+
+def test_keypools_are_kept_per_key_algorithm(app, mocker):
+    """Tests that each key algorithm gets its own worker pool."""
+    mocker.patch.dict(app.config, {"KEYPOOL_SIZE": 1, "keypool_instances": {}})
+    mocker.patch('server.keypool.KeyPool.start')
+    with app.app_context():
+        rsa_pool = get_keypool("rsa:4096")
+        ec_pool = get_keypool("ec:P-256")
+        assert rsa_pool is not ec_pool
+        assert get_keypool("ec:P-256") is ec_pool
+        assert set(keypool_stats()["pools"]) == {"rsa:4096", "ec:P-256"}
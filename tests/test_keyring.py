@@ -0,0 +1,101 @@
+import os
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers import Cipher
+from server.extensions import db
+from server.models import DownloadToken, DownloadPayload, PregeneratedKey
+from server.keyring import KeyRing, load_keyring, AESGCM_MARKER
+
+OLD_KEY = Fernet.generate_key().decode('utf-8')
+NEW_KEY = Fernet.generate_key().decode('utf-8')
+
+def test_rotated_key_ring_reads_old_tokens():
+    """Tests that adding a new key in front keeps data under the old key readable, and rotation moves it over."""
+    old_token = KeyRing([OLD_KEY]).encrypt(b"profile")
+    ring = KeyRing([NEW_KEY, OLD_KEY])
+
+    assert ring.decrypt(old_token) == b"profile"
+    assert not ring.is_current(old_token)
+    rotated = ring.rotate(old_token)
+    assert ring.is_current(rotated)
+    assert KeyRing([NEW_KEY]).decrypt(rotated) == b"profile"
+
+def test_aesgcm_envelope():
+    """Tests the AES-GCM format: tagged with its key ID, tamper-evident, and alongside readable Fernet tokens."""
+    fernet_token = KeyRing([OLD_KEY]).encrypt(b"legacy")
+    ring = KeyRing([NEW_KEY, OLD_KEY], cipher="aesgcm")
+    token = ring.encrypt(b"profile")
+
+    assert token.startswith(AESGCM_MARKER + ring.primary_key_id)
+    assert ring.decrypt(token) == b"profile"
+    assert ring.decrypt(fernet_token) == b"legacy"
+    assert ring.is_current(token)
+    assert not ring.is_current(fernet_token)
+
+    tampered = token[:-1] + bytes([token[-1] ^ 1])
+    with pytest.raises(InvalidToken):
+        ring.decrypt(tampered)
+    with pytest.raises(InvalidToken):
+        KeyRing([OLD_KEY], cipher="aesgcm").decrypt(token)
+
+def test_reencryption_decrypts_each_token_once(mocker):
+    """Tests that checking a token's key decrypts nothing, and rotating one decrypts it once."""
+    old_token = KeyRing([OLD_KEY]).encrypt(b"profile")
+    ring = KeyRing([NEW_KEY, OLD_KEY])
+    current_token = ring.encrypt(b"profile")
+    # Every Fernet decryption runs one AES decryptor; checking the HMAC runs none
+    decryptor = mocker.spy(Cipher, "decryptor")
+
+    assert ring.is_current(current_token)
+    assert not ring.is_current(old_token)
+    assert decryptor.call_count == 0
+
+    rotated = ring.rotate(old_token)
+    assert decryptor.call_count == 1
+    assert ring.is_current(rotated)
+
+def test_load_keyring_from_environment(mocker):
+    """Tests that ENCRYPTION_KEYS wins over ENCRYPTION_KEY, and unknown ciphers are rejected."""
+    mocker.patch.dict(os.environ, {"ENCRYPTION_KEY": OLD_KEY, "ENCRYPTION_KEYS": f"{NEW_KEY}, {OLD_KEY}", "ENCRYPTION_CIPHER": "AESGCM"})
+    ring = load_keyring()
+    assert ring.cipher == "aesgcm"
+    assert ring.primary_key_id == KeyRing([NEW_KEY]).primary_key_id
+
+    mocker.patch.dict(os.environ, {"ENCRYPTION_CIPHER": "rot13"})
+    with pytest.raises(RuntimeError):
+        load_keyring()
+
+def test_reencrypt_command(app, mocker):
+    """Tests that `flask encryption reencrypt` moves every encrypted column onto the newest key in batches."""
+    old_ring = KeyRing([OLD_KEY])
+    with app.app_context():
+        db.session.query(DownloadToken).delete()
+        db.session.query(DownloadPayload).delete()
+        db.session.query(PregeneratedKey).delete()
+        for n in range(3):
+            db.session.add(DownloadPayload(token=f'rotate-{n}', payload=old_ring.encrypt(f"profile-{n}".encode())))  # type: ignore
+        db.session.add(DownloadToken(token='rotate-pending', user='rotate-user', status='pending', issuance_context=old_ring.encrypt(b"{}")))  # type: ignore
+        db.session.add(DownloadPayload(token='rotate-lost', payload=KeyRing([Fernet.generate_key()]).encrypt(b"lost")))  # type: ignore
+        db.session.add(PregeneratedKey(key_type='ec:P-256', encrypted_key=old_ring.encrypt(b"key")))  # type: ignore
+        db.session.commit()
+
+    mocker.patch.dict(app.config, {"fernet_instance": KeyRing([NEW_KEY, OLD_KEY], cipher="aesgcm")})
+    result = app.test_cli_runner().invoke(args=['encryption', 'reencrypt', '--batch-size', '2'])
+
+    assert "download_payloads.payload: re-encrypted 3 of 4 rows, 1 undecryptable." in result.output
+    assert "download_tokens.issuance_context: re-encrypted 1 of 1 rows" in result.output
+    assert "pregenerated_keys.encrypted_key: re-encrypted 1 of 1 rows" in result.output
+
+    new_ring = KeyRing([NEW_KEY], cipher="aesgcm")
+    with app.app_context():
+        row = db.session.query(DownloadPayload).filter_by(token='rotate-2').first()
+        assert new_ring.decrypt(row.payload) == b"profile-2"
+        assert new_ring.decrypt(db.session.query(PregeneratedKey).first().encrypted_key) == b"key"
+        db.session.query(DownloadToken).delete()
+        db.session.query(DownloadPayload).delete()
+        db.session.query(PregeneratedKey).delete()
+        db.session.commit()
+
+    # A second run finds nothing left to do
+    result = app.test_cli_runner().invoke(args=['encryption', 'reencrypt'])
+    assert "Checked 0 rows" in result.output
@@ -0,0 +1,100 @@
+import io
+import os
+import logging
+import threading
+import pytest
+from logging.handlers import QueueHandler
+from gunicorn.config import Config
+from server.logging import CustomGunicornLogger, APP_LOGGERS, log_level, queue_log_handlers, _stop_queue_listener, _restart_queue_listener
+from server.utils import render_ovpn_template
+
+class ThreadRecordingHandler(logging.StreamHandler):
+    """Records which thread did the writing."""
+    def emit(self, record):
+        self.thread = threading.current_thread()
+        super().emit(record)
+
+@pytest.fixture
+def app_loggers():
+    """Restores the application loggers after a test has reconfigured them."""
+    saved = {name: (logging.getLogger(name).handlers[:], logging.getLogger(name).level, logging.getLogger(name).propagate) for name in APP_LOGGERS}
+    yield
+    _stop_queue_listener()
+    for name, (handlers, level, propagate) in saved.items():
+        logger = logging.getLogger(name)
+        logger.handlers, logger.propagate = handlers, propagate
+        logger.setLevel(level)
+
+def test_log_level_from_environment(mocker):
+    """Tests that LOG_LEVEL defaults to INFO, is case-insensitive and rejects unknown levels."""
+    mocker.patch.dict(os.environ, {}, clear=False)
+    os.environ.pop("LOG_LEVEL", None)
+    assert log_level() == logging.INFO
+    mocker.patch.dict(os.environ, {"LOG_LEVEL": "debug"})
+    assert log_level() == logging.DEBUG
+    mocker.patch.dict(os.environ, {"LOG_LEVEL": "chatty"})
+    with pytest.raises(RuntimeError):
+        log_level()
+
+def test_rendered_profile_is_never_logged(app, caplog):
+    """Tests that even at DEBUG the template sources are logged but the rendered profile is not."""
+    context = {"userinfo": {"sub": "log-user"}, "common_name": "log-cn", "optionset_name": "default", "tlscrypt_key": "SECRET-KEY-MATERIAL"}
+    with caplog.at_level(logging.DEBUG, logger='server'):
+        with app.app_context():
+            rendered = render_ovpn_template([], context)
+
+    assert "SECRET-KEY-MATERIAL" in rendered
+    assert "Loaded template pre-render is:" in caplog.text
+    assert "For cert: log-cn use 999.default.ovpn with optionset default.opts" in caplog.text
+    assert "SECRET-KEY-MATERIAL" not in caplog.text
+
+def test_queued_handlers_write_in_background(app_loggers):
+    """Tests that records logged through the queue are written by the listener thread."""
+    stream = io.StringIO()
+    target = ThreadRecordingHandler(stream)
+    logger = logging.getLogger('server.test_logging')
+    logger.addHandler(queue_log_handlers([target]))
+    logger.propagate = False
+    try:
+        logger.warning("queued %s", "message")
+        _stop_queue_listener()
+    finally:
+        logger.handlers = []
+        logger.propagate = True
+
+    assert stream.getvalue() == "queued message\n"
+    assert target.thread is not threading.current_thread()
+
+def test_queue_listener_restarts_after_fork(app_loggers):
+    """Tests that the listener started in a forked worker writes to the same handlers through a fresh queue."""
+    stream = io.StringIO()
+    target = ThreadRecordingHandler(stream)
+    logger = logging.getLogger('server.test_logging')
+    handler = queue_log_handlers([target])
+    logger.addHandler(handler)
+    logger.propagate = False
+    old_queue = handler.queue
+    try:
+        # What os.register_at_fork runs in a new gunicorn worker
+        _restart_queue_listener()
+        assert handler.queue is not old_queue
+        logger.warning("after %s", "fork")
+        _stop_queue_listener()
+    finally:
+        logger.handlers = []
+        logger.propagate = True
+
+    assert stream.getvalue() == "after fork\n"
+    assert target.thread is not threading.current_thread()
+
+def test_gunicorn_logger_uses_queue_and_log_level(app_loggers, mocker):
+    """Tests that the gunicorn logger routes the app loggers through one queue at LOG_LEVEL, not DEBUG."""
+    mocker.patch.dict(os.environ, {"LOG_LEVEL": "WARNING"})
+    CustomGunicornLogger(Config())
+    # gunicorn calls setup again when it reloads its config
+    CustomGunicornLogger(Config())
+
+    for name in APP_LOGGERS:
+        logger = logging.getLogger(name)
+        assert logger.level == logging.WARNING
+        assert len([h for h in logger.handlers if isinstance(h, QueueHandler)]) == 1
@@ -1,7 +1,12 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
+from sqlalchemy import create_engine
 from server.extensions import db
-from server.models import DownloadToken
+from server.models import DownloadToken, DownloadPayload
+from server.payload_store import get_payload_store
+from server.payload import encrypt_profile
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 
@@ -78,11 +83,49 @@ def test_download_flow(client, app, mocker):
     with app.app_context():
         token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
         assert token_record.collected is True # type: ignore
-        assert token_record.ovpn_content is None # type: ignore
+        assert get_payload_store().get(token_str) is None
 
     second_download_response = client.get(f'/download?token={token_str}')
     assert second_download_response.status_code == 403
 
+def test_concurrent_downloads_of_one_token(app, mocker, tmp_path):
+    """Tests that when many requests race for one token, exactly one gets the profile."""
+    # The in-memory test database is a single connection shared by every
+    # thread, which SQLite cannot run concurrent transactions on, so the
+    # race runs against a database file with a connection per thread.
+    engine = create_engine(f"sqlite:///{tmp_path / 'race.db'}")
+    for table in (DownloadToken.__table__, DownloadPayload.__table__):
+        table.create(engine)
+    with app.app_context():
+        mocker.patch.dict(db.engines, {None: engine})
+    token_str = "raced-token"
+    with app.app_context():
+        db.session.add(DownloadToken(token=token_str, user="race-user", cn="race-user"))  # type: ignore
+        get_payload_store().put(token_str, encrypt_profile("raced-profile"))
+        db.session.commit()
+
+    barrier = threading.Barrier(20)
+    def fetch(_):
+        client = app.test_client()
+        barrier.wait()
+        return client.get(f'/download?token={token_str}')
+
+    try:
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            responses = list(pool.map(fetch, range(20)))
+
+        succeeded = [response for response in responses if response.status_code == 200]
+        assert len(succeeded) == 1
+        assert succeeded[0].data == b"raced-profile"
+        assert [response.status_code for response in responses if response.status_code != 200] == [403] * 19
+
+        with app.app_context():
+            token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
+            assert token_record.collected is True  # type: ignore
+            assert get_payload_store().get(token_str) is None
+    finally:
+        engine.dispose()
+
 def test_security_headers_are_present(client):
     """
     Tests that Flask-Talisman is adding security headers to responses.
@@ -182,6 +225,6 @@ def test_tlscrypt_key_is_injected(client, app, mocker, fs):
     with app.app_context():
         from server.utils import get_fernet
         token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
-        decrypted_content = get_fernet().decrypt(token_record.ovpn_content).decode('utf-8')
+        decrypted_content = get_fernet().decrypt(get_payload_store().get(token_str)).decode('utf-8')
         
         assert "key-data" in decrypted_content
\ No newline at end of file
@@ -4,6 +4,8 @@ from urllib.parse import urlparse
 from flask import redirect
 from server.extensions import db
 from server.models import DownloadToken
+from server.payload_store import get_payload_store
+from server.keypool import take_device_key
 
 OIDC_CLIENT_PATH = 'server.extensions.oauth.oidc'
 
@@ -66,7 +68,7 @@ def test_auth_uses_default_optionset(client, app, mocker):
         with app.app_context():
             from server.utils import get_fernet
             token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
-            decrypted_content = get_fernet().decrypt(token_record.ovpn_content).decode('utf-8')
+            decrypted_content = get_fernet().decrypt(get_payload_store().get(token_str)).decode('utf-8')
             
             assert "proto udp" in decrypted_content
             assert "proto tcp-client" not in decrypted_content
@@ -95,8 +97,31 @@ def test_auth_uses_specific_optionset_from_session(client, app, mocker):
         with app.app_context():
             from server.utils import get_fernet
             token_record = db.session.query(DownloadToken).filter_by(token=token_str).first()
-            decrypted_content = get_fernet().decrypt(token_record.ovpn_content).decode('utf-8')
+            decrypted_content = get_fernet().decrypt(get_payload_store().get(token_str)).decode('utf-8')
             
             assert "proto tcp-client" in decrypted_content
             assert "proto udp" not in decrypted_content
             assert token_record.optionset_used == 'UseTCP'
+
+def test_optionset_header_selects_key_algorithm(client, app, mocker):
+    """
+    Tests that a key_algorithm frontmatter header on the chosen optionset
+    decides which kind of device key /auth issues.
+    """
+    mocker.patch.dict(app.config, {
+        "OVPNS_OPTIONSET_HEADERS": {"default": {}, "UseTCP": {"key_algorithm": "ec:P-256"}},
+    })
+    mock_take_device_key = mocker.patch('server.issuance.take_device_key', wraps=take_device_key)
+    mock_authorize_redirect = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_redirect')
+    mock_authorize_redirect.return_value = redirect("/fake-oidc")
+    mock_authorize_access_token = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_access_token')
+    mock_authorize_access_token.return_value = {
+        'userinfo': {'sub': 'auth|ec-user', 'groups': []}
+    }
+
+    with client:
+        client.get('/login?optionset=UseTCP')
+        auth_response = client.get('/auth')
+
+    assert auth_response.status_code == 302
+    mock_take_device_key.assert_called_once_with("ec:P-256")
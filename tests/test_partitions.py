@@ -0,0 +1,88 @@
+import os
+import pytest
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from server.extensions import db
+from server.models import DownloadToken
+from server.partitions import (
+    PARTITION_INTERVALS, DEFAULT_PARTITION, partition_start, partition_name, is_partitioned, list_partitions, partition_table, maintain_partitions,
+)
+from server.cleanup import cleanup_tokens
+
+def test_partition_boundaries():
+    """Tests that partitions start at midnight UTC, and on Mondays when weekly."""
+    moment = datetime(2026, 10, 17, 15, 30, tzinfo=timezone(timedelta(hours=2)))
+    assert partition_start(moment, PARTITION_INTERVALS["daily"]) == datetime(2026, 10, 17, tzinfo=timezone.utc)
+    weekly = partition_start(moment, PARTITION_INTERVALS["weekly"])
+    assert weekly == datetime(2026, 10, 12, tzinfo=timezone.utc) and weekly.weekday() == 0
+    assert partition_name(weekly) == "download_tokens_p20261012"
+
+def test_partitioning_is_postgres_only(app):
+    """Tests that SQLite keeps the delete path, and the partition command refuses to run on it."""
+    with app.app_context():
+        assert not is_partitioned()
+    result = app.test_cli_runner().invoke(args=['tokens', 'partition'])
+    assert result.exit_code != 0
+    assert "needs PostgreSQL" in result.output
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL is not set")
+def test_postgres_partition_retention(app, mocker):
+    """Tests converting a Postgres table with data, and that retention drops whole partitions."""
+    engine = create_engine(os.environ["TEST_POSTGRES_URL"])
+    db.metadata.create_all(engine, tables=[DownloadToken.__table__])
+    session = Session(engine)
+    mocker.patch.object(db, 'session', session)
+    try:
+        now = datetime.now(timezone.utc)
+        for days in (3, 2, 0):
+            session.add(DownloadToken(token=f"day-{days}", user="partition-user", created_at=now - timedelta(days=days)))  # type: ignore
+        session.commit()
+
+        with app.app_context():
+            result = partition_table("daily", ahead=2)
+            assert result["rows"] == 3
+            assert is_partitioned()
+            assert len(list_partitions()) >= 6
+
+            cleanup = cleanup_tokens(now - timedelta(days=1))
+            assert len(cleanup["partitions_dropped"]) >= 2
+            assert [token.token for token in session.query(DownloadToken).all()] == ["day-0"]
+    finally:
+        session.rollback()
+        session.execute(text("DROP TABLE IF EXISTS download_tokens CASCADE"))
+        session.commit()
+        session.close()
+        engine.dispose()
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL is not set")
+def test_postgres_maintenance_moves_rows_out_of_default_partition(app, mocker):
+    """Tests that after maintenance has lapsed, partitions are still created for ranges the default partition took rows in."""
+    engine = create_engine(os.environ["TEST_POSTGRES_URL"])
+    db.metadata.create_all(engine, tables=[DownloadToken.__table__])
+    session = Session(engine)
+    mocker.patch.object(db, 'session', session)
+    try:
+        now = datetime.now(timezone.utc)
+        with app.app_context():
+            partition_table("daily", ahead=0)
+            # Maintenance lapses: today has no partition, so today's rows go to the default partition
+            for partition, start, _ in list_partitions():
+                if start >= partition_start(now, PARTITION_INTERVALS["daily"]):
+                    session.execute(text(f'DROP TABLE "{partition}"'))
+            session.add(DownloadToken(token="lapsed", user="partition-user", created_at=now))  # type: ignore
+            session.commit()
+            assert session.execute(text(f"SELECT count(*) FROM {DEFAULT_PARTITION}")).scalar() == 1
+
+            maintained = maintain_partitions(now - timedelta(days=1), ahead=2)
+            today = partition_name(partition_start(now, PARTITION_INTERVALS["daily"]))
+            assert today in maintained["created"]
+            assert session.execute(text(f"SELECT count(*) FROM {DEFAULT_PARTITION}")).scalar() == 0
+            assert session.execute(text(f'SELECT token FROM "{today}"')).scalars().all() == ["lapsed"]
+            assert [token.token for token in session.query(DownloadToken).all()] == ["lapsed"]
+    finally:
+        session.rollback()
+        session.execute(text("DROP TABLE IF EXISTS download_tokens CASCADE"))
+        session.commit()
+        session.close()
+        engine.dispose()
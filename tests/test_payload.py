@@ -0,0 +1,56 @@
+import os
+import pytest
+from server.extensions import db
+from server.models import DownloadToken, DownloadPayload
+from server.payload import compress_profile, decompress_profile, encrypt_profile, decrypt_profile, init_payload, zstandard
+from server.utils import get_fernet
+
+PROFILE = "client\nproto udp\n<key>\n" + "A" * 3000 + "\n</key>\n"
+
+@pytest.mark.parametrize("compression", ["none", "zlib", pytest.param("zstd", marks=pytest.mark.skipif(zstandard is None, reason="zstandard is not installed"))])
+def test_profile_round_trip(compression):
+    """Tests that each compression setting decodes back to the original profile."""
+    encoded = compress_profile(PROFILE.encode('utf-8'), compression)
+    assert decompress_profile(encoded).decode('utf-8') == PROFILE
+    if compression != "none":
+        assert len(encoded) < len(PROFILE)
+
+def test_rows_stored_before_compression_still_decrypt(app, mocker):
+    """Tests that a profile encrypted the old way is read back unchanged with compression on."""
+    mocker.patch.dict(app.config, {"PROFILE_COMPRESSION": "zlib"})
+    with app.app_context():
+        legacy = get_fernet().encrypt(PROFILE.encode('utf-8'))
+        compressed = encrypt_profile(PROFILE)
+        assert decrypt_profile(legacy).decode('utf-8') == PROFILE
+        assert decrypt_profile(compressed).decode('utf-8') == PROFILE
+        assert len(compressed) < len(legacy)
+
+def test_unknown_format_is_rejected():
+    """Tests that corrupt or unknown stored formats raise ValueError rather than returning garbage."""
+    with pytest.raises(ValueError):
+        decompress_profile(b"\x00\x7fwhatever")
+    with pytest.raises(ValueError):
+        decompress_profile(b"\x00\x01not-zlib")
+
+def test_invalid_compression_setting_fails_at_startup(app, mocker):
+    """Tests that a typo in PROFILE_COMPRESSION stops the app starting rather than failing issuance."""
+    mocker.patch.dict(os.environ, {"PROFILE_COMPRESSION": "lzma"})
+    mocker.patch.dict(app.config)
+    with pytest.raises(RuntimeError):
+        init_payload(app)
+
+def test_download_serves_compressed_and_legacy_rows(client, app, mocker):
+    """Tests that /download returns the profile whichever format its row was stored in."""
+    mocker.patch.dict(app.config, {"PROFILE_COMPRESSION": "zlib"})
+    with app.app_context():
+        db.session.add(DownloadToken(token='compressed-row', user='payload-user'))  # type: ignore
+        db.session.add(DownloadPayload(token='compressed-row', payload=encrypt_profile(PROFILE)))  # type: ignore
+        db.session.add(DownloadToken(token='legacy-row', user='payload-user'))  # type: ignore
+        db.session.add(DownloadPayload(token='legacy-row', payload=get_fernet().encrypt(PROFILE.encode('utf-8'))))  # type: ignore
+        db.session.commit()
+
+    for token in ('compressed-row', 'legacy-row'):
+        response = client.get(f'/download?token={token}')
+        assert response.status_code == 200
+        assert response.data.decode('utf-8') == PROFILE
+    assert client.get('/metrics').json["payload"]["compression"] == "zlib"
@@ -0,0 +1,143 @@
+import os
+import pytest
+from datetime import datetime, timezone, timedelta
+from cryptography.fernet import InvalidToken
+from sqlalchemy.exc import OperationalError
+from server.extensions import db
+from server.models import DownloadToken, DownloadPayload
+from server.payload import encrypt_profile
+from server.payload_store import FilesystemPayloadStore, TablePayloadStore, get_payload_store, init_payload_store
+
+def test_filesystem_store_hands_out_each_payload_once(tmp_path):
+    """Tests that a filesystem payload is taken once, and tokens cannot escape the directory."""
+    store = FilesystemPayloadStore(str(tmp_path / "payloads"))
+    store.put("token-1", b"encrypted")
+
+    assert store.get("token-1") == b"encrypted"
+    assert oct(os.stat(tmp_path / "payloads" / "token-1.payload").st_mode & 0o777) == "0o600"
+    assert store.take("token-1") == b"encrypted"
+    assert store.take("token-1") is None
+    assert os.listdir(tmp_path / "payloads") == []
+
+    with pytest.raises(ValueError):
+        store.put("../escape", b"nope")
+
+def test_download_from_filesystem_store(client, app, mocker, tmp_path):
+    """Tests that /download serves and removes a profile kept on the filesystem, leaving no table row."""
+    store = FilesystemPayloadStore(str(tmp_path))
+    mocker.patch.dict(app.config, {"PAYLOAD_STORE": "filesystem", "payload_store": store})
+    with app.app_context():
+        db.session.add(DownloadToken(token='fs-row', user='payload-user'))  # type: ignore
+        store.put('fs-row', encrypt_profile("client\n"))
+        db.session.commit()
+        assert db.session.query(DownloadPayload).filter_by(token='fs-row').count() == 0
+
+    response = client.get('/download?token=fs-row')
+    assert response.status_code == 200
+    assert response.data == b"client\n"
+    assert store.get('fs-row') is None
+    assert client.get('/metrics').json["payload"]["store"] == "filesystem"
+
+def test_download_restores_payload_when_decryption_fails(client, app, mocker, tmp_path):
+    """Tests that a payload taken from the filesystem is put back when decryption fails, so the token can be retried."""
+    store = FilesystemPayloadStore(str(tmp_path))
+    mocker.patch.dict(app.config, {"PAYLOAD_STORE": "filesystem", "payload_store": store})
+    with app.app_context():
+        encrypted = encrypt_profile("client\n")
+        db.session.add(DownloadToken(token='fs-retry', user='payload-user'))  # type: ignore
+        store.put('fs-retry', encrypted)
+        db.session.commit()
+
+    mock_take = mocker.spy(store, 'take')
+    mock_decrypt = mocker.patch('server.main_routes.decrypt_profile', side_effect=InvalidToken)
+    assert client.get('/download?token=fs-retry').status_code == 500
+    mock_take.assert_called_once_with('fs-retry')
+    assert store.get('fs-retry') == encrypted
+    with app.app_context():
+        assert db.session.query(DownloadToken).filter_by(token='fs-retry').one().collected is False
+
+    mocker.stop(mock_decrypt)
+    response = client.get('/download?token=fs-retry')
+    assert response.status_code == 200
+    assert response.data == b"client\n"
+
+def test_download_keeps_table_payload_when_commit_fails(client, app, mocker):
+    """Tests that a failed commit rolls back the claim and the table payload's delete together."""
+    with app.app_context():
+        db.session.add(DownloadToken(token='table-retry', user='payload-user'))  # type: ignore
+        get_payload_store().put('table-retry', encrypt_profile("client\n"))
+        db.session.commit()
+
+    mock_commit = mocker.patch.object(db.session, 'commit', side_effect=OperationalError("COMMIT", {}, Exception("connection lost")))
+    with pytest.raises(OperationalError):
+        client.get('/download?token=table-retry')
+
+    mocker.stop(mock_commit)
+    with app.app_context():
+        assert db.session.query(DownloadPayload).filter_by(token='table-retry').count() == 1
+    response = client.get('/download?token=table-retry')
+    assert response.status_code == 200
+    assert response.data == b"client\n"
+
+def test_cleanup_purges_orphaned_payloads(client, app):
+    """Tests that the cleanup task removes old payloads as well as old token rows."""
+    with app.app_context():
+        db.session.query(DownloadToken).delete()
+        db.session.query(DownloadPayload).delete()
+        old = datetime.now(timezone.utc) - timedelta(hours=25)
+        db.session.add(DownloadToken(token='old-row', user='payload-user', created_at=old))  # type: ignore
+        db.session.add(DownloadPayload(token='old-row', payload=b"old", created_at=old))  # type: ignore
+        db.session.add(DownloadPayload(token='new-row', payload=b"new"))  # type: ignore
+        db.session.commit()
+        assert isinstance(get_payload_store(), TablePayloadStore)
+
+    assert client.post('/tasks/cleanup-tokens').status_code == 200
+    with app.app_context():
+        assert [row.token for row in db.session.query(DownloadPayload).all()] == ['new-row']
+        db.session.query(DownloadPayload).delete()
+        db.session.commit()
+
+class FakeRedis:
+    """Just the commands the Redis payload store uses."""
+    def __init__(self):
+        self.data, self.expiry = {}, {}
+
+    def set(self, key, value, ex=None):
+        self.data[key], self.expiry[key] = value, ex
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def getdel(self, key):
+        self.expiry.pop(key, None)
+        return self.data.pop(key, None)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+def test_redis_store_expires_with_the_download_window(client, app, mocker):
+    """Tests that Redis payloads are written with the download window as their TTL and claimed with GETDEL."""
+    fake = FakeRedis()
+    mocker.patch('server.payload_store.redis.Redis.from_url', return_value=fake)
+    mocker.patch.dict(os.environ, {"PAYLOAD_STORE": "redis", "RATELIMIT_STORAGE_URL": "redis://ratelimit:6379/0"})
+    mocker.patch.dict(app.config)
+    init_payload_store(app)
+    assert app.config["PAYLOAD_STORE_REDIS_URL"] == "redis://ratelimit:6379/0"
+
+    app.config.pop("payload_store", None)
+    with app.app_context():
+        store = get_payload_store()
+        db.session.add(DownloadToken(token='redis-row', user='payload-user'))  # type: ignore
+        store.put('redis-row', encrypt_profile("client\n"))
+        db.session.commit()
+    assert fake.expiry["ovpn-manager:payload:redis-row"] == 300
+
+    assert client.get('/download?token=redis-row').data == b"client\n"
+    assert fake.data == {}
+
+def test_redis_store_needs_a_url(app, mocker):
+    """Tests that PAYLOAD_STORE=redis without a Redis URL fails at startup."""
+    mocker.patch.dict(os.environ, {"PAYLOAD_STORE": "redis", "RATELIMIT_STORAGE_URL": "memory://"})
+    mocker.patch.dict(app.config)
+    with pytest.raises(RuntimeError):
+        init_payload_store(app)
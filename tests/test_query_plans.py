@@ -0,0 +1,65 @@
+import os
+import pytest
+from datetime import datetime, timezone
+from sqlalchemy import create_engine, select
+from server.extensions import db
+from server.models import DownloadToken, DownloadPayload
+from server.admin import status_query
+
+# (status page filter, time limit, index the planner should use)
+STATUS_QUERIES = [
+    ('all_records', '1d', 'ix_download_tokens_created_at'),
+    ('all_records', 'all', 'ix_download_tokens_created_at'),
+    ('collected', '1w', 'ix_download_tokens_created_at'),
+    ('downloadable', 'all', 'ix_download_tokens_downloadable_created_at'),
+    ('downloadable', '1d', 'ix_download_tokens_downloadable_created_at'),
+    ('all_records', 'expiring', 'ix_download_tokens_cert_expiry'),
+]
+
+def cleanup_statement():
+    """The query each cleanup batch finds its rows with."""
+    return select(DownloadToken.id, DownloadToken.created_at).where(
+        DownloadToken.created_at < datetime.now(timezone.utc), DownloadToken.created_at >= datetime(2020, 1, 1, tzinfo=timezone.utc)
+    ).order_by(DownloadToken.created_at, DownloadToken.id).limit(1000)
+
+def explain(connection, statement) -> str:
+    """Returns the query plan for a statement as text, on SQLite or Postgres."""
+    compiled = statement.compile(dialect=connection.dialect)
+    if connection.dialect.name == 'postgresql':
+        rows = connection.exec_driver_sql("EXPLAIN " + compiled.string, compiled.params).all()
+    else:
+        # The plan does not depend on the values, so datetimes are passed as text
+        params = tuple(value.isoformat() if isinstance(value, datetime) else value
+                       for value in (compiled.params[name] for name in compiled.positiontup))
+        rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + compiled.string, params).all()
+    return "\n".join(str(row[-1]) for row in rows)
+
+@pytest.mark.parametrize("filter_by, time_limit, index", STATUS_QUERIES)
+def test_sqlite_status_queries_use_indexes(app, filter_by, time_limit, index):
+    """Tests that every admin status filter is answered from an index rather than a table scan."""
+    with app.app_context():
+        plan = explain(db.session.connection(), status_query(filter_by, time_limit).statement)
+    assert f"USING INDEX {index}" in plan
+
+def test_sqlite_cleanup_uses_created_at_index(app):
+    """Tests that a cleanup batch finds old rows through the created_at index, starting from its cursor."""
+    with app.app_context():
+        plan = explain(db.session.connection(), cleanup_statement())
+    assert "INDEX ix_download_tokens_created_at" in plan
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL is not set")
+def test_postgres_queries_use_indexes(app):
+    """Tests the same plans on Postgres, in a throwaway copy of the tables."""
+    tables = [DownloadToken.__table__, DownloadPayload.__table__]
+    engine = create_engine(os.environ["TEST_POSTGRES_URL"])
+    db.metadata.create_all(engine, tables=tables)
+    try:
+        with app.app_context(), engine.connect() as connection:
+            # An empty table is cheapest to scan, so only an index plan is acceptable here
+            connection.exec_driver_sql("SET enable_seqscan = off")
+            for filter_by, time_limit, index in STATUS_QUERIES:
+                assert index in explain(connection, status_query(filter_by, time_limit).statement), (filter_by, time_limit)
+            assert "ix_download_tokens_created_at" in explain(connection, cleanup_statement())
+    finally:
+        db.metadata.drop_all(engine, tables=tables)
+        engine.dispose()
@@ -0,0 +1,124 @@
+import os
+import time
+import datetime
+from datetime import timezone
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from server.reload import ConfigReloader, path_fingerprint
+from server.utils import render_ovpn_template
+
+def write_volume(path, files, version):
+    """Lays files out the way the kubelet projects a ConfigMap or Secret, then swaps ..data over to them."""
+    path.mkdir(exist_ok=True)
+    data_dir = path / f"..{version}"
+    data_dir.mkdir()
+    for name, content in files.items():
+        (data_dir / name).write_bytes(content if isinstance(content, bytes) else content.encode())
+        if not (path / name).is_symlink():
+            (path / name).symlink_to(f"..data/{name}")
+    (path / "..data_tmp").symlink_to(data_dir.name)
+    os.replace(path / "..data_tmp", path / "..data")
+
+def make_ca(common_name):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()
+    ).serial_number(x509.random_serial_number()).not_valid_before(
+        datetime.datetime.now(timezone.utc)
+    ).not_valid_after(
+        datetime.datetime.now(timezone.utc) + datetime.timedelta(days=1)
+    ).add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True).sign(key, hashes.SHA256())
+    key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    return cert, cert.public_bytes(serialization.Encoding.PEM), key_pem
+
+def test_fingerprint_follows_data_symlink_swap(tmp_path):
+    """Tests that an atomic ..data swap is seen even when the new files keep the same size and timestamps."""
+    volume = tmp_path / "templates"
+    write_volume(volume, {"999.default.ovpn": "version-a"}, "v1")
+    os.utime(volume / "..v1" / "999.default.ovpn", ns=(1, 1))
+    before = path_fingerprint(str(volume))
+
+    write_volume(volume, {"999.default.ovpn": "version-b"}, "v2")
+    os.utime(volume / "..v2" / "999.default.ovpn", ns=(1, 1))
+
+    assert path_fingerprint(str(volume)) != before
+    assert path_fingerprint(str(tmp_path / "missing")) is None
+
+def test_reload_swaps_templates_and_optionsets(app, tmp_path, mocker):
+    """Tests that changed templates and optionsets are loaded, compiled and used by the next render."""
+    templates, optionsets = tmp_path / "templates", tmp_path / "optionsets"
+    write_volume(templates, {"999.default.ovpn": "old-template-for-{{ userinfo.sub }}"}, "v1")
+    write_volume(optionsets, {"default.opts": "# old options"}, "v1")
+    mocker.patch.dict(app.config, {"OVPN_TEMPLATES_PATH": str(templates), "OVPNS_OPTIONSETS_PATH": str(optionsets)})
+    reloader = ConfigReloader(app, interval=60)
+    assert reloader.check() == []
+
+    write_volume(templates, {"999.default.ovpn": "new-template-for-{{ userinfo.sub }}"}, "v2")
+    write_volume(optionsets, {"default.opts": "# new options", "Extra.opts": "# extra"}, "v2")
+    assert reloader.check() == ["templates"]
+
+    assert set(app.config["OVPNS_OPTIONSETS"]) == {"default", "Extra"}
+    assert app.config['ovpn_jinja_env'].ovpn_templates is app.config["OVPNS_TEMPLATES"]
+    with app.app_context():
+        rendered = render_ovpn_template([], {"userinfo": {"sub": "reload-user"}, "common_name": "reload-user", "optionset_name": "Extra"})
+    assert "new-template-for-reload-user" in rendered
+    assert "# extra" in rendered
+    assert reloader.stats()["reloads"] == 1
+
+def test_broken_reload_keeps_current_configuration(app, tmp_path, mocker):
+    """Tests that an update without a default optionset is rejected, and picked up once it is fixed."""
+    templates, optionsets = tmp_path / "templates", tmp_path / "optionsets"
+    write_volume(templates, {"999.default.ovpn": "template"}, "v1")
+    write_volume(optionsets, {"default.opts": "# options"}, "v1")
+    mocker.patch.dict(app.config, {"OVPN_TEMPLATES_PATH": str(templates), "OVPNS_OPTIONSETS_PATH": str(optionsets)})
+    current_templates = app.config["OVPNS_TEMPLATES"]
+    reloader = ConfigReloader(app, interval=60)
+
+    (optionsets / "..data").unlink()
+    (optionsets / "..data").symlink_to("..v1")
+    (optionsets / "..v1" / "default.opts").rename(optionsets / "..v1" / "other.opts")
+    assert reloader.check() == []
+    assert app.config["OVPNS_TEMPLATES"] is current_templates
+    assert reloader.stats()["failures"] == 1
+
+    write_volume(optionsets, {"default.opts": "# fixed"}, "v2")
+    assert reloader.check() == ["templates"]
+
+def test_reload_swaps_ca_and_rejects_mismatched_pair(app, tmp_path, mocker):
+    """Tests that a rotated CA is picked up, but a certificate and key which do not belong together are not."""
+    secret = tmp_path / "ca"
+    _, first_cert_pem, first_key_pem = make_ca("first-ca")
+    write_volume(secret, {"ca.crt": first_cert_pem, "ca.key": first_key_pem}, "v1")
+    mocker.patch.dict(os.environ, {"CA_CERT_PATH": str(secret / "ca.crt"), "CA_KEY_PATH": str(secret / "ca.key")})
+    mocker.patch.dict(app.config, {"ca_certs": app.config.get('ca_certs')})
+    reloader = ConfigReloader(app, interval=60)
+
+    second_cert, second_cert_pem, second_key_pem = make_ca("second-ca")
+    write_volume(secret, {"ca.crt": second_cert_pem, "ca.key": first_key_pem}, "v2")
+    assert reloader.check() == []
+    assert reloader.stats()["failures"] == 1
+
+    write_volume(secret, {"ca.crt": second_cert_pem, "ca.key": second_key_pem}, "v3")
+    assert reloader.check() == ["ca"]
+    assert app.config['ca_certs'][0] == second_cert
+
+def test_watcher_thread_reloads_in_background(app, tmp_path, mocker):
+    """Tests that the watcher thread picks up a change without any request being made."""
+    templates, optionsets = tmp_path / "templates", tmp_path / "optionsets"
+    write_volume(templates, {"999.default.ovpn": "template"}, "v1")
+    write_volume(optionsets, {"default.opts": "# options"}, "v1")
+    mocker.patch.dict(app.config, {"OVPN_TEMPLATES_PATH": str(templates), "OVPNS_OPTIONSETS_PATH": str(optionsets)})
+    reloader = ConfigReloader(app, interval=0.05)
+    reloader.start()
+    try:
+        write_volume(templates, {"999.default.ovpn": "background-template"}, "v2")
+        deadline = time.monotonic() + 5
+        while reloader.stats()["reloads"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        reloader.stop()
+
+    assert app.config["OVPNS_TEMPLATES"][0]['content'] == "background-template"
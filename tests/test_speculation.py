@@ -0,0 +1,109 @@
+import os
+import pytest
+from flask import redirect
+from server.speculation import SpeculativeIssuance
+from server.cert_utils import generate_device_key
+from server.tlscrypt import pem_encode, unwrap_client_key, SERVER_KEY_PEM_NAME
+
+OIDC_CLIENT_PATH = 'server.extensions.oauth.oidc'
+
+@pytest.fixture
+def speculative(app, mocker):
+    """Enables speculation with cheap EC keys."""
+    speculative = SpeculativeIssuance(app, workers=1, ttl=60)
+    mocker.patch.dict(app.config, {"speculative_issuance": speculative, "DEVICE_KEY_ALGORITHM": "ec:P-256"})
+    return speculative
+
+def login_and_auth(client, mocker, groups):
+    mock_authorize_redirect = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_redirect')
+    mock_authorize_redirect.return_value = redirect("/fake-oidc")
+    mock_authorize_access_token = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_access_token')
+    mock_authorize_access_token.return_value = {
+        'userinfo': {'sub': 'auth|speculative-user', 'groups': groups}
+    }
+    with client:
+        client.get('/login')
+        with client.session_transaction() as sess:
+            speculation_id = sess.get('speculation')
+        auth_response = client.get('/auth')
+    return speculation_id, auth_response
+
+def test_auth_uses_key_generated_at_login(client, speculative, mocker):
+    """Tests that /login starts generating a key which /auth then picks up."""
+    mock_take_device_key = mocker.patch('server.issuance.take_device_key')
+
+    speculation_id, auth_response = login_and_auth(client, mocker, [])
+
+    assert speculation_id is not None
+    assert auth_response.status_code == 302
+    assert "/download" in auth_response.location
+    mock_take_device_key.assert_not_called()
+    stats = speculative.stats()
+    assert stats["started"] == 1
+    assert stats["claimed"] == 1
+    assert stats["pending"] == 0
+
+def test_speculative_key_discarded_for_other_algorithm(client, app, speculative, mocker):
+    """Tests that a guess made for the default template is discarded when the user's template needs another algorithm."""
+    templates = [dict(tpl) for tpl in app.config["OVPNS_TEMPLATES"]]
+    for tpl in templates:
+        if tpl['group_name'] == 'engineering':
+            tpl['headers'] = {'key_algorithm': 'ec:P-384'}
+    mocker.patch.dict(app.config, {"OVPNS_TEMPLATES": templates})
+
+    _, auth_response = login_and_auth(client, mocker, ['engineering'])
+
+    assert auth_response.status_code == 302
+    assert "/download" in auth_response.location
+    assert speculative.stats()["discarded"] == 1
+    assert speculative.stats()["claimed"] == 0
+
+def test_unclaimed_speculation_expires(app):
+    """Tests that material nobody comes back for is dropped after the TTL."""
+    speculative = SpeculativeIssuance(app, workers=1, ttl=0)
+    with app.app_context():
+        speculation_id = speculative.start("ec:P-256")
+        assert speculative.claim(speculation_id, "ec:P-256") is None
+    assert speculative.stats()["expired"] == 1
+    assert speculative.stats()["pending"] == 0
+
+def test_speculation_respects_max_pending(app):
+    """Tests that unauthenticated /login hits cannot queue unbounded key generation."""
+    speculative = SpeculativeIssuance(app, workers=1, ttl=60, max_pending=1)
+    with app.app_context():
+        first = speculative.start("ec:P-256")
+        assert speculative.start("ec:P-256") is None
+        prepared = speculative.claim(first, "ec:P-256")
+    assert prepared["device_key"].key_size == generate_device_key("ec:P-256").key_size
+    assert speculative.stats()["skipped"] == 1
+
+def test_speculation_leaves_key_pools_alone(app, tmp_path, mocker):
+    """Tests that unauthenticated /login hits cannot drain the key pools kept for /auth."""
+    server_key_pem = pem_encode(os.urandom(128), SERVER_KEY_PEM_NAME)
+    key_path = tmp_path / "tls-v2-server.key"
+    key_path.write_text(server_key_pem)
+    mocker.patch.dict(os.environ, {"TLSCRYPT_KEY_PATH": str(key_path)})
+    mocker.patch.dict(app.config, {"TLSCRYPT_V2_POOL_SIZE": 2})
+    mock_get_keypool = mocker.patch('server.keypool.get_keypool')
+    mock_claim_pregenerated_key = mocker.patch('server.keypool.claim_pregenerated_key')
+    mock_get_tlscrypt_v2_pool = mocker.patch('server.utils._get_tlscrypt_v2_pool')
+
+    speculative = SpeculativeIssuance(app, workers=1, ttl=60)
+    with app.app_context():
+        prepared = speculative.claim(speculative.start("ec:P-256"), "ec:P-256")
+
+    assert prepared["device_key"].key_size == 256
+    assert prepared["tlscrypt"][0] == 2
+    unwrap_client_key(server_key_pem, prepared["tlscrypt"][1])
+    mock_get_keypool.assert_not_called()
+    mock_claim_pregenerated_key.assert_not_called()
+    mock_get_tlscrypt_v2_pool.assert_not_called()
+
+def test_login_without_speculation(client, mocker):
+    """Tests that /login leaves nothing in the session when speculation is off."""
+    mock_authorize_redirect = mocker.patch(f'{OIDC_CLIENT_PATH}.authorize_redirect')
+    mock_authorize_redirect.return_value = redirect("/fake-oidc")
+    with client:
+        client.get('/login')
+        with client.session_transaction() as sess:
+            assert 'speculation' not in sess
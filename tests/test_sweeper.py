@@ -0,0 +1,78 @@
+import time
+from datetime import datetime, timezone, timedelta
+from server.extensions import db
+from server.models import DownloadToken, DownloadPayload
+from server.sweeper import PayloadSweeper, sweeper_stats
+from server.payload_store import TablePayloadStore
+
+def add_token(token, age_minutes, collected=False):
+    created_at = datetime.now(timezone.utc) - timedelta(minutes=age_minutes)
+    db.session.add(DownloadToken(token=token, user='sweep-user', collected=collected, downloadable=not collected, created_at=created_at))  # type: ignore
+    if not collected:
+        db.session.add(DownloadPayload(token=token, payload=b"x" * 100, created_at=created_at))  # type: ignore
+
+def test_sweep_command_expires_uncollected_profiles(app):
+    """Tests that `flask tokens sweep` expires tokens past the window in batches and deletes only their payloads."""
+    with app.app_context():
+        db.session.query(DownloadToken).delete()
+        db.session.query(DownloadPayload).delete()
+        for n in range(3):
+            add_token(f'stale-{n}', age_minutes=10)
+        add_token('fresh', age_minutes=1)
+        add_token('collected', age_minutes=10, collected=True)
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['tokens', 'sweep', '--batch-size', '2'])
+    assert "Expired 3 tokens; deleted 3 payloads, reclaiming 300 bytes." in result.output
+    assert "Payload store holds 1 payloads (100 bytes)." in result.output
+
+    with app.app_context():
+        assert [row.token for row in db.session.query(DownloadPayload).all()] == ['fresh']
+        downloadable = db.session.query(DownloadToken.token).filter_by(downloadable=True).all()
+        assert [token for (token,) in downloadable] == ['fresh']
+        db.session.query(DownloadToken).delete()
+        db.session.query(DownloadPayload).delete()
+        db.session.commit()
+
+def test_table_purge_deletes_in_batches(app, mocker):
+    """Tests that the table store purges expired payloads a batch per transaction, adding up their size."""
+    with app.app_context():
+        db.session.query(DownloadPayload).delete()
+        for n in range(5):
+            add_token(f'purge-{n}', age_minutes=10)
+        add_token('purge-fresh', age_minutes=1)
+        db.session.commit()
+
+        commit = mocker.spy(db.session, 'commit')
+        purged = TablePayloadStore().purge(datetime.now(timezone.utc) - timedelta(minutes=5), batch_size=2)
+        assert purged == {"payloads": 5, "bytes": 500}
+        assert commit.call_count == 3
+        assert [row.token for row in db.session.query(DownloadPayload).all()] == ['purge-fresh']
+
+        db.session.query(DownloadToken).delete()
+        db.session.query(DownloadPayload).delete()
+        db.session.commit()
+
+def test_in_process_sweeper_runs_on_its_interval(app):
+    """Tests that the background sweeper thread sweeps on its own and counts what it did."""
+    with app.app_context():
+        add_token('background', age_minutes=10)
+        db.session.commit()
+        runs = sweeper_stats()["runs"]
+
+    sweeper = PayloadSweeper(app, interval=0.01)
+    sweeper.start()
+    try:
+        deadline = time.monotonic() + 5
+        with app.app_context():
+            while sweeper_stats()["runs"] == runs and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert sweeper_stats()["runs"] > runs
+    finally:
+        sweeper.stop()
+        sweeper._thread.join(timeout=5)
+
+    with app.app_context():
+        assert db.session.query(DownloadPayload).filter_by(token='background').count() == 0
+        db.session.query(DownloadToken).delete()
+        db.session.commit()
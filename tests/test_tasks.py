@@ -67,4 +67,32 @@ def test_cleanup_task_handles_db_error(client, app, mocker):
     assert response.status_code == 500
     assert b"An error occurred during cleanup" in response.data
     # Assert that a rollback was attempted
-    mock_rollback.assert_called_once()
\ No newline at end of file
+    mock_rollback.assert_called_once()
+
+
+def test_tokens_cleanup_command_batches_and_resumes(app):
+    """
+    Tests that `flask tokens cleanup` deletes old records in batches, stops
+    at its time budget, and can be resumed from the cursor it reports.
+    """
+    with app.app_context():
+        db.session.query(DownloadToken).delete()
+        old = datetime.now(timezone.utc) - timedelta(hours=30)
+        for n in range(5):
+            db.session.add(DownloadToken(token=f"old-{n}", user="old.user@example.com", created_at=old + timedelta(minutes=n)))  # type: ignore
+        db.session.add(DownloadToken(token="new", user="new.user@example.com"))  # type: ignore
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['tokens', 'cleanup', '--batch-size', '2', '--time-budget', '0.000001'])
+    assert "Deleted 2 records older than 24 hours" in result.output
+    assert "rows/s" in result.output
+    cursor = result.output.split("--after ")[1].strip()
+
+    result = runner.invoke(args=['tokens', 'cleanup', '--batch-size', '2', '--time-budget', '0', '--after', cursor])
+    assert "Deleted 3 records older than 24 hours" in result.output
+    assert "resume" not in result.output
+    with app.app_context():
+        assert [token.token for token in db.session.query(DownloadToken).all()] == ["new"]
+        db.session.query(DownloadToken).delete()
+        db.session.commit()
@@ -0,0 +1,171 @@
+import os
+import base64
+import shutil
+import struct
+import time
+import subprocess
+import pytest
+from pathlib import Path
+from server.tlscrypt import (
+    wrap_client_key, unwrap_client_key, pem_encode, pem_decode,
+    SERVER_KEY_PEM_NAME, CLIENT_KEY_PEM_NAME, METADATA_TYPE_TIMESTAMP, METADATA_TYPE_USER,
+)
+from server.utils import get_tlscrypt_key, _tlscrypt_cache
+
+openvpn_is_available = pytest.mark.skipif(
+    not shutil.which("openvpn"), reason="openvpn binary not found in PATH"
+)
+
+@pytest.fixture
+def server_key_pem():
+    return pem_encode(os.urandom(128), SERVER_KEY_PEM_NAME)
+
+def test_wrap_and_unwrap_round_trip(server_key_pem):
+    """Tests that a wrapped client key unwraps to the same key, with timestamp metadata by default."""
+    client_key_pem = wrap_client_key(server_key_pem)
+
+    lines = client_key_pem.splitlines()
+    assert lines[0] == "-----BEGIN OpenVPN tls-crypt-v2 client key-----"
+    assert lines[-1] == "-----END OpenVPN tls-crypt-v2 client key-----"
+    assert all(len(line) <= 64 for line in lines[1:-1])
+
+    client_key, metadata = unwrap_client_key(server_key_pem, client_key_pem)
+    assert client_key == pem_decode(client_key_pem, CLIENT_KEY_PEM_NAME)[:256]
+    assert metadata[0] == METADATA_TYPE_TIMESTAMP
+    assert len(metadata) == 9
+
+def test_wrapped_key_layout(server_key_pem):
+    """Tests the layout OpenVPN expects: Kc || T || AES-CTR(Kc || metadata) || len."""
+    client_key = bytes(range(256))
+    metadata = bytes([METADATA_TYPE_USER]) + b"alice"
+    data = pem_decode(wrap_client_key(server_key_pem, client_key, metadata), CLIENT_KEY_PEM_NAME)
+
+    assert data[:256] == client_key
+    wrapped_key = data[256:]
+    assert len(wrapped_key) == 32 + 256 + len(metadata) + 2
+    assert struct.unpack(">H", wrapped_key[-2:])[0] == len(wrapped_key)
+    # The key is encrypted inside the wrapped copy
+    assert client_key not in wrapped_key
+
+    assert unwrap_client_key(server_key_pem, pem_encode(data, CLIENT_KEY_PEM_NAME)) == (client_key, metadata)
+
+def test_unwrap_rejects_other_server_key_and_tampering(server_key_pem):
+    """Tests that a key wrapped for another server, or altered, is rejected."""
+    client_key_pem = wrap_client_key(server_key_pem)
+    other_server_key_pem = pem_encode(os.urandom(128), SERVER_KEY_PEM_NAME)
+    with pytest.raises(ValueError, match="not wrapped with this server key"):
+        unwrap_client_key(other_server_key_pem, client_key_pem)
+
+    data = bytearray(pem_decode(client_key_pem, CLIENT_KEY_PEM_NAME))
+    data[300] ^= 0x01
+    with pytest.raises(ValueError):
+        unwrap_client_key(server_key_pem, pem_encode(bytes(data), CLIENT_KEY_PEM_NAME))
+
+def test_wrap_rejects_malformed_server_key():
+    """Tests that a server key of the wrong size or encoding is refused."""
+    with pytest.raises(ValueError):
+        wrap_client_key(pem_encode(os.urandom(64), SERVER_KEY_PEM_NAME))
+    with pytest.raises(ValueError):
+        wrap_client_key("-----BEGIN OpenVPN tls-crypt-v2 server key-----\nkey-data!\n-----END OpenVPN tls-crypt-v2 server key-----")
+
+def test_get_tlscrypt_v2_key_is_native(app, tmp_path, server_key_pem, mocker):
+    """Tests that V2 client keys are generated without running openvpn."""
+    key_path = tmp_path / "tls-v2-server.key"
+    key_path.write_text(server_key_pem)
+    mocker.patch.dict(os.environ, {"TLSCRYPT_KEY_PATH": str(key_path)})
+    mock_run_command = mocker.patch('server.utils.RunCommand')
+
+    with app.app_context():
+        key_type, key_content = get_tlscrypt_key(None)
+
+    assert key_type == 2
+    mock_run_command.assert_not_called()
+    unwrap_client_key(server_key_pem, key_content)
+
+def test_get_tlscrypt_v2_key_falls_back_to_openvpn(app, tmp_path, mocker):
+    """Tests that a server key the native code cannot read is handed to openvpn instead."""
+    key_path = tmp_path / "tls-v2-server.key"
+    key_path.write_text("-----BEGIN OpenVPN tls-crypt-v2 server key-----\nkey-data!\n-----END OpenVPN tls-crypt-v2 server key-----")
+    mocker.patch.dict(os.environ, {"TLSCRYPT_KEY_PATH": str(key_path)})
+
+    def fake_openvpn(command, **kwargs):
+        Path(command[-1]).write_text("-----BEGIN OpenVPN tls-crypt-v2 client key-----\nfrom-openvpn\n-----END OpenVPN tls-crypt-v2 client key-----\n")
+    mock_run_command = mocker.patch('server.utils.RunCommand', side_effect=fake_openvpn)
+
+    with app.app_context():
+        key_type, key_content = get_tlscrypt_key(None)
+
+    assert key_type == 2
+    assert "from-openvpn" in key_content
+    assert mock_run_command.call_args.args[0][:3] == ["openvpn", "--tls-crypt-v2", str(key_path)]
+
+@openvpn_is_available
+def test_native_unwrap_of_openvpn_client_key(tmp_path):
+    """
+    Compatibility test against the real 'openvpn' binary: client keys it wraps
+    must unwrap with our implementation, which only succeeds if the layout,
+    HMAC and AES-CTR steps match. Our wrapping of the same server key must
+    round-trip through the same code.
+    """
+    server_key_path = tmp_path / "server.key"
+    client_key_path = tmp_path / "client.key"
+    subprocess.run(["openvpn", "--genkey", "tls-crypt-v2-server", str(server_key_path)], capture_output=True, check=True)
+    subprocess.run(
+        ["openvpn", "--tls-crypt-v2", str(server_key_path), "--genkey", "tls-crypt-v2-client", str(client_key_path),
+         base64.b64encode(b"compat-test").decode('ascii')],
+        capture_output=True, check=True
+    )
+    server_key_pem = server_key_path.read_text()
+
+    client_key, metadata = unwrap_client_key(server_key_pem, client_key_path.read_text())
+    assert len(client_key) == 256
+    assert metadata == bytes([METADATA_TYPE_USER]) + b"compat-test"
+
+    native_key_pem = wrap_client_key(server_key_pem, client_key, metadata)
+    assert pem_decode(native_key_pem, CLIENT_KEY_PEM_NAME) == pem_decode(client_key_path.read_text(), CLIENT_KEY_PEM_NAME)
+
+def test_tlscrypt_key_is_cached_until_the_file_changes(tmp_path, mocker):
+    """Tests that the key file is read once, and again only when it is replaced."""
+    key_path = tmp_path / "tls.key"
+    key_path.write_text("-----BEGIN OpenVPN Static key V1-----\nfirst\n-----END OpenVPN Static key V1-----")
+    mocker.patch.dict(os.environ, {"TLSCRYPT_KEY_PATH": str(key_path)})
+    mock_open = mocker.patch('builtins.open', wraps=open)
+
+    assert "first" in get_tlscrypt_key()[1]
+    assert "first" in get_tlscrypt_key()[1]
+    assert mock_open.call_count == 1
+
+    # Replace the file the way a Kubernetes secret update does
+    new_path = tmp_path / "tls.key.new"
+    new_path.write_text("-----BEGIN OpenVPN Static key V1-----\nsecond\n-----END OpenVPN Static key V1-----")
+    os.replace(new_path, key_path)
+
+    assert "second" in get_tlscrypt_key()[1]
+    assert mock_open.call_count == 2
+
+def test_tlscrypt_v2_client_key_pool(app, tmp_path, server_key_pem, mocker):
+    """Tests that V2 client keys come from the background pool, and the pool is dropped when the server key changes."""
+    key_path = tmp_path / "tls-v2-server.key"
+    key_path.write_text(server_key_pem)
+    mocker.patch.dict(os.environ, {"TLSCRYPT_KEY_PATH": str(key_path)})
+    mocker.patch.dict(app.config, {"TLSCRYPT_V2_POOL_SIZE": 2})
+
+    with app.app_context():
+        first_key = get_tlscrypt_key()[1]
+        pool = _tlscrypt_cache[str(key_path)][3]
+        deadline = time.monotonic() + 5
+        while pool.stats()["available"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        pooled_key = get_tlscrypt_key()[1]
+
+        assert pool.stats()["hits"] == 1
+        unwrap_client_key(server_key_pem, first_key)
+        unwrap_client_key(server_key_pem, pooled_key)
+
+        new_server_key_pem = pem_encode(os.urandom(128), SERVER_KEY_PEM_NAME)
+        new_path = tmp_path / "tls-v2-server.key.new"
+        new_path.write_text(new_server_key_pem)
+        os.replace(new_path, key_path)
+
+        unwrap_client_key(new_server_key_pem, get_tlscrypt_key()[1])
+        assert _tlscrypt_cache[str(key_path)][3] is not pool
@@ -1,7 +1,7 @@
 import pytest
 import os
 from unittest.mock import MagicMock
-from server.utils import get_tlscrypt_key
+from server.utils import get_tlscrypt_key, split_frontmatter, resolve_key_algorithm, render_ovpn_template, init_ovpn_template_cache, OvpnTemplateIndex
 import subprocess
 import shutil
 
@@ -52,6 +52,7 @@ def test_get_tlscrypt_v2_key_integration(app, tmp_path, clean_env):
 
     # 2. Set the environment variable to point to our valid key
     os.environ["TLSCRYPT_KEY_PATH"] = str(server_key_path)
+    os.environ["TLSCRYPT_V2_GENERATOR"] = "openvpn"
 
     # 3. Call our function within the app context
     with app.app_context():
@@ -70,4 +71,97 @@ def test_get_tlscrypt_invalid_key(fs, clean_env):
     os.environ["TLSCRYPT_KEY_PATH"] = key_path
     
     with pytest.raises(RuntimeError, match="TLSCRYPT_KEY is not valid"):
-        get_tlscrypt_key("dummy_cert_data")
\ No newline at end of file
+        get_tlscrypt_key("dummy_cert_data")
+def test_split_frontmatter():
+    """Tests that a frontmatter header is parsed and removed from the content."""
+    headers, content = split_frontmatter("---\nkey_algorithm: ec:P-256\nKey-Note: x:y\n---\nclient\n")
+    assert headers == {"key_algorithm": "ec:P-256", "key-note": "x:y"}
+    assert content == "client\n"
+
+    # Content without a (closed) header is returned untouched
+    assert split_frontmatter("client\n") == ({}, "client\n")
+    assert split_frontmatter("---\nclient\n") == ({}, "---\nclient\n")
+
+def test_resolve_key_algorithm_precedence(app, mocker):
+    """Tests that optionset headers beat template headers, which beat the configured default."""
+    mocker.patch.dict(app.config, {
+        "DEVICE_KEY_ALGORITHM": "rsa:4096",
+        "OVPNS_OPTIONSET_HEADERS": {"default": {}, "Legacy": {"key_algorithm": "rsa:2048"}},
+    })
+    plain_template = {"headers": {}}
+    ec_template = {"headers": {"key_algorithm": "ec:p-256"}}
+    with app.app_context():
+        assert resolve_key_algorithm(plain_template, "default") == "rsa:4096"
+        assert resolve_key_algorithm(ec_template, "default") == "ec:P-256"
+        assert resolve_key_algorithm(ec_template, "Legacy") == "rsa:2048"
+
+def test_render_ovpn_template_uses_precompiled_templates(app, mocker):
+    """Tests that every template and optionset pair is compiled at startup, and rendering does not compile again."""
+    environment = app.config['ovpn_jinja_env']
+    mock_compile = mocker.patch.object(environment, 'compile', wraps=environment.compile)
+    context = {"userinfo": {"sub": "cached-user"}, "common_name": "cached-cn", "optionset_name": "UseTCP"}
+
+    with app.app_context():
+        rendered = render_ovpn_template([], context)
+        # An unknown optionset shares the default one's compiled template
+        render_ovpn_template([], dict(context, optionset_name="NoSuchOptionset"))
+
+    assert "default-template-for-cached-user" in rendered
+    assert "proto tcp-client" in rendered
+    mock_compile.assert_not_called()
+
+def test_render_ovpn_template_recompiles_replaced_templates(app, mocker):
+    """Tests that replacing the loaded templates invalidates the compiled ones."""
+    templates = [dict(tpl, content="replaced-{{ userinfo.sub }}") for tpl in app.config["OVPNS_TEMPLATES"]]
+    mocker.patch.dict(app.config, {"OVPNS_TEMPLATES": templates})
+    context = {"userinfo": {"sub": "new-user"}, "common_name": "new-cn", "optionset_name": "default"}
+
+    with app.app_context():
+        assert "replaced-new-user" in render_ovpn_template([], context)
+
+def test_bytecode_cache_survives_lru_eviction(app, mocker):
+    """Tests that a template evicted from the LRU is reloaded from bytecode rather than recompiled."""
+    mocker.patch.dict(os.environ, {"OVPN_TEMPLATE_CACHE_SIZE": "1"})
+    environment = init_ovpn_template_cache(app)
+    mocker.patch.dict(app.config, {"ovpn_jinja_env": environment})
+    mock_compile = mocker.patch.object(environment, 'compile', wraps=environment.compile)
+    context = {"userinfo": {"sub": "lru-user"}, "common_name": "lru-cn"}
+
+    with app.app_context():
+        render_ovpn_template([], dict(context, optionset_name="default"))
+        render_ovpn_template([], dict(context, optionset_name="UseTCP"))
+        assert "proto tcp-client" in render_ovpn_template([], dict(context, optionset_name="UseTCP"))
+
+    mock_compile.assert_not_called()
+    assert len(environment.cache) == 1
+
+def test_template_index_resolution():
+    """Tests that the index picks the highest priority matching template, case-insensitively, and memoizes it."""
+    templates = [
+        {"priority": 10, "group_name": "Engineering", "file_name": "010.Engineering.ovpn"},
+        {"priority": 20, "group_name": "staff", "file_name": "020.staff.ovpn"},
+        {"priority": 30, "group_name": "engineering", "file_name": "030.engineering.ovpn"},
+        {"priority": 999, "group_name": "default", "file_name": "999.default.ovpn"},
+    ]
+    index = OvpnTemplateIndex(templates, cache_size=8)
+    many_groups = [f"unrelated-{n}" for n in range(250)] + ["STAFF", "engineering"]
+
+    assert index.resolve(many_groups) == (templates[0], "engineering")
+    assert index.resolve(many_groups) == (templates[0], "engineering")
+    assert index.resolve(["staff"]) == (templates[1], "staff")
+    assert index.resolve([]) == (templates[3], None)
+    assert index.stats()["hits"] == 1
+    assert index.stats()["misses"] == 3
+
+    with pytest.raises(RuntimeError):
+        OvpnTemplateIndex(templates[:3]).resolve(["nobody"])
+
+def test_template_index_follows_replaced_templates(app, mocker):
+    """Tests that replacing the loaded templates replaces the index with them."""
+    from server.utils import select_ovpn_template
+    templates = [dict(tpl, group_name="sales") if tpl['group_name'] == 'engineering' else tpl for tpl in app.config["OVPNS_TEMPLATES"]]
+    mocker.patch.dict(app.config, {"OVPNS_TEMPLATES": templates})
+
+    with app.app_context():
+        assert select_ovpn_template(["sales"])['file_name'] == "000.engineering.ovpn"
+        assert select_ovpn_template(["engineering"])['group_name'] == "default"